@@ -0,0 +1,235 @@
+"""
+Admission control for the API.
+
+Every /api request is charged to a token bucket keyed by the caller's address
+and the route's class, and requests to expensive routes (searches, listings,
+exports, bulk uploads, analytics) also need one of a fixed number of
+concurrency slots. A request that is over its rate gets 429 and one that
+finds every slot taken for ADMISSION_QUEUE_TIMEOUT seconds gets 503, both
+with Retry-After, before the view touches the database. In the async serving
+mode (asgi.py) there is no queueing: a request finding no free slot gets 503
+at once.
+
+Routes declare their class with the limit() decorator; undecorated GETs are
+'read' and everything else 'write'. Rates are configured per class as
+RATE_LIMITS = {'read': (per_second, burst), ...}.
+
+Two stores, like the response cache:
+- 'memory' (default): buckets and slots per process, so the rates and the
+  ADMISSION_MAX_CONCURRENT cap apply per worker, not per host. Each gthread
+  worker of gunicorn.conf.py serves WEB_THREADS requests at once and can
+  hold that many slots, up to the cap; N workers admit up to N times the
+  cap.
+- 'sqlite': a file shared by every worker on the host, so rates and the
+  slot cap are host-wide. Slots are leases that expire after
+  ADMISSION_SLOT_LEASE seconds in case a worker dies holding one.
+
+Behind a reverse proxy, wrap the app in werkzeug's ProxyFix so
+request.remote_addr is the real client.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from flask import current_app, g, jsonify, request
+
+DEFAULT_RATE_LIMITS = {
+    'read': (20, 40),
+    'write': (5, 20),
+    'expensive': (5, 10),
+}
+DEFAULT_MAX_CONCURRENT = 4
+DEFAULT_QUEUE_TIMEOUT = 0.25
+DEFAULT_SLOT_LEASE = 300
+MAX_BUCKETS = 10000
+# Shared buckets idle this long are full again and can be forgotten
+BUCKET_IDLE_SECONDS = 3600
+PURGE_EVERY = 1000
+SLOT_POLL_INTERVAL = 0.01
+
+EXPENSIVE = 'expensive'
+
+# Set in the WSGI environ by servers that run views on an event loop
+# (asgi.py), where waiting for a slot would stall every other request
+NONBLOCKING_KEY = 'admission.nonblocking'
+
+
+class MemoryStore:
+    """Per-process token buckets (LRU-bounded) and a semaphore of slots"""
+
+    def __init__(self, max_concurrent, max_buckets=MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    def take(self, key, rate, burst):
+        """Spend a token; returns 0 if admitted, else seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / rate
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def acquire(self, timeout):
+        return True if self._slots.acquire(timeout=timeout) else None
+
+    def release(self, slot):
+        self._slots.release()
+
+
+class SQLiteStore:
+    """Buckets and slot leases shared by every worker process through a local SQLite file"""
+
+    def __init__(self, path, max_concurrent, lease=DEFAULT_SLOT_LEASE):
+        self.path = path
+        self.max_concurrent = max_concurrent
+        self.lease = lease
+        self._local = threading.local()
+        self._calls = 0
+        with self._connect() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS rate_bucket (
+                    key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS admission_slot (
+                    id TEXT PRIMARY KEY, expires_at REAL NOT NULL
+                );
+            ''')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        connection = self._connect()
+        # Refill and spend in one statement; the update is skipped when the
+        # refilled bucket still holds less than a token
+        admitted = connection.execute(
+            'INSERT INTO rate_bucket (key, tokens, updated) VALUES (?1, ?3 - 1, ?4) '
+            'ON CONFLICT (key) DO UPDATE SET '
+            'tokens = min(?3, tokens + (?4 - updated) * ?2) - 1, updated = ?4 '
+            'WHERE min(?3, tokens + (?4 - updated) * ?2) >= 1',
+            (key, rate, burst, now)
+        ).rowcount
+        self._calls += 1
+        if self._calls % PURGE_EVERY == 0:
+            connection.execute('DELETE FROM rate_bucket WHERE updated < ?', (now - BUCKET_IDLE_SECONDS,))
+        if admitted:
+            return 0
+        row = connection.execute('SELECT tokens, updated FROM rate_bucket WHERE key = ?', (key,)).fetchone()
+        tokens = min(burst, row[0] + (now - row[1]) * rate) if row else 0
+        return max((1 - tokens) / rate, 0.001)
+
+    def _try_acquire(self):
+        now = time.time()
+        slot = uuid.uuid4().hex
+        connection = self._connect()
+        connection.execute('DELETE FROM admission_slot WHERE expires_at < ?', (now,))
+        acquired = connection.execute(
+            'INSERT INTO admission_slot (id, expires_at) SELECT ?, ? '
+            'WHERE (SELECT COUNT(*) FROM admission_slot) < ?',
+            (slot, now + self.lease, self.max_concurrent)
+        ).rowcount
+        return slot if acquired else None
+
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            slot = self._try_acquire()
+            if slot is not None or time.monotonic() >= deadline:
+                return slot
+            time.sleep(SLOT_POLL_INTERVAL)
+
+    def release(self, slot):
+        self._connect().execute('DELETE FROM admission_slot WHERE id = ?', (slot,))
+
+
+class AdmissionControl:
+    """Flask extension applying rate limits and the expensive-route slot cap"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('ADMISSION_ENABLED', True):
+            return
+        max_concurrent = app.config.get('ADMISSION_MAX_CONCURRENT', DEFAULT_MAX_CONCURRENT)
+        if app.config.get('ADMISSION_BACKEND', 'memory') == 'sqlite':
+            path = app.config.get('ADMISSION_PATH', os.path.join(app.instance_path, 'admission.db'))
+            store = SQLiteStore(path, max_concurrent,
+                                app.config.get('ADMISSION_SLOT_LEASE', DEFAULT_SLOT_LEASE))
+        else:
+            store = MemoryStore(max_concurrent)
+        app.extensions['admission'] = {
+            'store': store,
+            'rates': dict(DEFAULT_RATE_LIMITS, **app.config.get('RATE_LIMITS', {})),
+            'queue_timeout': app.config.get('ADMISSION_QUEUE_TIMEOUT', DEFAULT_QUEUE_TIMEOUT),
+        }
+        app.before_request(self._admit)
+        app.teardown_request(self._release)
+
+    def limit(self, route_class):
+        """Put a view in a route class; EXPENSIVE views also take a concurrency slot"""
+        def decorator(view):
+            view.admission_class = route_class
+            return view
+        return decorator
+
+    def _route_class(self):
+        view = current_app.view_functions.get(request.endpoint)
+        route_class = getattr(view, 'admission_class', None)
+        if route_class is not None:
+            return route_class
+        return 'read' if request.method in ('GET', 'HEAD') else 'write'
+
+    def _admit(self):
+        # CORS preflights and non-API routes (/metrics) are never limited
+        if request.method == 'OPTIONS' or not request.path.startswith('/api/'):
+            return None
+        state = current_app.extensions['admission']
+        route_class = self._route_class()
+        rate, burst = state['rates'][route_class]
+        wait = state['store'].take(f'{request.remote_addr}:{route_class}', rate, burst)
+        if wait:
+            response = jsonify({'error': 'Too many requests'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(wait))
+            return response
+        if route_class == EXPENSIVE:
+            timeout = 0 if request.environ.get(NONBLOCKING_KEY) else state['queue_timeout']
+            slot = state['store'].acquire(timeout)
+            if slot is None:
+                response = jsonify({'error': 'Server busy, retry shortly'})
+                response.status_code = 503
+                response.headers['Retry-After'] = '1'
+                return response
+            g.admission_slot = slot
+        return None
+
+    def _release(self, exc):
+        slot = g.pop('admission_slot', None)
+        if slot is not None:
+            current_app.extensions['admission']['store'].release(slot)
+
+
+admission = AdmissionControl()
@@ -0,0 +1,447 @@
+"""
+Surveillance analytics per health program.
+
+Five metrics over a date window, binned by day or ISO week:
+- incidence: new enrollments per period
+- prevalence: active enrollments at the end of each period
+- transitions: what enrollments started in each period (all of which start
+  'active') have moved to since
+- strata: enrollments and active enrollments by age band at enrollment and
+  gender
+- retention: of the active spells started in the window, the share still
+  active after each interval (Kaplan-Meier, spells still running censored
+  today), with how many remained at risk
+
+Incidence, transitions and strata read the enrollment rollup (program, day,
+status, age band, gender; see rollups.py), or with ROLLUPS_ENABLED=False one
+GROUP BY over enrollments joined to clients. Either way the rows number in the thousands
+however many enrollments there are, and are binned into
+period/program/stratum arrays with NumPy.
+
+Results are materialized in the analytics_result table. Requests are served
+from it; a missing or stale result is queued as a background job (see
+jobs.py) so requests never wait on the aggregation. ANALYTICS_SYNC=True computes
+missing results inline instead, which is convenient for tests and tiny
+databases.
+
+Prevalence and retention read the status spans kept by history.py instead,
+so an enrollment counts as active exactly while it was: a baseline of spans
+covering the window start, then grouped starts and ends per day.
+"""
+import json
+from datetime import date, datetime, timedelta
+import numpy as np
+from flask import current_app
+from sqlalchemy import extract, func
+from models import (db, Client, HealthProgram, Enrollment, EnrollmentRollup, EnrollmentStatusInterval,
+                    AnalyticsResult, ENROLLMENT_STATUSES)
+import history
+import rollups
+import jobs
+
+METRICS = ('incidence', 'prevalence', 'transitions', 'strata', 'retention')
+INTERVALS = ('day', 'week')
+DEFAULT_INTERVAL = 'week'
+DEFAULT_WINDOW_DAYS = 90
+MAX_WINDOW_DAYS = 3660
+DEFAULT_MAX_AGE = 300  # seconds before a materialized result is refreshed
+RETENTION_DAYS = 7
+
+
+class AnalyticsError(ValueError):
+    """Raised for invalid analytics parameters"""
+
+
+def init_app(app):
+    app.extensions['analytics'] = {
+        'max_age': app.config.get('ANALYTICS_MAX_AGE', DEFAULT_MAX_AGE),
+        'sync': app.config.get('ANALYTICS_SYNC', False),
+    }
+
+
+# --- Parameters ---
+
+def _parse_date(value, name):
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise AnalyticsError(f'{name} must be an ISO date (YYYY-MM-DD)')
+
+
+def parse_window(args):
+    """Validate interval, start/end (or days) and program_id from query arguments"""
+    interval = args.get('interval', DEFAULT_INTERVAL)
+    if interval not in INTERVALS:
+        raise AnalyticsError(f'interval must be one of {", ".join(INTERVALS)}')
+    end = _parse_date(args.get('end'), 'end') or datetime.utcnow().date()
+    start = _parse_date(args.get('start'), 'start')
+    if start is None:
+        try:
+            days = int(args.get('days', DEFAULT_WINDOW_DAYS))
+        except ValueError:
+            raise AnalyticsError('days must be an integer')
+        start = end - timedelta(days=max(1, days) - 1)
+    if start > end:
+        raise AnalyticsError('start must not be after end')
+    if (end - start).days >= MAX_WINDOW_DAYS:
+        raise AnalyticsError(f'The window may span at most {MAX_WINDOW_DAYS} days')
+    program_id = args.get('program_id')
+    if program_id is not None:
+        try:
+            program_id = int(program_id)
+        except ValueError:
+            raise AnalyticsError('program_id must be an integer')
+    return {'interval': interval, 'start': start, 'end': end, 'program_id': program_id}
+
+
+def result_key(metric, window):
+    program = window['program_id'] if window['program_id'] is not None else 'all'
+    return f'{metric}:{window["interval"]}:{window["start"]}:{window["end"]}:{program}'
+
+
+# --- Aggregation ---
+
+def _to_datetime(day):
+    return datetime.combine(day, datetime.min.time())
+
+
+def _cells(window, statuses=None):
+    """
+    Enrollment counts grouped by program, day, status, gender and age band
+    within the window, as a dict of NumPy columns
+    """
+    if rollups.rollups_enabled():
+        return _cells_from_rollup(window, statuses)
+
+    day = func.date(Enrollment.enrollment_date)
+    birth_year = extract('year', Client.date_of_birth)
+    query = db.session.query(
+        Enrollment.program_id, day, Enrollment.status, Client.gender, birth_year, func.count(Enrollment.id)
+    ).join(Client, Client.id == Enrollment.client_id).filter(
+        Enrollment.enrollment_date >= _to_datetime(window['start']),
+        Enrollment.enrollment_date < _to_datetime(window['end'] + timedelta(days=1))
+    )
+    if window['program_id'] is not None:
+        query = query.filter(Enrollment.program_id == window['program_id'])
+    if statuses is not None:
+        query = query.filter(Enrollment.status.in_(statuses))
+    rows = query.group_by(Enrollment.program_id, day, Enrollment.status, Client.gender, birth_year).all()
+
+    columns = list(zip(*rows)) or [()] * 6
+    cells = _columns(columns[0], columns[1], columns[2], columns[3], columns[5])
+    enrolled_year = cells['day'].astype('datetime64[Y]').astype(np.int64) + 1970
+    age = enrolled_year - np.array(columns[4], dtype=np.int64)
+    cells['band'] = np.clip(np.searchsorted(rollups.AGE_BANDS, age, side='right') - 1,
+                            0, len(rollups.AGE_BANDS) - 1)
+    return cells
+
+
+def _cells_from_rollup(window, statuses):
+    query = db.session.query(
+        EnrollmentRollup.program_id, EnrollmentRollup.day, EnrollmentRollup.status,
+        EnrollmentRollup.gender, EnrollmentRollup.age_band, EnrollmentRollup.count
+    ).filter(
+        EnrollmentRollup.day >= window['start'], EnrollmentRollup.day <= window['end'],
+        EnrollmentRollup.count != 0
+    )
+    if window['program_id'] is not None:
+        query = query.filter(EnrollmentRollup.program_id == window['program_id'])
+    if statuses is not None:
+        query = query.filter(EnrollmentRollup.status.in_(statuses))
+    columns = list(zip(*query.all())) or [()] * 6
+    cells = _columns(columns[0], columns[1], columns[2], columns[3], columns[5])
+    band_index = {label: i for i, label in enumerate(rollups.AGE_BAND_LABELS)}
+    cells['band'] = np.array([band_index[label] for label in columns[4]], dtype=np.int64)
+    return cells
+
+
+def _columns(program_ids, days, statuses, genders, counts):
+    status_index = {status: i for i, status in enumerate(ENROLLMENT_STATUSES)}
+    return {
+        'program_id': np.array(program_ids, dtype=np.int64),
+        'day': np.array([str(d) for d in days], dtype='datetime64[D]'),
+        # Unknown statuses land in an extra slot that is never reported
+        'status': np.array([status_index.get(s or 'active', len(status_index)) for s in statuses],
+                           dtype=np.int64),
+        'gender': np.array(genders, dtype=object),
+        'count': np.array(counts, dtype=np.int64),
+    }
+
+
+def _programs(window):
+    query = db.session.query(HealthProgram.id, HealthProgram.name).order_by(HealthProgram.id)
+    if window['program_id'] is not None:
+        query = query.filter(HealthProgram.id == window['program_id'])
+    rows = query.all()
+    return np.array([r[0] for r in rows], dtype=np.int64), [r[1] for r in rows]
+
+
+def _program_index(program_ids, cells):
+    """Position of each cell's program in program_ids, dropping cells of unknown programs"""
+    index = np.searchsorted(program_ids, cells['program_id'])
+    index = np.minimum(index, max(len(program_ids) - 1, 0))
+    known = (program_ids[index] == cells['program_id']) if len(program_ids) else np.zeros(len(index), bool)
+    return index, known
+
+
+def _period_starts(window):
+    """First day of each period and the first day of the first period"""
+    start = np.datetime64(window['start'], 'D')
+    end = np.datetime64(window['end'], 'D')
+    if window['interval'] == 'week':
+        # 1970-01-01 was a Thursday; align to the Monday on or before start
+        start = start - ((start.astype(np.int64) + 3) % 7)
+        step = 7
+    else:
+        step = 1
+    return np.arange(start, end + 1, step), start, step
+
+
+def _bin(shape, indices, weights):
+    """Sum weights into an array of the given shape at the given index tuples"""
+    flat = np.ravel_multi_index(indices, shape) if len(weights) else np.array([], dtype=np.int64)
+    return np.bincount(flat, weights=weights, minlength=int(np.prod(shape))).reshape(shape).astype(np.int64)
+
+
+def _series(program_ids, names, matrix, key):
+    return [
+        {'program_id': int(pid), 'name': name, key: row.tolist()}
+        for pid, name, row in zip(program_ids, names, matrix)
+    ]
+
+
+def incidence(window):
+    program_ids, names = _programs(window)
+    cells = _cells(window)
+    periods, first, step = _period_starts(window)
+    p, known = _program_index(program_ids, cells)
+    t = (cells['day'] - first).astype(np.int64) // step
+    counts = _bin((len(program_ids), len(periods)), (p[known], t[known]), cells['count'][known])
+    return {
+        'periods': [str(d) for d in periods],
+        'programs': _series(program_ids, names, counts, 'counts'),
+        'total': counts.sum(axis=0).tolist(),
+    }
+
+
+def _by_program_day(program_ids, rows, start, days):
+    """(program_id, day, count) rows as a programs x days array, day 0 being `start`"""
+    rows = [row for row in rows if row[1] is not None]
+    columns = list(zip(*rows)) or [()] * 3
+    cells = {'program_id': np.array(columns[0], dtype=np.int64),
+             'day': np.array([str(d) for d in columns[1]], dtype='datetime64[D]'),
+             'count': np.array(columns[2], dtype=np.int64)}
+    p, known = _program_index(program_ids, cells)
+    d = (cells['day'] - start).astype(np.int64)
+    return _bin((len(program_ids), days), (p[known], d[known]), cells['count'][known])
+
+
+def prevalence(window):
+    program_ids, names = _programs(window)
+    start = np.datetime64(window['start'], 'D')
+    days = (np.datetime64(window['end'], 'D') - start).astype(np.int64) + 1
+    lower = _to_datetime(window['start'])
+    upper = _to_datetime(window['end'] + timedelta(days=1))
+    span = EnrollmentStatusInterval
+    # program_id IN (...) keeps each query a range scan of a covering index
+    active = (span.status == 'active', span.program_id.in_(program_ids.tolist()))
+
+    # Active spans held when the window opens, then +1 the day one starts and
+    # -1 the day one ends
+    baseline = np.zeros(len(program_ids), dtype=np.int64)
+    for program_id, count in db.session.query(span.program_id, func.count()).filter(
+        *active, *history.covering(window['start'] - timedelta(days=1))
+    ).group_by(span.program_id):
+        baseline[np.searchsorted(program_ids, program_id)] = count
+    started = db.session.query(span.program_id, func.date(span.starts_at), func.count()).filter(
+        *active, span.starts_at >= lower, span.starts_at < upper
+    ).group_by(span.program_id, func.date(span.starts_at)).all()
+    ended = db.session.query(span.program_id, func.date(span.ends_at), func.count()).filter(
+        *active, span.ends_at >= lower, span.ends_at < upper
+    ).group_by(span.program_id, func.date(span.ends_at)).all()
+    daily = _by_program_day(program_ids, started, start, days) - _by_program_day(program_ids, ended, start, days)
+    running = baseline[:, None] + np.cumsum(daily, axis=1)
+
+    periods, first, step = _period_starts(window)
+    # Value on the last day of each period that falls inside the window
+    last_day = np.minimum((periods - start).astype(np.int64) + step - 1, days - 1)
+    active = running[:, last_day] if len(program_ids) else np.zeros((0, len(periods)), dtype=np.int64)
+    return {
+        'periods': [str(d) for d in periods],
+        'programs': _series(program_ids, names, active, 'active'),
+        'total': active.sum(axis=0).tolist(),
+    }
+
+
+def _survival(durations, ended, counts, days):
+    """
+    Kaplan-Meier estimate of staying active longer than each of 0..days days,
+    and how many spells were still at risk then, for spells lasting
+    `durations` days (still running ones censored at their current length)
+    """
+    length = np.minimum(durations, days + 1)
+    at_risk = np.cumsum(np.bincount(length, weights=counts, minlength=days + 2)[::-1])[::-1][:days + 1]
+    left = np.bincount(durations[ended & (durations <= days)], weights=counts[ended & (durations <= days)],
+                       minlength=days + 1)[:days + 1]
+    hazard = np.divide(left, at_risk, out=np.zeros(days + 1), where=at_risk > 0)
+    return np.cumprod(1 - hazard), at_risk.astype(np.int64)
+
+
+def retention(window):
+    program_ids, names = _programs(window)
+    span = EnrollmentStatusInterval
+    rows = db.session.query(
+        span.program_id, func.date(span.starts_at), func.date(span.ends_at), func.count()
+    ).filter(
+        span.status == 'active', span.program_id.in_(program_ids.tolist()),
+        span.starts_at >= _to_datetime(window['start']),
+        span.starts_at < _to_datetime(window['end'] + timedelta(days=1))
+    ).group_by(span.program_id, func.date(span.starts_at), func.date(span.ends_at)).all()
+
+    columns = list(zip(*rows)) or [()] * 4
+    today = np.datetime64(datetime.utcnow().date(), 'D')
+    program = np.searchsorted(program_ids, np.array(columns[0], dtype=np.int64))
+    began = np.array([str(d) for d in columns[1]], dtype='datetime64[D]')
+    ended = np.array([d is not None for d in columns[2]], dtype=bool)
+    until = np.array([str(d) if d is not None else str(today) for d in columns[2]], dtype='datetime64[D]')
+    durations = np.maximum((until - began).astype(np.int64), 0)
+    counts = np.array(columns[3], dtype=np.float64)
+
+    # Offsets step by the interval across the length of the window
+    _, _, step = _period_starts(window)
+    days = (window['end'] - window['start']).days + 1
+    offsets = np.arange(step, days + 1, step) if days >= step else np.array([days])
+    programs = []
+    for i, (pid, name) in enumerate(zip(program_ids, names)):
+        mine = program == i
+        survival, at_risk = _survival(durations[mine], ended[mine], counts[mine], days)
+        programs.append({'program_id': int(pid), 'name': name, 'started': int(counts[mine].sum()),
+                         'retained': np.round(survival[offsets], 4).tolist(),
+                         'at_risk': at_risk[offsets].tolist()})
+    survival, at_risk = _survival(durations, ended, counts, days)
+    return {
+        'days': offsets.tolist(),
+        'programs': programs,
+        'total': {'started': int(counts.sum()), 'retained': np.round(survival[offsets], 4).tolist(),
+                  'at_risk': at_risk[offsets].tolist()},
+    }
+
+
+def transitions(window):
+    program_ids, names = _programs(window)
+    cells = _cells(window)
+    periods, first, step = _period_starts(window)
+    p, known = _program_index(program_ids, cells)
+    t = (cells['day'] - first).astype(np.int64) // step
+    statuses = len(ENROLLMENT_STATUSES) + 1
+    counts = _bin((len(program_ids), len(periods), statuses),
+                  (p[known], t[known], cells['status'][known]), cells['count'][known])
+    programs = []
+    for pid, name, matrix in zip(program_ids, names, counts):
+        programs.append({
+            'program_id': int(pid),
+            'name': name,
+            'from': 'active',
+            'to': {status: int(matrix[:, i].sum()) for i, status in enumerate(ENROLLMENT_STATUSES)},
+            'by_period': {status: matrix[:, i].tolist() for i, status in enumerate(ENROLLMENT_STATUSES)},
+        })
+    return {'periods': [str(d) for d in periods], 'programs': programs}
+
+
+def strata(window):
+    program_ids, names = _programs(window)
+    cells = _cells(window)
+    p, known = _program_index(program_ids, cells)
+    band = cells['band']
+    genders, gender = np.unique(cells['gender'].astype(str), return_inverse=True)
+    active = cells['status'] == ENROLLMENT_STATUSES.index('active')
+
+    shape = (len(program_ids), len(rollups.AGE_BANDS), len(genders))
+    enrolled = _bin(shape, (p[known], band[known], gender[known]), cells['count'][known])
+    still_active = _bin(shape, (p[known & active], band[known & active], gender[known & active]),
+                        cells['count'][known & active])
+    programs = []
+    for i, (pid, name) in enumerate(zip(program_ids, names)):
+        rows = [
+            {'age_band': rollups.AGE_BAND_LABELS[b], 'gender': str(genders[s]),
+             'enrollments': int(enrolled[i, b, s]), 'active': int(still_active[i, b, s])}
+            for b in range(len(rollups.AGE_BANDS)) for s in range(len(genders))
+            if enrolled[i, b, s]
+        ]
+        programs.append({'program_id': int(pid), 'name': name, 'strata': rows})
+    return {'age_bands': list(rollups.AGE_BAND_LABELS), 'programs': programs}
+
+
+_COMPUTE = {'incidence': incidence, 'prevalence': prevalence, 'transitions': transitions, 'strata': strata,
+            'retention': retention}
+
+
+def compute(metric, window):
+    """Compute a metric for a window without touching the materialized results"""
+    payload = _COMPUTE[metric](window)
+    return dict(payload, metric=metric, interval=window['interval'],
+                start=window['start'].isoformat(), end=window['end'].isoformat(),
+                program_id=window['program_id'])
+
+
+# --- Materialization ---
+
+def refresh(metric, window):
+    """Compute a metric and store it as the materialized result for its window"""
+    if rollups.rollups_enabled():
+        # Fold in everything written since the last refresh
+        rollups.refresh()
+    payload = compute(metric, window)
+    now = datetime.utcnow()
+    db.session.merge(AnalyticsResult(key=result_key(metric, window), payload=json.dumps(payload),
+                                     computed_at=now))
+    # Results for windows nobody asked about recently (e.g. yesterday's default window)
+    AnalyticsResult.query.filter(
+        AnalyticsResult.computed_at < now - timedelta(days=RETENTION_DAYS)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return dict(payload, computed_at=now.isoformat(), stale=False)
+
+
+def get_result(metric, window):
+    """
+    The materialized result for a window and the refresh job queued for it,
+    if any. A refresh is queued when the result is missing or older than
+    ANALYTICS_MAX_AGE; the result is None until a missing one is computed.
+    """
+    state = current_app.extensions['analytics']
+    row = db.session.get(AnalyticsResult, result_key(metric, window))
+    fresh = row is not None and row.computed_at >= datetime.utcnow() - timedelta(seconds=state['max_age'])
+    if fresh:
+        return dict(json.loads(row.payload), computed_at=row.computed_at.isoformat(), stale=False), None
+    if state['sync']:
+        return refresh(metric, window), None
+    job = submit_refresh([metric], window)
+    if row is None:
+        return None, job
+    return dict(json.loads(row.payload), computed_at=row.computed_at.isoformat(), stale=True), job
+
+
+def submit_refresh(metrics, window):
+    """Queue a job refreshing these metrics for a window, unless one is already queued"""
+    params = {
+        'metrics': list(metrics),
+        'interval': window['interval'],
+        'start': window['start'].isoformat(),
+        'end': window['end'].isoformat(),
+        'program_id': window['program_id'],
+    }
+    key = 'analytics:' + ','.join(metrics) + ':' + result_key('', window)
+    return jobs.submit('refresh-analytics', params, dedupe_key=key)
+
+
+@jobs.handler('refresh-analytics')
+def refresh_job(context, metrics, interval, start, end, program_id=None):
+    window = parse_window({'interval': interval, 'start': start, 'end': end, 'program_id': program_id})
+    context.progress(0, len(metrics))
+    for done, metric in enumerate(metrics, start=1):
+        refresh(metric, window)
+        context.progress(done)
+    return {'refreshed': [result_key(metric, window) for metric in metrics]}
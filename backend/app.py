@@ -1,21 +1,77 @@
-from flask import Flask, request, jsonify, make_response
-from models import db, Client, HealthProgram, User, Enrollment
+from flask import Flask, Response, request, jsonify, make_response, send_file, stream_with_context
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import and_
+from sqlalchemy.orm import aliased, selectinload, joinedload
+from models import db, Client, ClientMatch, HealthProgram, User, Enrollment, EnrollmentStatusInterval, Job
+from pagination import paginate, column_map, parse_limit, PaginationError
+from serialization import JSONProvider, RowShape
+import search
+import stats
+import analytics
+import cohorts
+import history
+import rollups
+import jobs
+import linkage
+import sync
+import bulk
+import export
+import deletes
+import migrations
+import database
+import instrumentation
+from cache import cache
+from admission import admission, EXPENSIVE
+from idempotency import idempotency
+from commands import register_commands
 from datetime import datetime
+import json
 import os
 from flask_cors import CORS
 
+# Columns that may be requested through the fields= projection parameter
+CLIENT_FIELDS = column_map(Client, exclude=('first_name_norm', 'last_name_norm', 'name_phonetic'))
+PROGRAM_FIELDS = column_map(HealthProgram)
+ENROLLMENT_FIELDS = column_map(Enrollment)
+USER_FIELDS = column_map(User, exclude=('password_hash',))
+
+# List payloads built straight from result tuples; they match the
+# corresponding to_dict()/to_dict_basic() output
+CLIENT_ROWS = RowShape(Client.id, Client.first_name, Client.last_name, Client.date_of_birth)
+ENROLLMENT_ROWS = RowShape(
+    Enrollment.id, Enrollment.client_id, Enrollment.program_id,
+    HealthProgram.name.label('program_name'), Enrollment.enrollment_date,
+    Enrollment.status, Enrollment.notes, Enrollment.enrolled_by
+)
+# The same with ?as_of=: the status held then, and the id read from the span
+# so pages walk ix_status_interval_listing in order
+ENROLLMENT_AS_OF_KEY = EnrollmentStatusInterval.enrollment_id.label('id')
+ENROLLMENT_FIELDS_AS_OF = dict(ENROLLMENT_FIELDS, id=ENROLLMENT_AS_OF_KEY, status=EnrollmentStatusInterval.status)
+ENROLLMENT_ROWS_AS_OF = RowShape(*[ENROLLMENT_FIELDS_AS_OF.get(column.key, column)
+                                   for column in ENROLLMENT_ROWS.columns])
+USER_ROWS = RowShape(
+    User.id, User.username, User.email, User.first_name, User.last_name,
+    User.role, User.is_active, User.created_at, User.last_login
+)
+
 def create_app(test_config=None):
     # Create and configure the app
     app = Flask(__name__, instance_relative_config=True)
+    # orjson-backed jsonify when orjson is installed
+    app.json = JSONProvider(app)
     # Explicitly configure CORS to allow DELETE methods
-    CORS(app, resources={r"/api/*": {"origins": "*", "methods": ["GET", "POST", "DELETE", "PATCH"]}})
+    CORS(app, resources={r"/api/*": {"origins": "*", "methods": ["GET", "POST", "DELETE", "PATCH"]}},
+         expose_headers=["Retry-After", "Idempotent-Replayed"])
     
     if test_config is None:
         app.config.from_mapping(
             SECRET_KEY='dev',
-            SQLALCHEMY_DATABASE_URI='sqlite:///health_system.db',
+            SQLALCHEMY_DATABASE_URI=os.environ.get('DATABASE_URL', database.DEFAULT_DATABASE_URI),
             SQLALCHEMY_TRACK_MODIFICATIONS=False,
         )
+        # FLASK_-prefixed environment variables override settings,
+        # e.g. FLASK_DB_POOL_SIZE=20 or FLASK_SQLITE_PRAGMAS='{"synchronous": "FULL"}'
+        app.config.from_prefixed_env()
     else:
         app.config.from_mapping(test_config)
     
@@ -24,12 +80,128 @@ def create_app(test_config=None):
     except OSError:
         pass
     
-    db.init_app(app)
+    # Engine options (pooling) and SQLite pragmas (WAL, busy_timeout, ...)
+    database.init_app(app, db)
     
     with app.app_context():
         db.create_all()
+        if app.config.get('AUTO_MIGRATE', True):
+            # Bring older database files up to date (new columns and indexes)
+            try:
+                for message in migrations.upgrade(db.engine):
+                    app.logger.info(message)
+            except migrations.MigrationError as exc:
+                app.logger.warning('Schema upgrade incomplete: %s', exc)
+        # Until the unique index exists, enrollment writes fall back to a pre-check
+        app.extensions['active_enrollment_index'] = migrations.has_index(
+            db.engine, 'enrollment', migrations.ACTIVE_ENROLLMENT_INDEX)
+        if not app.extensions['active_enrollment_index']:
+            app.logger.warning('%s is missing; run `flask --app app upgrade-db --dedupe` to build it',
+                               migrations.ACTIVE_ENROLLMENT_INDEX)
+    
+    search.init_app(app)
+    stats.init_app(app)
+    rollups.init_app(app)
+    analytics.init_app(app)
+    jobs.init_app(app)
+    linkage.init_app(app)
+    sync.init_app(app)
+    cohorts.init_app(app)
+    history.init_app(app)
+    cache.init_app(app)
+    idempotency.init_app(app)
+    instrumentation.init_app(app, db)
+    # After instrumentation, so rejected requests are still counted
+    admission.init_app(app)
+    register_commands(app)
+
+    @app.errorhandler(PaginationError)
+    @app.errorhandler(search.SearchError)
+    @app.errorhandler(analytics.AnalyticsError)
+    @app.errorhandler(sync.SyncError)
+    @app.errorhandler(cohorts.CohortError)
+    @app.errorhandler(history.HistoryError)
+    def handle_query_error(error):
+        return jsonify({'error': str(error)}), 400
+
+    @app.errorhandler(sync.TokenExpired)
+    def handle_expired_token(error):
+        return jsonify({'error': str(error)}), 410
+
+    def job_accepted(job):
+        """202 response pointing at a queued background job"""
+        response = jsonify({'job': job.to_dict()})
+        response.status_code = 202
+        response.headers['Location'] = f'/api/jobs/{job.id}'
+        return response
+
+    @app.route('/api/stats', methods=['GET'])
+    def get_stats():
+        """Get dashboard statistics"""
+        days = request.args.get('days', stats.DEFAULT_DAYS, type=int)
+        return jsonify(stats.get_stats(days))
+
+    @app.route('/api/analytics/<metric>', methods=['GET'])
+    @admission.limit(EXPENSIVE)
+    def get_analytics(metric):
+        """Get incidence, prevalence, transitions or strata per program"""
+        if metric not in analytics.METRICS:
+            return jsonify({'error': f'Unknown metric, expected one of {", ".join(analytics.METRICS)}'}), 404
+        window = analytics.parse_window(request.args)
+        result, job = analytics.get_result(metric, window)
+        if result is None:
+            # Being computed in the background; poll the job or retry shortly
+            response = job_accepted(job)
+            response.headers['Retry-After'] = '2'
+            return response
+        return jsonify(result)
+
+    @app.route('/api/analytics/refresh', methods=['POST'])
+    def refresh_analytics():
+        """Queue a refresh of every analytics metric for a window"""
+        window = analytics.parse_window(request.args)
+        return job_accepted(analytics.submit_refresh(analytics.METRICS, window))
+
+    @app.route('/api/cohorts', methods=['POST'])
+    @admission.limit(EXPENSIVE)
+    def count_cohort():
+        """Count the clients matching a cohort definition"""
+        data = request.get_json(silent=True) or {}
+        engine = cohorts.parse_engine(data.get('engine'))
+        tree = cohorts.parse(data.get('where'))
+        return jsonify({'count': cohorts.count(tree, engine), 'engine': engine})
+
+    @app.route('/api/cohorts/members', methods=['POST'])
+    @admission.limit(EXPENSIVE)
+    def cohort_members():
+        """Stream the ids of the clients matching a cohort as NDJSON or CSV"""
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in export.STREAM_FORMATS:
+            return jsonify({'error': f'format must be one of: {", ".join(export.STREAM_FORMATS)}'}), 400
+        
+        data = request.get_json(silent=True) or {}
+        engine = cohorts.parse_engine(data.get('engine'))
+        tree = cohorts.parse(data.get('where'))
+        total, batches = cohorts.members(tree, engine)
+        formatter = export.iter_ndjson if fmt == 'ndjson' else export.iter_csv
+        response = Response(stream_with_context(formatter(['id'], batches)), mimetype=export.MIMETYPES[fmt])
+        if total is not None:
+            response.headers['X-Cohort-Count'] = str(total)
+        return response
+
+    @app.route('/api/cohorts/matrix', methods=['GET'])
+    @admission.limit(EXPENSIVE)
+    def co_enrollment_matrix():
+        """Clients enrolled in each pair of programs"""
+        statuses = cohorts.parse_statuses(request.args.getlist('status') or None)
+        engine = cohorts.parse_engine(request.args.get('engine'))
+        return jsonify(cohorts.co_enrollment(statuses, engine))
 
     # Health Program Endpoints
+    def serialize_programs(programs):
+        counts = stats.active_client_counts([program.id for program in programs])
+        return [program.to_dict(client_count=counts[program.id]) for program in programs]
+
     @app.route('/api/programs', methods=['POST'])
     def create_program():
         """Create a new health program"""
@@ -53,12 +225,17 @@ def create_app(test_config=None):
         return jsonify({'message': 'Program created successfully', 'program': program.to_dict()}), 201
 
     @app.route('/api/programs', methods=['GET'])
+    @admission.limit(EXPENSIVE)
+    @cache.cached(lambda: ['programs'])
     def get_programs():
-        """Get all health programs"""
-        programs = HealthProgram.query.all()
-        return jsonify([program.to_dict() for program in programs])
+        """Get a page of health programs"""
+        page = paginate(HealthProgram.query, HealthProgram.id,
+                        lambda program: program.to_dict(), PROGRAM_FIELDS,
+                        serialize_page=serialize_programs)
+        return jsonify(page)
 
     @app.route('/api/programs/<int:id>', methods=['GET'])
+    @cache.cached(lambda id: [f'program:{id}'])
     def get_program(id):
         """Get a specific health program by ID"""
         program = HealthProgram.query.get(id)
@@ -71,16 +248,18 @@ def create_app(test_config=None):
 
     @app.route('/api/programs/<int:id>', methods=['DELETE'])
     def delete_program(id):
-        """Delete a health program by ID"""
-        program = HealthProgram.query.get(id)
-        
-        if not program:
+        """Delete (or with ?archive=1, archive) a health program and its enrollments"""
+        if db.session.get(HealthProgram, id) is None:
             return jsonify({'error': 'Program not found'}), 404
 
-        db.session.delete(program)
-        db.session.commit()
+        archive = deletes.archive_requested(request.args, app.config)
+        counts = deletes.remove(program_ids=[id], archive=archive)
 
-        return jsonify({'message': 'Program deleted successfully'}), 200
+        return jsonify({
+            'message': f'Program {"archived" if archive else "deleted"} successfully',
+            'archived': archive,
+            'removed': counts
+        }), 200
 
     @app.route('/api/programs/<int:id>', methods=['PATCH'])
     def update_program(id):
@@ -103,21 +282,29 @@ def create_app(test_config=None):
 
     # Client Endpoints
     @app.route('/api/clients/<int:client_id>', methods=['GET'])
+    @cache.cached(lambda client_id: [f'client:{client_id}', 'clients'])
     def get_client(client_id):
         """Get a client's profile by ID"""
-        client = Client.query.get_or_404(client_id)
-        
-        # Get the client's enrolled programs
-        enrollments = Enrollment.query.filter_by(client_id=client_id).all()
+        # Enrollments and their programs arrive in one extra query however
+        # many programs the client is enrolled in
+        client = Client.query.options(
+            selectinload(Client.enrollments).joinedload(Enrollment.program)
+        ).filter_by(id=client_id).first_or_404()
+        programs = [
+            enrollment.program
+            for enrollment in sorted(client.enrollments, key=lambda e: (e.program_id, e.id))
+            if enrollment.program is not None
+        ]
+        counts = stats.active_client_counts(sorted({program.id for program in programs}))
         
         # Create a dictionary with client data and their programs
         client_data = client.to_dict()
         client_data['programs'] = []
         
-        for enrollment in enrollments:
-            program = HealthProgram.query.get(enrollment.program_id)
-            if program:
-                client_data['programs'].append(program.to_dict())
+        for program in programs:
+            client_data['programs'].append(program.to_dict(client_count=counts[program.id]))
+            # Embedded program data (client_count) goes stale with the program
+            cache.add_tags(f'program:{program.id}')
         
         # Add program count to the response
         client_data['program_count'] = len(client_data['programs'])
@@ -127,92 +314,169 @@ def create_app(test_config=None):
 
     @app.route('/api/clients/<int:client_id>', methods=['DELETE'])
     def delete_client(client_id):
-        """Delete a client by ID"""
-        client = Client.query.get_or_404(client_id)
+        """Delete (or with ?archive=1, archive) a client and their enrollments"""
+        db.get_or_404(Client, client_id)
         
-        # Delete associated enrollments first (to avoid foreign key constraints)
-        enrollments = Enrollment.query.filter_by(client_id=client_id).all()
-        for enrollment in enrollments:
-            db.session.delete(enrollment)
+        archive = deletes.archive_requested(request.args, app.config)
+        counts = deletes.remove(client_ids=[client_id], archive=archive)
         
-        db.session.delete(client)
-        db.session.commit()
-        
-        return jsonify({'message': 'Client deleted successfully'}), 200
+        return jsonify({
+            'message': f'Client {"archived" if archive else "deleted"} successfully',
+            'archived': archive,
+            'removed': counts
+        }), 200
 
     @app.route('/api/clients', methods=['GET'])
+    @admission.limit(EXPENSIVE)
     def search_clients():
         """Search for clients with optional filters"""
-        first_name = request.args.get('first_name')
-        last_name = request.args.get('last_name')
-        search_term = request.args.get('search')  # General search parameter
+        include = request.args.get('include', '').split(',')
         
         query = Client.query
-        
-        if search_term:
-            # Search in both first and last name with OR logic
-            query = query.filter(
-                (Client.first_name.ilike(f'%{search_term}%')) | 
-                (Client.last_name.ilike(f'%{search_term}%'))
+        serialize = None
+        shape = CLIENT_ROWS
+        
+        if 'programs' in include:
+            # Load active enrollments and their programs in two batched queries
+            # instead of one request (and one query per enrollment) per client
+            query = query.options(
+                selectinload(Client.enrollments.and_(Enrollment.status == 'active'))
+                .joinedload(Enrollment.program)
             )
-        else:
-            # Keep original specific field search
-            if first_name:
-                query = query.filter(Client.first_name.ilike(f'%{first_name}%'))
-            if last_name:
-                query = query.filter(Client.last_name.ilike(f'%{last_name}%'))
+            serialize = lambda client: client.to_dict_summary()
+            shape = None
         
-        clients = query.all()
-        return jsonify([client.to_dict_basic() for client in clients])
+        # search/first_name/last_name filters, mode and rank are handled by search
+        return jsonify(search.search_page(query, serialize, CLIENT_FIELDS, shape=shape))
 
-    @app.route('/api/clients', methods=['POST'])
-    def register_client():
-        """Register a new client"""
-        data = request.get_json()
+    def client_values(data):
+        """Validated column values for a client from a JSON body, or an error response"""
+        if not data:
+            return None, (jsonify({'error': 'Request body must be a JSON object'}), 400)
         
         required_fields = ['first_name', 'last_name', 'date_of_birth', 'gender']
         for field in required_fields:
             if field not in data:
-                return jsonify({'error': f'{field} is required'}), 400
+                return None, (jsonify({'error': f'{field} is required'}), 400)
+        # Names feed the search and linkage keys, which need text
+        for field in ('first_name', 'last_name'):
+            if not isinstance(data[field], str) or not data[field].strip():
+                return None, (jsonify({'error': f'{field} must be a non-empty string'}), 400)
         
         try:
             date_of_birth = datetime.strptime(data['date_of_birth'], '%Y-%m-%d').date()
-        except ValueError:
-            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
-        
-        client = Client(
-            first_name=data['first_name'],
-            last_name=data['last_name'],
-            date_of_birth=date_of_birth,
-            gender=data['gender'],
-            contact_number=data.get('contact_number'),
-            email=data.get('email'),
-            address=data.get('address'),
-            registered_by=None  # No current_user
-        )
+        except (TypeError, ValueError):
+            return None, (jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400)
+        
+        return {
+            'first_name': data['first_name'],
+            'last_name': data['last_name'],
+            'date_of_birth': date_of_birth,
+            'gender': data['gender'],
+            'contact_number': data.get('contact_number'),
+            'email': data.get('email'),
+            'address': data.get('address')
+        }, None
+
+    @app.route('/api/clients', methods=['POST'])
+    @idempotency.idempotent
+    def register_client():
+        """Register a new client"""
+        data = request.get_json()
+        values, error = client_values(data)
+        if error:
+            return error
+        
+        # Field clinics re-register the same people; look for them first
+        matches = []
+        mode = linkage.settings()['on_register']
+        if mode != 'off':
+            matches = linkage.find_matches(values)
+            if mode == 'reject' and not data.get('confirm_new') and linkage.is_likely_duplicate(matches):
+                best = matches[0]['client']
+                return jsonify({
+                    'error': f'Client appears to be already registered as #{best["id"]} '
+                             f'{best["first_name"]} {best["last_name"]}; '
+                             'resend with "confirm_new": true to register anyway',
+                    'matches': matches
+                }), 409
+        
+        client = Client(**values, registered_by=None)  # No current_user
         
         db.session.add(client)
         db.session.commit()
         
         return jsonify({
             'message': 'Client registered successfully', 
-            'client': client.to_dict_basic()
+            'client': client.to_dict_basic(),
+            'possible_duplicates': matches
         }), 201
 
+    @app.route('/api/clients/matches', methods=['POST'])
+    def match_client():
+        """Find registered clients likely to be the person described, without registering"""
+        values, error = client_values(request.get_json())
+        if error:
+            return error
+        return jsonify({'matches': linkage.find_matches(values)})
+
+    @app.route('/api/clients/<int:client_id>/matches', methods=['GET'])
+    def get_client_matches(client_id):
+        """Find other clients likely to be the same person as this one"""
+        client = db.get_or_404(Client, client_id)
+        values = {column: getattr(client, column)
+                  for column in ('first_name', 'last_name', 'date_of_birth', 'gender', 'contact_number')}
+        return jsonify({'matches': linkage.find_matches(values, exclude_id=client.id)})
+
+    @app.route('/api/clients/duplicates', methods=['GET'])
+    @admission.limit(EXPENSIVE)
+    def get_duplicate_clients():
+        """Get a page of likely duplicate pairs found by the last dedupe job"""
+        # Pairs whose clients were deleted since are skipped by the joins
+        first = aliased(Client)
+        second = aliased(Client)
+        query = ClientMatch.query \
+            .join(first, first.id == ClientMatch.client_id) \
+            .join(second, second.id == ClientMatch.match_id)
+        shape = RowShape(
+            ClientMatch.id, ClientMatch.client_id, ClientMatch.match_id, ClientMatch.probability,
+            first.first_name.label('client_first_name'), first.last_name.label('client_last_name'),
+            second.first_name.label('match_first_name'), second.last_name.label('match_last_name'),
+            ClientMatch.found_at
+        )
+        return jsonify(paginate(query, ClientMatch.id, None, {}, shape=shape))
+
+    @app.route('/api/clients/dedupe', methods=['POST'])
+    def dedupe_clients():
+        """Queue a search for likely duplicates across all clients"""
+        return job_accepted(jobs.submit('dedupe-clients', {}, dedupe_key='dedupe-clients'))
+
+    @app.route('/api/clients/bulk', methods=['POST'])
+    @admission.limit(EXPENSIVE)
+    def bulk_register_clients():
+        """Register clients from a streamed NDJSON or CSV body"""
+        try:
+            fmt = bulk.detect_format(request.content_type, request.args.get('format'))
+        except ValueError as exc:
+            return jsonify({'error': str(exc)}), 400
+        
+        if request.args.get('async') in ('1', 'true'):
+            # Spool the body and return at once; the import runs as a job
+            path = jobs.spool(request.stream, f'.{fmt}')
+            return job_accepted(jobs.submit('import', {'kind': 'clients', 'path': path, 'fmt': fmt}))
+        
+        report = bulk.import_clients(bulk.iter_records(request.stream, fmt))
+        return jsonify(report.to_dict())
+
     # Enrollment Endpoints
     @app.route('/api/clients/<int:client_id>/programs/<int:program_id>', methods=['POST'])
+    @idempotency.idempotent
     def enroll_client(client_id, program_id):
         """Enroll a client in a health program"""
         client = Client.query.get_or_404(client_id)
         program = HealthProgram.query.get_or_404(program_id)
         
-        existing_enrollment = Enrollment.query.filter_by(
-            client_id=client_id,
-            program_id=program_id,
-            status='active'
-        ).first()
-        
-        if existing_enrollment:
+        if history.already_active(client_id, program_id):
             return jsonify({'message': 'Client is already actively enrolled in this program'}), 409
         
         data = request.get_json() or {}
@@ -225,8 +489,13 @@ def create_app(test_config=None):
             enrolled_by=None  # No current_user
         )
         
+        # The partial unique index rejects a second active enrollment atomically
         db.session.add(enrollment)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({'message': 'Client is already actively enrolled in this program'}), 409
         
         return jsonify({
             'message': f'Client enrolled in {program.name} successfully',
@@ -234,6 +503,7 @@ def create_app(test_config=None):
         })
     
     @app.route('/api/enrollments', methods=['POST'])
+    @idempotency.idempotent
     def create_enrollment():
         """Enroll a client in a program"""
         data = request.get_json()
@@ -244,14 +514,7 @@ def create_app(test_config=None):
         if not client_id or not program_id:
             return jsonify({'error': 'Client ID and Program ID are required'}), 400
         
-        # Check if this enrollment already exists
-        existing_enrollment = Enrollment.query.filter_by(
-            client_id=client_id,
-            program_id=program_id,
-            status='active'
-        ).first()
-        
-        if existing_enrollment:
+        if history.already_active(client_id, program_id):
             return jsonify({'error': 'Client is already enrolled in this program'}), 409
         
         # Create new enrollment
@@ -261,11 +524,133 @@ def create_app(test_config=None):
             enrolled_by=None  # No current_user
         )
         
+        # The partial unique index rejects a second active enrollment atomically
         db.session.add(new_enrollment)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if Enrollment.query.filter_by(client_id=client_id, program_id=program_id,
+                                          status='active').first():
+                return jsonify({'error': 'Client is already enrolled in this program'}), 409
+            return jsonify({'error': 'Client or program not found'}), 404
         
         return jsonify({'message': 'Client enrolled successfully', 'enrollment': new_enrollment.to_dict()}), 201
 
+    @app.route('/api/enrollments/bulk', methods=['POST'])
+    @admission.limit(EXPENSIVE)
+    def bulk_create_enrollments():
+        """Enroll clients from a streamed NDJSON or CSV body"""
+        try:
+            fmt = bulk.detect_format(request.content_type, request.args.get('format'))
+        except ValueError as exc:
+            return jsonify({'error': str(exc)}), 400
+        
+        if request.args.get('async') in ('1', 'true'):
+            # Spool the body and return at once; the import runs as a job
+            path = jobs.spool(request.stream, f'.{fmt}')
+            return job_accepted(jobs.submit('import', {'kind': 'enrollments', 'path': path, 'fmt': fmt}))
+        
+        report = bulk.import_enrollments(bulk.iter_records(request.stream, fmt))
+        return jsonify(report.to_dict())
+
+    # Export Endpoints
+    @app.route('/api/export/<kind>', methods=['GET'])
+    @admission.limit(EXPENSIVE)
+    def export_records(kind):
+        """Stream a clients or enrollments line list as NDJSON or CSV"""
+        if kind not in export.KINDS:
+            return jsonify({'error': 'Unknown export'}), 404
+        
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in export.STREAM_FORMATS:
+            return jsonify({'error': f'format must be one of: {", ".join(export.STREAM_FORMATS)}'}), 400
+        
+        try:
+            since = export.parse_since(request.args.get('since'))
+        except ValueError:
+            return jsonify({'error': 'Invalid since. Use the X-Export-Watermark of an earlier export'}), 400
+        
+        # Rows written after this belong to the next incremental export
+        watermark = export.current_watermark()
+        response = Response(stream_with_context(export.stream(kind, fmt, since, watermark)),
+                            mimetype=export.MIMETYPES[fmt])
+        response.headers['Content-Disposition'] = f'attachment; filename={kind}.{fmt}'
+        response.headers['X-Export-Watermark'] = str(watermark)
+        return response
+
+    @app.route('/api/export/<kind>', methods=['POST'])
+    def queue_export(kind):
+        """Write an export file in the background, including Parquet"""
+        if kind not in export.KINDS:
+            return jsonify({'error': 'Unknown export'}), 404
+        
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in export.FILE_FORMATS:
+            return jsonify({'error': f'format must be one of: {", ".join(export.FILE_FORMATS)}'}), 400
+        
+        since = request.args.get('since')
+        try:
+            export.parse_since(since)
+        except ValueError:
+            return jsonify({'error': 'Invalid since. Use the watermark of an earlier export'}), 400
+        
+        return job_accepted(jobs.submit('export', {'kind': kind, 'fmt': fmt, 'since': since}))
+
+    # Job Endpoints
+    @app.route('/api/jobs', methods=['GET'])
+    def get_jobs():
+        """Get the most recent background jobs"""
+        query = Job.query.order_by(Job.created_at.desc())
+        status = request.args.get('status')
+        if status:
+            query = query.filter(Job.status == status)
+        limit = parse_limit(request.args.get('limit'))
+        return jsonify({'items': [job.to_dict() for job in query.limit(limit)]})
+
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    def get_job(job_id):
+        """Get a background job's status and progress"""
+        job = db.get_or_404(Job, job_id)
+        return jsonify(job.to_dict())
+
+    @app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+    def cancel_job(job_id):
+        """Cancel a queued job or ask a running one to stop"""
+        job = db.get_or_404(Job, job_id)
+        if job.status in jobs.FINISHED_STATUSES:
+            return jsonify({'error': f'Job already {job.status}'}), 409
+        return jsonify(jobs.cancel(job).to_dict()), 202
+
+    @app.route('/api/jobs/<job_id>/result', methods=['GET'])
+    def get_job_result(job_id):
+        """Download the file produced by a finished export job"""
+        job = db.get_or_404(Job, job_id)
+        result = job.to_dict()['result'] or {}
+        if job.status != 'succeeded' or 'file' not in result:
+            return jsonify({'error': 'Job has no file to download'}), 404
+        params = json.loads(job.params)
+        return send_file(jobs.job_path(job.id, f'.{result["format"]}'), as_attachment=True,
+                         download_name=f'{params["kind"]}.{result["format"]}')
+
+    # Sync Endpoints
+    @app.route('/api/sync', methods=['GET'])
+    @admission.limit(EXPENSIVE)
+    def get_sync():
+        """Get clients, programs and enrollments changed or deleted since a sync token"""
+        since = sync.parse_token(request.args.get('since'))
+        limit = sync.parse_limit(request.args.get('limit'))
+        return sync.compress(jsonify(sync.changes(since, limit)))
+
+    @app.route('/api/sync', methods=['POST'])
+    @admission.limit(EXPENSIVE)
+    def upload_sync():
+        """Upload clients and enrollments created on an offline device"""
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Request body must be a JSON object'}), 400
+        return jsonify(sync.upload(data.get('device_id'), data))
+
     @app.route('/api/users', methods=['POST'])
     def create_user():
         """Create a new user"""
@@ -294,10 +679,11 @@ def create_app(test_config=None):
         return jsonify({'message': 'User created successfully', 'user': user.to_dict()}), 201
 
     @app.route('/api/users', methods=['GET'])
+    @admission.limit(EXPENSIVE)
     def get_users():
-        """Get all users"""
-        users = User.query.all()
-        return jsonify([user.to_dict() for user in users])
+        """Get a page of users"""
+        page = paginate(User.query, User.id, None, USER_FIELDS, shape=USER_ROWS)
+        return jsonify(page)
 
     @app.route('/api/users/<int:user_id>', methods=['GET'])
     def get_user(user_id):
@@ -310,22 +696,79 @@ def create_app(test_config=None):
         """Delete a user"""
         user = User.query.get_or_404(user_id)
         db.session.delete(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Older databases lack ON DELETE SET NULL on the references
+            db.session.rollback()
+            return jsonify({'error': 'User is still referenced by clients, programs or enrollments'}), 409
         return jsonify({'message': 'User deleted successfully'})
 
     # --- Enrollment Management Endpoints ---
     @app.route('/api/enrollments', methods=['GET'])
+    @admission.limit(EXPENSIVE)
     def get_enrollments():
-        """Get all enrollments"""
-        enrollments = Enrollment.query.all()
-        return jsonify([enrollment.to_dict() for enrollment in enrollments])
+        """Get a page of enrollments, or with ?as_of=YYYY-MM-DD those that existed at the end of that day"""
+        query = Enrollment.query.join(HealthProgram, HealthProgram.id == Enrollment.program_id)
+        key, shape, fields, row = Enrollment.id, ENROLLMENT_ROWS, ENROLLMENT_FIELDS, Enrollment
+        if request.args.get('as_of'):
+            # Filtered and shown with the status held then
+            day = history.parse_day(request.args['as_of'])
+            query = query.join(EnrollmentStatusInterval, and_(
+                EnrollmentStatusInterval.enrollment_id == Enrollment.id, *history.covering(day)
+            ))
+            key, shape, fields, row = (ENROLLMENT_AS_OF_KEY, ENROLLMENT_ROWS_AS_OF, ENROLLMENT_FIELDS_AS_OF,
+                                       EnrollmentStatusInterval)
+        program_id = request.args.get('program_id', type=int)
+        if program_id is not None:
+            query = query.filter(row.program_id == program_id)
+        if request.args.get('status'):
+            query = query.filter(row.status == request.args['status'])
+        page = paginate(query, key, None, fields, shape=shape)
+        return jsonify(page)
+
+    @app.route('/api/enrollments/counts', methods=['GET'])
+    @admission.limit(EXPENSIVE)
+    def get_enrollment_counts():
+        """Enrollments per program and status at the end of ?as_of=YYYY-MM-DD (default today)"""
+        as_of = request.args.get('as_of')
+        day = history.parse_day(as_of) if as_of else datetime.utcnow().date()
+        return jsonify(history.status_counts(day, request.args.get('program_id', type=int)))
 
     @app.route('/api/enrollments/<int:enrollment_id>', methods=['GET'])
     def get_enrollment(enrollment_id):
         """Get a specific enrollment by ID"""
-        enrollment = Enrollment.query.get_or_404(enrollment_id)
+        enrollment = Enrollment.query.options(joinedload(Enrollment.program)) \
+            .filter_by(id=enrollment_id).first_or_404()
         return jsonify(enrollment.to_dict())
 
+    @app.route('/api/enrollments/<int:enrollment_id>', methods=['PATCH'])
+    def update_enrollment(enrollment_id):
+        """Change an enrollment's status (optionally back-dated with effective_at) or notes"""
+        enrollment = db.get_or_404(Enrollment, enrollment_id)
+        data = request.get_json() or {}
+        
+        if data.get('status') == 'active' and history.already_active(
+                enrollment.client_id, enrollment.program_id, exclude_id=enrollment.id):
+            return jsonify({'error': 'Client already has an active enrollment in this program'}), 409
+        if 'notes' in data:
+            enrollment.notes = data['notes']
+        if 'status' in data:
+            history.set_status(enrollment, data['status'], data.get('effective_at'))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({'error': 'Client already has an active enrollment in this program'}), 409
+        
+        return jsonify({'message': 'Enrollment updated successfully', 'enrollment': enrollment.to_dict()}), 200
+
+    @app.route('/api/enrollments/<int:enrollment_id>/history', methods=['GET'])
+    def get_enrollment_history(enrollment_id):
+        """Status events and the spans they form for an enrollment"""
+        db.get_or_404(Enrollment, enrollment_id)
+        return jsonify(history.enrollment_history(enrollment_id))
+
     @app.route('/api/enrollments/<int:enrollment_id>', methods=['DELETE'])
     def delete_enrollment(enrollment_id):
         """Delete an enrollment"""
@@ -0,0 +1,198 @@
+"""
+ASGI entry point for the async serving mode:
+
+    gunicorn -c gunicorn.conf.py asgi:app    # with SERVER_MODE=async
+    uvicorn asgi:app --workers 4
+
+Uvicorn keeps every connection on one event loop per worker, so slow or idle
+clients cost a socket rather than a thread. Requests for the read-heavy
+endpoints in ASYNC_ENDPOINTS (client search and profiles, programs, stats)
+run on that loop with async database access: the Flask view runs unchanged
+inside AsyncSession.run_sync(), with db.session bound to the async session,
+so each statement awaits the driver (aiosqlite, asyncpg) instead of blocking
+a thread. Only the Python work of a request holds the loop.
+
+Every other route (writes, uploads, streamed exports, jobs) is handed to the
+WSGI app on a thread pool of ASGI_WSGI_THREADS, exactly as under gunicorn's
+sync workers.
+
+The async engine follows DATABASE_URL with the async driver swapped in
+(ASYNC_DRIVERS), or ASYNC_DATABASE_URL when set, and gets the same pool
+settings and SQLite pragmas as the sync engine.
+"""
+import asyncio
+import io
+import sys
+from a2wsgi import WSGIMiddleware
+from flask import request
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from models import db
+from app import create_app
+import admission
+import database
+import instrumentation
+
+DEFAULT_ASYNC_ENDPOINTS = ('search_clients', 'get_client', 'get_programs', 'get_program', 'get_stats')
+DEFAULT_WSGI_THREADS = 10
+
+# Sync driver -> async driver of the same database
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+# WSGI environ key carrying the run_sync session of an async request
+SESSION_KEY = 'health.async_session'
+
+
+def async_database_url(app):
+    """The configured ASYNC_DATABASE_URL, or the app's database with its async driver"""
+    url = app.config.get('ASYNC_DATABASE_URL')
+    if url:
+        return database.normalize_database_url(url)
+    with app.app_context():
+        # The engine's URL, as Flask-SQLAlchemy resolved it (instance-relative SQLite paths)
+        url = db.engine.url
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f'No async driver for {backend}; set ASYNC_DATABASE_URL')
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def _bind_session():
+    """Route db.session (and Model.query) to the async request's session for this app context"""
+    session = request.environ.get(SESSION_KEY)
+    if session is not None:
+        db.session.registry.set(session)
+
+
+def _environ(scope, body):
+    """A WSGI environ for an ASGI HTTP scope (PEP 3333)"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope["http_version"]}',
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+            continue
+        key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def _read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body.extend(message.get('body', b''))
+        if not message.get('more_body', False):
+            return bytes(body)
+
+
+class AsyncApp:
+    """ASGI application serving ASYNC_ENDPOINTS on the event loop and the rest through WSGI"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.endpoints = frozenset(flask_app.config.get('ASYNC_ENDPOINTS', DEFAULT_ASYNC_ENDPOINTS))
+        self.engine = create_async_engine(async_database_url(flask_app),
+                                          **flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        database.apply_sqlite_pragmas(self.engine.sync_engine, database.sqlite_pragmas(flask_app.config))
+        if 'instrumentation' in flask_app.extensions:
+            instrumentation.instrument_engine(self.engine.sync_engine)
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        # Requests beyond this wait their turn in arrival order rather than all
+        # interleaving on the loop, so the ones already started finish first
+        options = flask_app.config['SQLALCHEMY_ENGINE_OPTIONS']
+        self.max_concurrent = flask_app.config.get(
+            'ASYNC_MAX_CONCURRENT', options.get('pool_size', 5) + options.get('max_overflow', 10))
+        self.slots = None
+        self.wsgi = WSGIMiddleware(flask_app, workers=flask_app.config.get('ASGI_WSGI_THREADS',
+                                                                            DEFAULT_WSGI_THREADS))
+        # First, so every other hook already sees the async session
+        flask_app.before_request_funcs.setdefault(None, []).insert(0, _bind_session)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            environ = _environ(scope, b'')
+            if self._endpoint(environ) in self.endpoints:
+                environ['wsgi.input'] = io.BytesIO(await _read_body(receive))
+                return await self._serve_async(environ, send)
+        return await self.wsgi(scope, receive, send)
+
+    def _endpoint(self, environ):
+        adapter = self.flask_app.url_map.bind_to_environ(environ)
+        try:
+            endpoint, _ = adapter.match()
+        except Exception:
+            # 404, 405 and redirects are left to Flask
+            return None
+        return endpoint
+
+    async def _serve_async(self, environ, send):
+        # Waiting for a slot would stall the loop; a busy expensive route gets 503 at once
+        environ[admission.NONBLOCKING_KEY] = True
+        if self.slots is None:
+            # Created on first use so it belongs to the worker's running loop
+            self.slots = asyncio.Semaphore(self.max_concurrent)
+        async with self.slots, self.sessions() as session:
+            status, headers, body = await session.run_sync(self._call_flask, environ)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers],
+        })
+        await send({'type': 'http.response.body',
+                    'body': b'' if environ['REQUEST_METHOD'] == 'HEAD' else body})
+
+    def _call_flask(self, session, environ):
+        """Run the WSGI app to completion with `session` (run_sync's sync view) as db.session"""
+        environ[SESSION_KEY] = session
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'], started['headers'] = status, headers
+
+        result = self.flask_app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return started['status'], started['headers'], body
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_asgi_app(test_config=None):
+    return AsyncApp(create_app(test_config))
+
+
+app = create_asgi_app()
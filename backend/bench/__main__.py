@@ -0,0 +1,110 @@
+"""
+Benchmark runner, from the backend/ directory:
+
+    python -m bench generate --clients 10k --db bench.db
+    python -m bench run --db bench.db --out results.json
+    python -m bench run --db bench.db --check bench/baseline.json
+    python -m bench run --db bench.db --update-baseline bench/baseline.json
+    python -m bench load --db bench.db --connections 1000
+"""
+import argparse
+import json
+import os
+import sys
+from app import create_app
+from bench import generate, endpoints, load
+
+
+def _app(db_path, cache=False):
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.abspath(db_path)}',
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'TESTING': True,
+        # Measure the endpoints themselves unless the cache is asked for
+        'RESPONSE_CACHE_ENABLED': cache,
+        # Every bench request comes from one address
+        'ADMISSION_ENABLED': False,
+    })
+
+
+def _client_count(value):
+    return generate.PRESETS.get(value.lower()) or int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='Create a synthetic population')
+    gen.add_argument('--db', default='bench.db', help='SQLite file to create or extend')
+    gen.add_argument('--clients', type=_client_count, default='10k',
+                     help='Number of clients or a preset: 10k, 1m, 10m')
+    gen.add_argument('--programs', type=int, default=len(generate.PROGRAMS))
+    gen.add_argument('--chunk-size', type=int, default=50_000)
+    gen.add_argument('--seed', type=int, default=42)
+
+    run = commands.add_parser('run', help='Benchmark endpoints against a database')
+    run.add_argument('--db', default='bench.db')
+    run.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+    run.add_argument('--only', nargs='*', help='Endpoint names to run')
+    run.add_argument('--cache', action='store_true', help='Enable the response cache')
+    run.add_argument('--out', help='Write results JSON here')
+    run.add_argument('--check', metavar='BASELINE', help='Fail on regressions against this baseline')
+    run.add_argument('--tolerance', type=float, default=0.5,
+                     help='Allowed p95 slowdown as a fraction (default 0.5)')
+    run.add_argument('--update-baseline', metavar='BASELINE', help='Store the results as the baseline')
+
+    concurrency = commands.add_parser('load', help='Compare the sync and async serving modes under load')
+    concurrency.add_argument('--db', default='bench.db')
+    concurrency.add_argument('--mode', choices=load.MODES, nargs='*', default=list(load.MODES))
+    concurrency.add_argument('--connections', type=int, default=1000)
+    concurrency.add_argument('--duration', type=float, default=20, help='Seconds per mode')
+    concurrency.add_argument('--workers', type=int, default=2)
+    concurrency.add_argument('--threads', type=int, default=8, help='Threads per sync worker')
+    concurrency.add_argument('--slow-clients', type=int, default=0,
+                             help='Extra connections that trickle their requests in')
+    concurrency.add_argument('--out', help='Write results JSON here')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        app = _app(args.db)
+        with app.app_context():
+            clients, enrollments = generate.generate(args.clients, args.programs,
+                                                     args.chunk_size, args.seed)
+        print(f'Generated {clients:,} clients and {enrollments:,} enrollments in {args.db}')
+        return 0
+
+    if not os.path.exists(args.db):
+        parser.error(f'{args.db} does not exist; run `python -m bench generate` first')
+    if args.command == 'load':
+        results = load.run(_app(args.db), args.db, args.mode, args.connections, args.duration,
+                           args.workers, args.threads, args.slow_clients)
+        if args.out:
+            with open(args.out, 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+        return 0
+
+    results = endpoints.run(_app(args.db, args.cache), args.requests, only=args.only)
+    if args.out:
+        with open(args.out, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.update_baseline:
+        with open(args.update_baseline, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+            output.write('\n')
+        print(f'Baseline written to {args.update_baseline}')
+    if args.check:
+        with open(args.check) as baseline:
+            problems = endpoints.compare(results, json.load(baseline), args.tolerance)
+        for problem in problems:
+            print(f'REGRESSION {problem}')
+        if problems:
+            return 1
+        print('No regressions against baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
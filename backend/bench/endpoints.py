@@ -0,0 +1,141 @@
+"""
+Per-endpoint latency, throughput and query-count measurements.
+
+Requests go through the Flask test client against create_app(test_config),
+so the numbers cover routing, ORM work and serialization but not the network
+or the WSGI server. Each request's SQL statements are counted with a
+before_cursor_execute listener.
+"""
+import time
+import numpy as np
+from sqlalchemy import event, func
+from models import db, Client, Enrollment
+
+
+class QueryCounter:
+    """Count statements executed on an engine between reset() calls"""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+    def reset(self):
+        count, self.count = self.count, 0
+        return count
+
+
+def _context():
+    """Facts about the dataset the request generators need"""
+    client_count = db.session.query(func.max(Client.id)).scalar() or 0
+    enrollment_count = db.session.query(func.max(Enrollment.id)).scalar() or 0
+    # The most-enrolled client shows whether get_client's cost grows with enrollments
+    busiest = db.session.query(Enrollment.client_id).group_by(Enrollment.client_id).order_by(
+        func.count(Enrollment.id).desc()
+    ).limit(1).scalar()
+    single = db.session.query(Enrollment.client_id).group_by(Enrollment.client_id).having(
+        func.count(Enrollment.id) == 1
+    ).limit(1).scalar()
+    last_names = [name for (name,) in db.session.query(Client.last_name_norm).limit(200)]
+    return {'max_client_id': client_count, 'busiest_client_id': busiest or 1,
+            'single_client_id': single or 1, 'max_enrollment_id': enrollment_count,
+            'last_names': last_names}
+
+
+def _requests(ctx):
+    """Endpoint name -> function(rng) returning a URL"""
+    prefixes = [name[:3] for name in ctx['last_names'] if name] or ['a']
+    return {
+        'get_client': lambda rng: f'/api/clients/{ctx["single_client_id"]}',
+        'get_random_client': lambda rng: f'/api/clients/{rng.integers(1, ctx["max_client_id"] + 1)}',
+        'get_client_most_enrolled': lambda rng: f'/api/clients/{ctx["busiest_client_id"]}',
+        'search_clients': lambda rng: f'/api/clients?search={prefixes[rng.integers(len(prefixes))]}',
+        'search_clients_fts': lambda rng: f'/api/clients?mode=fts&search={prefixes[rng.integers(len(prefixes))]}',
+        'list_clients_with_programs': lambda rng: '/api/clients?include=programs',
+        'get_programs': lambda rng: '/api/programs',
+        'get_enrollments': lambda rng: '/api/enrollments',
+        'get_enrollment': lambda rng: f'/api/enrollments/{rng.integers(1, ctx["max_enrollment_id"] + 1)}',
+        'get_stats': lambda rng: '/api/stats',
+    }
+
+
+def run(app, requests=200, warmup=10, only=None, seed=0, log=print):
+    """Benchmark every endpoint; returns {endpoint: metrics}"""
+    rng = np.random.default_rng(seed)
+    client = app.test_client()
+    with app.app_context():
+        ctx = _context()
+        counter = QueryCounter(db.engine)
+
+    results = {}
+    for name, make_url in _requests(ctx).items():
+        if only and name not in only:
+            continue
+        for _ in range(warmup):
+            client.get(make_url(rng))
+        latencies, queries = [], []
+        started = time.perf_counter()
+        for _ in range(requests):
+            url = make_url(rng)
+            counter.reset()
+            t0 = time.perf_counter()
+            response = client.get(url)
+            latencies.append(time.perf_counter() - t0)
+            queries.append(counter.reset())
+            if response.status_code >= 500:
+                raise RuntimeError(f'{name}: {url} returned {response.status_code}')
+        elapsed = time.perf_counter() - started
+
+        ms = np.array(latencies) * 1000
+        results[name] = {
+            'requests': requests,
+            'mean_ms': round(float(ms.mean()), 3),
+            'p50_ms': round(float(np.percentile(ms, 50)), 3),
+            'p95_ms': round(float(np.percentile(ms, 95)), 3),
+            'p99_ms': round(float(np.percentile(ms, 99)), 3),
+            'rps': round(requests / elapsed, 1),
+            'mean_queries': round(float(np.mean(queries)), 2),
+            'max_queries': int(max(queries)),
+        }
+        log(f'{name:28} p50 {results[name]["p50_ms"]:8.2f} ms  p95 {results[name]["p95_ms"]:8.2f} ms  '
+            f'{results[name]["rps"]:8.1f} req/s  queries <= {results[name]["max_queries"]}')
+    return results
+
+
+# Endpoint pairs that must issue the same number of queries: a client with
+# one enrollment and the client with the most enrollments
+CONSTANT_QUERIES = [('get_client', 'get_client_most_enrolled')]
+
+# Latency differences below this are noise for millisecond endpoints
+MIN_SLACK_MS = 2.0
+
+
+def compare(results, baseline, tolerance=0.5):
+    """
+    Return a list of regressions against a stored baseline. Query counts
+    must not exceed the baseline or grow with the data (CONSTANT_QUERIES);
+    p95 latency may exceed the baseline by `tolerance` (a fraction, and at
+    least MIN_SLACK_MS) before being reported, since timings vary between
+    machines.
+    """
+    problems = []
+    for small, large in CONSTANT_QUERIES:
+        if small in results and large in results and \
+                results[large]['max_queries'] != results[small]['max_queries']:
+            problems.append(f'{large}: {results[large]["max_queries"]} queries per request, '
+                            f'{small}: {results[small]["max_queries"]}; the count should not '
+                            f'depend on the number of enrollments')
+    for name, expected in baseline.items():
+        actual = results.get(name)
+        if actual is None:
+            continue
+        if actual['max_queries'] > expected['max_queries']:
+            problems.append(f'{name}: {actual["max_queries"]} queries per request, '
+                            f'baseline {expected["max_queries"]}')
+        limit = max(expected['p95_ms'] * (1 + tolerance), expected['p95_ms'] + MIN_SLACK_MS)
+        if actual['p95_ms'] > limit:
+            problems.append(f'{name}: p95 {actual["p95_ms"]} ms, baseline {expected["p95_ms"]} ms '
+                            f'(+{tolerance:.0%} allowed)')
+    return problems
@@ -0,0 +1,166 @@
+"""
+Synthetic population generator.
+
+Draws clients and enrollments with NumPy a chunk at a time and inserts each
+chunk with one executemany, so 10M clients fit in bounded memory. The shape
+is meant to be plausible, not realistic: Zipf-distributed names, a
+young-skewed age pyramid, registrations spread over the last few years, and
+a Poisson number of enrollments per client over programs of uneven
+popularity.
+"""
+from datetime import datetime, timedelta
+from itertools import product
+import numpy as np
+from sqlalchemy import insert
+from models import db, Client, HealthProgram, Enrollment, name_search_columns, soundex
+import stats
+import rollups
+import sync
+import history
+
+PRESETS = {'10k': 10_000, '1m': 1_000_000, '10m': 10_000_000}
+
+PROGRAMS = [
+    ('HIV/AIDS Care', 'HIV testing, treatment, and support services'),
+    ('Malaria Prevention', 'Program focused on malaria prevention and early treatment'),
+    ('Maternal Health', 'Prenatal and postnatal care for expectant mothers'),
+    ('Tuberculosis Control', 'Comprehensive TB prevention and treatment program'),
+    ('Child Immunization', 'Routine childhood vaccination schedule'),
+    ('Diabetes Management', 'Monitoring and management services for diabetes patients'),
+    ('Hypertension Screening', 'Blood pressure screening and follow-up'),
+    ('Nutrition Support', 'Supplementary feeding and growth monitoring'),
+]
+
+_FIRST_NAMES = [
+    'John', 'Jane', 'Michael', 'Sarah', 'David', 'Lisa', 'Robert', 'Emily', 'James', 'Maria',
+    'Amina', 'Wanjiru', 'Otieno', 'Achieng', 'Kamau', 'Njeri', 'Mwangi', 'Akinyi', 'Kiprop', 'Chebet',
+    'Fatuma', 'Hassan', 'Grace', 'Peter', 'Mercy', 'Joseph', 'Faith', 'Daniel', 'Esther', 'Samuel',
+]
+_SYLLABLES = ['ka', 'mo', 'ri', 'ne', 'to', 'wa', 'lu', 'chi', 'ba', 'de', 'si', 'yo', 'ma', 'ki', 'na', 'o']
+ENROLLMENT_STATUSES = ['active', 'completed', 'suspended']
+ENROLLMENT_STATUS_WEIGHTS = [0.7, 0.2, 0.1]
+
+
+def _last_names():
+    # A few thousand distinct surnames so prefix search has realistic selectivity
+    names = [''.join(parts).capitalize() for parts in product(_SYLLABLES, repeat=3)]
+    return ['Smith', 'Johnson', 'Garcia', 'Ochieng', 'Wambui', 'Mutua'] + names
+
+
+def _zipf_weights(n, exponent=1.1):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+class _Vocabulary:
+    """Names with their precomputed search columns, gathered by index per chunk"""
+
+    def __init__(self, names):
+        self.names = np.array(names, dtype=object)
+        self.weights = _zipf_weights(len(names))
+        self.norm = np.array([name_search_columns(n, '')['first_name_norm'] for n in names], dtype=object)
+        self.phonetic = np.array([name_search_columns(n, '')['name_phonetic'] for n in names], dtype=object)
+        # First half of the record linkage key (models.link_key)
+        self.link = np.array([soundex(norm.replace(' ', '')) for norm in self.norm], dtype=object)
+
+    def sample(self, rng, size):
+        return rng.choice(len(self.names), size=size, p=self.weights)
+
+
+def _datetimes(base, seconds):
+    return (np.datetime64(base, 'us') + seconds.astype('timedelta64[s]')).tolist()
+
+
+def generate(clients, programs=len(PROGRAMS), chunk_size=50_000, seed=42, years=3, log=print):
+    """Insert `clients` synthetic clients and their enrollments into the app's database"""
+    rng = np.random.default_rng(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    window = int(timedelta(days=365 * years).total_seconds())
+
+    first = _Vocabulary(_FIRST_NAMES)
+    last = _Vocabulary(_last_names())
+
+    program_ids = []
+    for name, description in PROGRAMS[:programs]:
+        program = HealthProgram.query.filter_by(name=name).first()
+        if program is None:
+            program = HealthProgram(name=name, description=description)
+            db.session.add(program)
+            db.session.flush()
+        program_ids.append(program.id)
+    db.session.commit()
+    program_ids = np.array(program_ids)
+    program_weights = _zipf_weights(len(program_ids), exponent=0.8)
+
+    next_id = (db.session.query(db.func.max(Client.id)).scalar() or 0) + 1
+    inserted = enrolled = 0
+    while inserted < clients:
+        size = min(chunk_size, clients - inserted)
+        ids = np.arange(next_id, next_id + size)
+        f = first.sample(rng, size)
+        l = last.sample(rng, size)
+        # Young-skewed age pyramid, capped at 95 years
+        ages = np.minimum(rng.gamma(2.0, 14.0, size), 95.0)
+        dob = (np.datetime64(now.date()) - (ages * 365.25).astype('timedelta64[D]')).tolist()
+        registered_offset = rng.integers(0, window, size)
+        registered = _datetimes(now - timedelta(seconds=window), registered_offset)
+        genders = rng.choice(np.array(['Female', 'Male'], dtype=object), size=size, p=[0.52, 0.48])
+
+        client_rows = [
+            {
+                'id': int(client_id),
+                'first_name': first.names[fi],
+                'last_name': last.names[li],
+                'date_of_birth': born,
+                'gender': gender,
+                'contact_number': f'+254-7{client_id % 100_000_000:08d}',
+                'email': None,
+                'address': None,
+                'registered_at': at,
+                'first_name_norm': first.norm[fi],
+                'last_name_norm': last.norm[li],
+                'name_phonetic': f'{first.phonetic[fi]} {last.phonetic[li]}',
+                'link_key': f'{last.link[li]}:{born.year}',
+            }
+            for client_id, fi, li, born, at, gender in zip(ids.tolist(), f, l, dob, registered, genders)
+        ]
+        sync.stamp(db.session.connection(), client_rows)
+        db.session.execute(insert(Client), client_rows)
+
+        # Distinct programs per client via weighted sampling without
+        # replacement: top-k of u ** (1 / w) (Efraimidis-Spirakis)
+        counts = np.minimum(rng.poisson(1.1, size), len(program_ids))
+        keys = rng.random((size, len(program_ids))) ** (1.0 / program_weights)
+        ranked = np.argsort(-keys, axis=1)
+        mask = np.arange(len(program_ids)) < counts[:, None]
+        owner = np.repeat(np.arange(size), counts)
+        chosen = program_ids[ranked[mask]]
+        status = rng.choice(len(ENROLLMENT_STATUSES), size=len(owner), p=ENROLLMENT_STATUS_WEIGHTS)
+        delay = np.minimum(rng.exponential(30 * 86400, len(owner)).astype(np.int64),
+                           window - registered_offset[owner])
+        enrollment_dates = _datetimes(now - timedelta(seconds=window), registered_offset[owner] + delay)
+
+        enrollment_rows = [
+            {
+                'client_id': int(ids[o]),
+                'program_id': int(p),
+                'status': ENROLLMENT_STATUSES[s],
+                'enrollment_date': at,
+                'notes': None,
+            }
+            for o, p, s, at in zip(owner.tolist(), chosen.tolist(), status.tolist(), enrollment_dates)
+        ]
+        if enrollment_rows:
+            version = sync.stamp(db.session.connection(), enrollment_rows)
+            db.session.execute(insert(Enrollment), enrollment_rows)
+            history.record_inserted(db.session.connection(), version)
+        db.session.commit()
+
+        inserted += size
+        enrolled += len(enrollment_rows)
+        next_id += size
+        log(f'{inserted:,} clients, {enrolled:,} enrollments')
+
+    stats.rebuild_counters()
+    rollups.rebuild()
+    return inserted, enrolled
@@ -0,0 +1,181 @@
+"""
+Concurrency benchmark of the serving modes.
+
+Starts gunicorn with gunicorn.conf.py in each SERVER_MODE against the bench
+database and holds `connections` keep-alive connections open against it,
+each sending the read-heavy requests (client profiles, client search,
+programs, stats) back to back for `duration` seconds. Unlike endpoints.py
+this covers the server and the network stack: it shows how each mode copes
+with many more connections than it has threads. With `slow_clients`, that
+many more connections send their requests a few bytes at a time, like
+clients on a poor mobile link, and only the other connections are measured.
+
+The load generator is a plain asyncio HTTP/1.1 client in this process, so
+on a small machine it competes with the server for CPU; compare modes on
+the same machine rather than reading the numbers as absolute capacity.
+"""
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import numpy as np
+from models import db
+from bench.endpoints import _context, _requests
+
+MODES = ('sync', 'async')
+ENDPOINTS = ('get_random_client', 'search_clients', 'get_programs', 'get_stats')
+REQUEST_TIMEOUT = 30
+# A slow client sends its request in pieces this far apart
+SLOW_CLIENT_PIECES = 10
+SLOW_CLIENT_INTERVAL = 0.5
+STARTUP_TIMEOUT = 60
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(mode, db_path, port, workers, threads):
+    env = dict(
+        os.environ,
+        SERVER_MODE=mode,
+        BIND=f'127.0.0.1:{port}',
+        WEB_CONCURRENCY=str(workers),
+        WEB_THREADS=str(threads),
+        DATABASE_URL=f'sqlite:///{os.path.abspath(db_path)}',
+        # Measure the endpoints, not the cache; every request comes from one address
+        FLASK_RESPONSE_CACHE_ENABLED='false',
+        FLASK_ADMISSION_ENABLED='false',
+        FLASK_AUTO_MIGRATE='false',
+    )
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--log-level', 'warning'],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, start_new_session=True
+    )
+
+
+def _wait_until_up(port, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with status {process.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1) as sock:
+                sock.sendall(b'GET /api/stats HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n')
+                if sock.recv(12).startswith(b'HTTP/1.1 200'):
+                    return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError('Server did not start')
+
+
+def _stop_server(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+async def _request(reader, writer, path, slow=False):
+    """Send one GET on a keep-alive connection; returns the status code"""
+    message = f'GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n'.encode()
+    if slow:
+        size = -(-len(message) // SLOW_CLIENT_PIECES)
+        for start in range(0, len(message), size):
+            writer.write(message[start:start + size])
+            await writer.drain()
+            await asyncio.sleep(SLOW_CLIENT_INTERVAL)
+    else:
+        writer.write(message)
+        await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin1').split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def _connection(port, urls, rng, deadline, results, slow=False):
+    reader = writer = None
+    while time.monotonic() < deadline:
+        path = urls[rng.integers(len(urls))](rng)
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection('127.0.0.1', port), REQUEST_TIMEOUT)
+            status = await asyncio.wait_for(_request(reader, writer, path, slow), REQUEST_TIMEOUT)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            if not slow:
+                results['errors'] += 1
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            continue
+        if slow:
+            continue
+        results['latencies'].append(time.perf_counter() - started)
+        if status >= 400:
+            results['errors'] += 1
+    if writer is not None:
+        writer.close()
+
+
+async def _load(port, urls, connections, duration, seed, slow_clients=0):
+    results = {'latencies': [], 'errors': 0}
+    deadline = time.monotonic() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        _connection(port, urls, np.random.default_rng(seed + i), deadline, results, slow=i < slow_clients)
+        for i in range(connections + slow_clients)
+    ])
+    return results, time.perf_counter() - started
+
+
+def run(app, db_path, modes=MODES, connections=1000, duration=20, workers=2, threads=8, slow_clients=0,
+        seed=0, log=print):
+    """Load each serving mode in turn; returns {mode: metrics}"""
+    with app.app_context():
+        ctx = _context()
+        db.session.remove()
+    requests = _requests(ctx)
+    urls = [requests[name] for name in ENDPOINTS]
+
+    summary = {}
+    for mode in modes:
+        port = _free_port()
+        process = _start_server(mode, db_path, port, workers, threads)
+        try:
+            _wait_until_up(port, process)
+            results, elapsed = asyncio.run(_load(port, urls, connections, duration, seed, slow_clients))
+        finally:
+            _stop_server(process)
+        ms = np.array(results['latencies'] or [0]) * 1000
+        summary[mode] = {
+            'connections': connections,
+            'slow_clients': slow_clients,
+            'requests': len(results['latencies']),
+            'errors': results['errors'],
+            'rps': round(len(results['latencies']) / elapsed, 1),
+            'p50_ms': round(float(np.percentile(ms, 50)), 1),
+            'p95_ms': round(float(np.percentile(ms, 95)), 1),
+            'p99_ms': round(float(np.percentile(ms, 99)), 1),
+        }
+        metrics = summary[mode]
+        log(f'{mode:6} {connections} connections (+{slow_clients} slow)  {metrics["rps"]:8.1f} req/s  '
+            f'p50 {metrics["p50_ms"]:8.1f} ms  p95 {metrics["p95_ms"]:8.1f} ms  p99 {metrics["p99_ms"]:8.1f} ms  '
+            f'errors {metrics["errors"]}')
+    return summary
@@ -0,0 +1,301 @@
+"""
+Bulk client registration and enrollment.
+
+Records are read from an NDJSON or CSV byte stream one at a time, validated,
+and inserted in chunked executemany transactions, so memory stays bounded by
+the chunk size however large the upload is. Invalid rows are skipped and
+reported by row number.
+"""
+import codecs
+import csv
+import json
+import os
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from models import db, Client, HealthProgram, Enrollment, ENROLLMENT_STATUSES, name_search_columns, link_key
+import stats
+import rollups
+import sync
+import history
+from cache import cache
+import jobs
+
+DEFAULT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+FORMATS = ('ndjson', 'csv')
+
+CLIENT_REQUIRED = ('first_name', 'last_name', 'date_of_birth', 'gender')
+CLIENT_OPTIONAL = ('contact_number', 'email', 'address')
+
+
+class RowError(ValueError):
+    """A single record failed validation"""
+
+
+class ImportReport:
+    """Running totals and a bounded list of per-row errors"""
+
+    def __init__(self):
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+        self.program_ids = set()
+        self.earliest = None
+
+    def error(self, row, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'error': message})
+
+    def to_dict(self):
+        return {
+            'inserted': self.inserted,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors)
+        }
+
+
+def detect_format(content_type, explicit=None):
+    """Pick the record format from an explicit name or a Content-Type header"""
+    if explicit:
+        if explicit not in FORMATS:
+            raise ValueError(f'format must be one of: {", ".join(FORMATS)}')
+        return explicit
+    if content_type and 'csv' in content_type:
+        return 'csv'
+    return 'ndjson'
+
+
+def iter_records(stream, fmt):
+    """Yield (row_number, record) from a binary stream without buffering it"""
+    lines = codecs.iterdecode(stream, 'utf-8-sig')
+    if fmt == 'csv':
+        for number, record in enumerate(csv.DictReader(lines), start=1):
+            # Empty CSV cells mean "not provided"
+            yield number, {key: value or None for key, value in record.items()}
+        return
+    number = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield number, RowError('Invalid JSON')
+            continue
+        if not isinstance(record, dict):
+            yield number, RowError('Each line must be a JSON object')
+            continue
+        yield number, record
+
+
+def _parse_date(value, field):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise RowError(f'Invalid {field}. Use YYYY-MM-DD')
+
+
+def _parse_int(value, field):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RowError(f'{field} must be an integer')
+
+
+def validate_client(record):
+    """Turn a client record into column values for client"""
+    for field in CLIENT_REQUIRED:
+        if not record.get(field):
+            raise RowError(f'{field} is required')
+    for field in ('first_name', 'last_name'):
+        if not isinstance(record[field], str):
+            raise RowError(f'{field} must be a string')
+    values = {
+        'first_name': record['first_name'],
+        'last_name': record['last_name'],
+        'date_of_birth': _parse_date(record['date_of_birth'], 'date_of_birth'),
+        'gender': record['gender'],
+        'registered_at': datetime.utcnow(),
+        'registered_by': None
+    }
+    values.update({field: record.get(field) for field in CLIENT_OPTIONAL})
+    values.update(name_search_columns(values['first_name'], values['last_name']))
+    values['link_key'] = link_key(values['last_name'], values['date_of_birth'])
+    return values
+
+
+def validate_enrollment(record):
+    """Turn an enrollment record into column values for enrollment"""
+    for field in ('client_id', 'program_id'):
+        if record.get(field) in (None, ''):
+            raise RowError(f'{field} is required')
+    status = record.get('status') or 'active'
+    if status not in ENROLLMENT_STATUSES:
+        raise RowError(f'status must be one of: {", ".join(ENROLLMENT_STATUSES)}')
+    enrollment_date = record.get('enrollment_date')
+    if enrollment_date:
+        try:
+            enrollment_date = datetime.fromisoformat(enrollment_date)
+        except (TypeError, ValueError):
+            raise RowError('Invalid enrollment_date. Use ISO 8601')
+    return {
+        'client_id': _parse_int(record['client_id'], 'client_id'),
+        'program_id': _parse_int(record['program_id'], 'program_id'),
+        'status': status,
+        'enrollment_date': enrollment_date or datetime.utcnow(),
+        'notes': record.get('notes'),
+        'enrolled_by': None
+    }
+
+
+def _client_deltas(values):
+    return Counter(stats.client_keys(values['registered_at']))
+
+
+def _enrollment_deltas(values):
+    return Counter(stats.enrollment_keys(values['program_id'], values['status']))
+
+
+def _insert_chunk(model, chunk, report, deltas_for):
+    """Insert a chunk of (row_number, values) in one transaction"""
+    if not chunk:
+        return
+    try:
+        version = sync.stamp(db.session.connection(), [values for _, values in chunk])
+        db.session.execute(insert(model), [values for _, values in chunk])
+        if model is Enrollment:
+            history.record_inserted(db.session.connection(), version)
+        if stats.counters_enabled():
+            deltas = Counter()
+            for _, values in chunk:
+                deltas.update(deltas_for(values))
+            stats.apply_deltas(db.session.connection(), deltas)
+        db.session.commit()
+        report.inserted += len(chunk)
+        return
+    except IntegrityError:
+        db.session.rollback()
+
+    # A constraint failed somewhere in the chunk; retry row by row to isolate it
+    version = sync.stamp(db.session.connection(), [values for _, values in chunk])
+    for number, values in chunk:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(model), [values])
+                if stats.counters_enabled():
+                    stats.apply_deltas(db.session.connection(), deltas_for(values))
+            report.inserted += 1
+        except IntegrityError as exc:
+            report.error(number, f'Constraint violation: {exc.orig}')
+    if model is Enrollment:
+        history.record_inserted(db.session.connection(), version)
+    db.session.commit()
+
+
+def import_clients(records, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Validate and insert client records; returns an ImportReport.
+    `progress` is called with the number of rows handled after each chunk.
+    """
+    report = ImportReport()
+    chunk = []
+    for number, record in records:
+        try:
+            if isinstance(record, RowError):
+                raise record
+            chunk.append((number, validate_client(record)))
+        except RowError as exc:
+            report.error(number, str(exc))
+        if len(chunk) >= chunk_size:
+            _insert_chunk(Client, chunk, report, _client_deltas)
+            chunk = []
+            if progress:
+                progress(report.inserted + report.failed)
+    _insert_chunk(Client, chunk, report, _client_deltas)
+    return report
+
+
+def _check_enrollment_chunk(chunk, program_ids, report):
+    """Drop rows referencing unknown clients/programs or duplicating an active enrollment"""
+    if not chunk:
+        return chunk
+    client_ids = {values['client_id'] for _, values in chunk}
+    existing_clients = {
+        client_id for (client_id,) in
+        db.session.query(Client.id).filter(Client.id.in_(client_ids))
+    }
+    active_pairs = set(
+        db.session.query(Enrollment.client_id, Enrollment.program_id).filter(
+            Enrollment.client_id.in_(client_ids), Enrollment.status == 'active'
+        )
+    )
+
+    accepted = []
+    for number, values in chunk:
+        report.program_ids.add(values['program_id'])
+        pair = (values['client_id'], values['program_id'])
+        if values['client_id'] not in existing_clients:
+            report.error(number, 'Client not found')
+        elif values['program_id'] not in program_ids:
+            report.error(number, 'Program not found')
+        elif values['status'] == 'active' and pair in active_pairs:
+            report.error(number, 'Client is already enrolled in this program')
+        else:
+            if values['status'] == 'active':
+                active_pairs.add(pair)
+            day = values['enrollment_date'].date()
+            report.earliest = day if report.earliest is None else min(report.earliest, day)
+            accepted.append((number, values))
+    return accepted
+
+
+def import_enrollments(records, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Validate and insert enrollment records; returns an ImportReport.
+    `progress` is called with the number of rows handled after each chunk.
+    """
+    report = ImportReport()
+    # Programs are few, so resolve them once instead of per chunk
+    program_ids = {program_id for (program_id,) in db.session.query(HealthProgram.id)}
+    chunk = []
+    for number, record in records:
+        try:
+            if isinstance(record, RowError):
+                raise record
+            chunk.append((number, validate_enrollment(record)))
+        except RowError as exc:
+            report.error(number, str(exc))
+        if len(chunk) >= chunk_size:
+            chunk = _check_enrollment_chunk(chunk, program_ids, report)
+            _insert_chunk(Enrollment, chunk, report, _enrollment_deltas)
+            chunk = []
+            if progress:
+                progress(report.inserted + report.failed)
+    chunk = _check_enrollment_chunk(chunk, program_ids, report)
+    _insert_chunk(Enrollment, chunk, report, _enrollment_deltas)
+    # Core inserts skip the ORM flush hooks, so expire cached program and
+    # client payloads here
+    if report.inserted:
+        # Back-dated rows land in rollup days that are otherwise final
+        rollups.reopen('enrollment', report.earliest)
+        cache.invalidate('programs', 'clients',
+                         *[f'program:{program_id}' for program_id in report.program_ids])
+    return report
+
+
+@jobs.handler('import')
+def import_job(context, kind, path, fmt, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Import a spooled upload; rows of chunks finished before a cancellation stay"""
+    importer = import_clients if kind == 'clients' else import_enrollments
+    try:
+        with open(path, 'rb') as stream:
+            report = importer(iter_records(stream, fmt), chunk_size, progress=context.progress)
+    finally:
+        os.remove(path)
+    context.progress(report.inserted + report.failed)
+    return report.to_dict()
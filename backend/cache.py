@@ -0,0 +1,291 @@
+"""
+Response cache for read endpoints.
+
+Cached responses are tagged with the resources they were built from
+('programs', 'program:3', 'client:12', ...). Writes never touch entries
+directly: committing a change bumps a generation counter per affected tag,
+and an entry is only served while every tag still has the generation it was
+stored with. That makes invalidation O(tags) and lets one invalidation cover
+every cached variant of a resource (any page, any query string).
+
+Two backends:
+- 'memory' (default): an LRU dict with TTL in each process. Invalidation is
+  local, so with several workers other processes may serve an entry until
+  its TTL expires. gunicorn.conf.py switches to 'sqlite' when it starts
+  more than one worker.
+- 'sqlite': a file shared by every worker on the host, so invalidation is
+  global.
+
+Every cached response carries a strong ETag and answers If-None-Match with
+304 Not Modified.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import Client, HealthProgram, Enrollment
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_ENTRIES = 1024
+
+# Bumped on every invalidation; lets a request that raced with a write skip storing
+_EPOCH = '__epoch__'
+
+
+class MemoryBackend:
+    """Per-process LRU cache with TTL"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry['expires_at'] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generations(self, tags):
+        with self._lock:
+            return {tag: self._generations.get(tag, 0) for tag in tags}
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in set(tags) | {_EPOCH}:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+
+class SQLiteBackend:
+    """Cache shared by all worker processes through a local SQLite file"""
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY, body BLOB, etag TEXT, tags TEXT,
+                    expires_at REAL, stored_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS ix_response_cache_stored_at
+                    ON response_cache (stored_at);
+                CREATE TABLE IF NOT EXISTS cache_generation (
+                    tag TEXT PRIMARY KEY, generation INTEGER NOT NULL
+                );
+            ''')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT body, etag, tags, expires_at FROM response_cache WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or row[3] < time.time():
+            return None
+        return {'body': row[0], 'etag': row[1], 'tags': json.loads(row[2]), 'expires_at': row[3]}
+
+    def set(self, key, entry):
+        connection = self._connect()
+        now = time.time()
+        connection.execute(
+            'INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?)',
+            (key, entry['body'], entry['etag'], json.dumps(entry['tags']), entry['expires_at'], now)
+        )
+        # Evict expired entries, then the oldest beyond the size limit
+        connection.execute('DELETE FROM response_cache WHERE expires_at < ?', (now,))
+        connection.execute(
+            'DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache '
+            'ORDER BY stored_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,)
+        )
+
+    def generations(self, tags):
+        tags = list(tags)
+        placeholders = ','.join('?' * len(tags))
+        rows = dict(self._connect().execute(
+            f'SELECT tag, generation FROM cache_generation WHERE tag IN ({placeholders})', tags
+        ))
+        return {tag: rows.get(tag, 0) for tag in tags}
+
+    def bump(self, tags):
+        self._connect().executemany(
+            'INSERT INTO cache_generation (tag, generation) VALUES (?, 1) '
+            'ON CONFLICT (tag) DO UPDATE SET generation = generation + 1',
+            [(tag,) for tag in set(tags) | {_EPOCH}]
+        )
+
+    def clear(self):
+        connection = self._connect()
+        connection.execute('DELETE FROM response_cache')
+        connection.execute('DELETE FROM cache_generation')
+
+
+def compute_etag(body):
+    """Strong validator for a response body"""
+    return hashlib.sha256(body).hexdigest()
+
+
+class ResponseCache:
+    """Flask extension wiring a backend, the cached() decorator and write invalidation"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = None
+        if app.config.get('RESPONSE_CACHE_ENABLED', True):
+            max_entries = app.config.get('RESPONSE_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+            if app.config.get('RESPONSE_CACHE_BACKEND', 'memory') == 'sqlite':
+                path = app.config.get('RESPONSE_CACHE_PATH',
+                                      os.path.join(app.instance_path, 'response_cache.db'))
+                backend = SQLiteBackend(path, max_entries)
+            else:
+                backend = MemoryBackend(max_entries)
+        app.extensions['response_cache'] = {
+            'backend': backend,
+            'ttl': app.config.get('RESPONSE_CACHE_TTL', DEFAULT_TTL)
+        }
+
+    @property
+    def backend(self):
+        return current_app.extensions['response_cache']['backend']
+
+    def add_tags(self, *tags):
+        """Tag the response being built with resources only known while building it"""
+        g.setdefault('cache_tags', []).extend(tags)
+
+    def invalidate(self, *tags):
+        """Expire every cached response built from any of these resources"""
+        if tags and self.backend is not None:
+            self.backend.bump(tags)
+
+    def cached(self, tags):
+        """
+        Cache a GET view's 200 responses. `tags` is called with the view's
+        keyword arguments and returns the resource tags known up front; the
+        view can add more with add_tags().
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**kwargs):
+                backend = self.backend
+                if backend is None:
+                    return _conditional(current_app.make_response(view(**kwargs)))
+
+                key = request.full_path
+                entry = backend.get(key)
+                if entry is not None:
+                    current = backend.generations(entry['tags'])
+                    if current == entry['tags']:
+                        return _conditional(_from_entry(entry))
+
+                base_tags = list(tags(**kwargs)) + [_EPOCH]
+                started = backend.generations(base_tags)
+                response = current_app.make_response(view(**kwargs))
+                if response.status_code != 200:
+                    g.pop('cache_tags', None)
+                    return response
+
+                extra_tags = [tag for tag in g.pop('cache_tags', []) if tag not in started]
+                generations = dict(started, **backend.generations(extra_tags))
+                # Skip storing if anything was invalidated while the view ran;
+                # its result may already be stale
+                if backend.generations([_EPOCH]) == {_EPOCH: started[_EPOCH]}:
+                    generations.pop(_EPOCH)
+                    body = response.get_data()
+                    backend.set(key, {
+                        'body': body,
+                        'etag': compute_etag(body),
+                        'tags': generations,
+                        'expires_at': time.time() + current_app.extensions['response_cache']['ttl']
+                    })
+                return _conditional(response)
+            return wrapper
+        return decorator
+
+    # --- Write invalidation ---
+
+    def tags_for_changes(self, session):
+        """Resource tags touched by the pending changes of a flushing session"""
+        tags = set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Client):
+                tags.add(f'client:{obj.id}')
+            elif isinstance(obj, HealthProgram):
+                tags.update(('programs', f'program:{obj.id}'))
+            elif isinstance(obj, Enrollment):
+                # client_count on programs and the client's program list change
+                tags.update(('programs', f'program:{obj.program_id}', f'client:{obj.client_id}'))
+        return tags
+
+
+def _from_entry(entry):
+    response = current_app.response_class(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    return response
+
+
+def _conditional(response):
+    if response.status_code != 200:
+        return response
+    if response.get_etag()[0] is None:
+        response.set_etag(compute_etag(response.get_data()))
+    # Let browsers keep the body but revalidate it with If-None-Match every time
+    response.headers.setdefault('Cache-Control', 'no-cache')
+    return response.make_conditional(request)
+
+
+cache = ResponseCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_invalidations(session, flush_context):
+    if not has_app_context() or 'response_cache' not in current_app.extensions:
+        return
+    session.info.setdefault('cache_tags', set()).update(cache.tags_for_changes(session))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_invalidations(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags and has_app_context():
+        cache.invalidate(*tags)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_invalidations(session):
+    session.info.pop('cache_tags', None)
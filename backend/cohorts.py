@@ -0,0 +1,567 @@
+"""
+Cohort queries: the clients matching a boolean combination of program,
+enrollment status, enrollment date and demographic conditions.
+
+A cohort is a JSON tree of conditions:
+
+    {"all": [
+        {"program": "HIV/AIDS Care"},
+        {"program": "Tuberculosis Control", "status": "active", "within_days": 90},
+        {"age": {"min": 15, "max": 49}}
+    ]}
+
+- {"program": <id or name>, "status": ..., "enrolled_from": ..., "enrolled_to": ...,
+  "within_days": n}: the client has one enrollment matching all of the given
+  fields. Every field is optional; {} alone is any enrollment.
+- {"age": {"min": a, "max": b}}: age today in whole years, bounds inclusive
+- {"gender": "Female"} or {"gender": ["Female", "Other"]}
+- {"all": [...]}, {"any": [...]} and {"not": {...}} combine them.
+
+Two engines answer the same tree:
+- 'sql' compiles it into one statement over client, each enrollment
+  condition an uncorrelated client.id IN (SELECT client_id ...) that the
+  database evaluates once.
+- 'bitmap' (default) evaluates it over a per-process index: a packed bitset
+  of client ids for every (program, status) pair, plus date of birth and
+  gender per client id. Conditions become bitsets and all/any/not become
+  AND/OR/AND NOT over N/8 bytes, so a count is a few vectorized passes
+  whatever the tree. Enrollment conditions with a date range read their
+  client ids through ix_enrollment_program_date instead.
+
+The index is built on first use and kept current with the sync clock (see
+sync.py). Before each query, clients and enrollments with a newer
+row_version and newer tombstones are folded in, so a write is visible to
+the next query. A client's program bits are re-read whole when any of their
+enrollments changes, since one client may hold several enrollments in a
+program. The index costs about P*S/8 + 5 bytes per client (P programs, S
+statuses) and 4 per enrollment in every worker; COHORT_INDEX_ENABLED=False
+leaves only the sql engine.
+"""
+import threading
+from datetime import date, datetime, timedelta
+import numpy as np
+from flask import current_app
+from sqlalchemy import String, and_, false, func, not_, or_, select, true, type_coerce
+from sqlalchemy.orm import aliased
+from models import db, Client, HealthProgram, Enrollment, SyncClock, Tombstone, ENROLLMENT_STATUSES
+
+ENGINES = ('bitmap', 'sql')
+MAX_DEPTH = 8
+MAX_CONDITIONS = 64
+ENROLLMENT_FIELDS = ('program', 'status', 'enrolled_from', 'enrolled_to', 'within_days')
+# Above this many changed rows since the last query a rebuild is cheaper
+REBUILD_THRESHOLD = 50000
+CHUNK_SIZE = 500
+GROWTH = 1.25
+MEMBER_BATCH_SIZE = 1000
+BUILD_BATCH_SIZE = 100000
+
+
+class CohortError(ValueError):
+    """Raised for a malformed cohort definition"""
+
+
+def init_app(app):
+    enabled = app.config.get('COHORT_INDEX_ENABLED', True)
+    app.extensions['cohorts'] = {'index': CohortIndex() if enabled else None}
+
+
+def parse_engine(value):
+    index = current_app.extensions['cohorts']['index']
+    if value is None:
+        return 'bitmap' if index is not None else 'sql'
+    if value not in ENGINES:
+        raise CohortError(f'engine must be one of {", ".join(ENGINES)}')
+    if value == 'bitmap' and index is None:
+        raise CohortError('The bitmap engine is disabled (COHORT_INDEX_ENABLED=False)')
+    return value
+
+
+def parse_statuses(value):
+    """None, one status or a list of them, validated; None means any status"""
+    if value is None:
+        return None
+    statuses = [value] if isinstance(value, str) else value
+    if not isinstance(statuses, list) or not statuses:
+        raise CohortError('status must be a status or a non-empty list of them')
+    for status in statuses:
+        if status not in ENROLLMENT_STATUSES:
+            raise CohortError(f'status must be one of {", ".join(ENROLLMENT_STATUSES)}')
+    return tuple(sorted(set(statuses)))
+
+
+# --- Definitions ---
+
+def _parse_date(value, name):
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise CohortError(f'{name} must be an ISO date (YYYY-MM-DD)')
+
+
+def _integer(value, name):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise CohortError(f'{name} must be a non-negative integer')
+    return value
+
+
+def _years_before(day, years):
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:
+        # 29 February in a non-leap year
+        return day.replace(year=day.year - years, day=28)
+
+
+class _Parser:
+    def __init__(self, today):
+        self.today = today
+        self.conditions = 0
+        self._programs = None
+
+    def program(self, value):
+        if self._programs is None:
+            self._programs = dict(db.session.query(HealthProgram.id, HealthProgram.name).all())
+        if isinstance(value, int) and not isinstance(value, bool):
+            if value not in self._programs:
+                raise CohortError(f'Unknown program {value}')
+            return value
+        if isinstance(value, str):
+            for program_id, name in self._programs.items():
+                if name.lower() == value.strip().lower():
+                    return program_id
+            raise CohortError(f'Unknown program {value!r}')
+        raise CohortError('program must be a program id or name')
+
+    def node(self, node, depth=0):
+        if depth > MAX_DEPTH:
+            raise CohortError(f'Cohorts may nest at most {MAX_DEPTH} levels')
+        if not isinstance(node, dict):
+            raise CohortError('Each condition must be a JSON object')
+        for combinator in ('all', 'any', 'not'):
+            if combinator not in node:
+                continue
+            if len(node) != 1:
+                raise CohortError(f'"{combinator}" must be the only key of its condition')
+            if combinator == 'not':
+                return ('not', self.node(node['not'], depth + 1))
+            children = node[combinator]
+            if not isinstance(children, list):
+                raise CohortError(f'"{combinator}" takes a list of conditions')
+            return (combinator, [self.node(child, depth + 1) for child in children])
+
+        self.conditions += 1
+        if self.conditions > MAX_CONDITIONS:
+            raise CohortError(f'Cohorts may have at most {MAX_CONDITIONS} conditions')
+        if set(node) <= {'age'} and node:
+            return self.age(node['age'])
+        if set(node) <= {'gender'} and node:
+            genders = node['gender']
+            genders = [genders] if isinstance(genders, str) else genders
+            if not isinstance(genders, list) or not genders or \
+                    not all(isinstance(gender, str) for gender in genders):
+                raise CohortError('gender must be a string or a non-empty list of them')
+            return ('gender', tuple(sorted(set(genders))))
+        unknown = set(node) - set(ENROLLMENT_FIELDS)
+        if unknown:
+            raise CohortError(f'Unknown condition field(s) {", ".join(sorted(unknown))}')
+        return self.enrollment(node)
+
+    def enrollment(self, node):
+        program_id = self.program(node['program']) if node.get('program') is not None else None
+        start = _parse_date(node['enrolled_from'], 'enrolled_from') if 'enrolled_from' in node else None
+        end = _parse_date(node['enrolled_to'], 'enrolled_to') if 'enrolled_to' in node else None
+        if 'within_days' in node:
+            days = _integer(node['within_days'], 'within_days')
+            recent = self.today - timedelta(days=max(1, days) - 1)
+            start = recent if start is None else max(start, recent)
+        return ('enrolled', program_id, parse_statuses(node.get('status')), start, end)
+
+    def age(self, bounds):
+        if not isinstance(bounds, dict) or not bounds or set(bounds) - {'min', 'max'}:
+            raise CohortError('age must be an object with min and/or max')
+        youngest = oldest = None
+        if bounds.get('min') is not None:
+            # At least min years old: born on or before this day
+            youngest = _years_before(self.today, _integer(bounds['min'], 'age.min'))
+        if bounds.get('max') is not None:
+            # At most max years old: born after this day
+            oldest = _years_before(self.today, _integer(bounds['max'], 'age.max') + 1)
+        return ('age', oldest, youngest)
+
+
+def parse(definition, today=None):
+    """Validate a cohort definition into a tree of tuples, resolving program names"""
+    if definition is None:
+        raise CohortError('A cohort definition ("where") is required')
+    return _Parser(today or datetime.utcnow().date()).node(definition)
+
+
+# --- SQL engine ---
+
+def _to_datetime(day):
+    return datetime.combine(day, datetime.min.time())
+
+
+def _enrollment_conditions(program_id, statuses, start, end, enrollment=Enrollment):
+    conditions = []
+    if program_id is not None:
+        conditions.append(enrollment.program_id == program_id)
+    if statuses is not None:
+        conditions.append(enrollment.status.in_(statuses))
+    if start is not None:
+        conditions.append(enrollment.enrollment_date >= _to_datetime(start))
+    if end is not None:
+        conditions.append(enrollment.enrollment_date < _to_datetime(end + timedelta(days=1)))
+    return conditions
+
+
+def to_sql(node):
+    """WHERE clause over Client for a parsed cohort"""
+    kind = node[0]
+    if kind == 'all':
+        return and_(true(), *[to_sql(child) for child in node[1]])
+    if kind == 'any':
+        return or_(false(), *[to_sql(child) for child in node[1]])
+    if kind == 'not':
+        return not_(to_sql(node[1]))
+    if kind == 'enrolled':
+        return Client.id.in_(select(Enrollment.client_id).where(*_enrollment_conditions(*node[1:])))
+    if kind == 'age':
+        oldest, youngest = node[1:]
+        conditions = []
+        if oldest is not None:
+            conditions.append(Client.date_of_birth > oldest)
+        if youngest is not None:
+            conditions.append(Client.date_of_birth <= youngest)
+        return and_(true(), *conditions)
+    return Client.gender.in_(node[1])
+
+
+def _sql_member_batches(tree, batch_size):
+    result = db.session.execute(
+        select(Client.id).where(to_sql(tree)).order_by(Client.id).execution_options(yield_per=batch_size)
+    )
+    try:
+        for batch in result.partitions():
+            yield batch
+    finally:
+        result.close()
+
+
+def _sql_matrix(program_ids, statuses):
+    first, second = aliased(Enrollment), aliased(Enrollment)
+    query = select(first.program_id, second.program_id, func.count(func.distinct(first.client_id))) \
+        .join(second, and_(second.client_id == first.client_id, second.program_id >= first.program_id)) \
+        .where(first.program_id.in_(program_ids), second.program_id.in_(program_ids),
+               *_enrollment_conditions(None, statuses, None, None, first),
+               *_enrollment_conditions(None, statuses, None, None, second)) \
+        .group_by(first.program_id, second.program_id)
+    position = {program_id: i for i, program_id in enumerate(program_ids)}
+    matrix = np.zeros((len(program_ids), len(program_ids)), dtype=np.int64)
+    for a, b, count in db.session.execute(query):
+        matrix[position[a], position[b]] = matrix[position[b], position[a]] = count
+    return matrix
+
+
+# --- Bitmap engine ---
+
+def _capacity(size):
+    return (size + 7) // 8 * 8
+
+
+def _pack(mask):
+    return np.packbits(mask, bitorder='little')
+
+
+def _bits_for(ids, size):
+    mask = np.zeros(size, dtype=bool)
+    mask[ids] = True
+    return _pack(mask)
+
+
+def _assign(bits, ids, on):
+    """Set (on=True) or clear the bits of these client ids in place"""
+    ids = np.asarray(ids, dtype=np.int64)
+    masks = np.left_shift(np.uint8(1), (ids & 7).astype(np.uint8))
+    if on:
+        np.bitwise_or.at(bits, ids >> 3, masks)
+    else:
+        np.bitwise_and.at(bits, ids >> 3, ~masks)
+
+
+def popcount(bits):
+    return int(np.bitwise_count(bits).sum(dtype=np.int64))
+
+
+def _day_numbers(values):
+    return np.array(values, dtype='datetime64[D]').astype(np.int32)
+
+
+class CohortIndex:
+    """Per-process bitmap index of program membership and demographics by client id"""
+
+    def __init__(self):
+        # Held for the whole of a query, so readers never see a half-applied change
+        self.lock = threading.RLock()
+        self.version = None
+        self.size = 0
+        self.present = None    # packed bitset of existing client ids
+        self.born = None       # date of birth per client id, as days since 1970
+        self.gender = None     # index into self.genders per client id
+        self.genders = {}
+        self.members = {}      # (program_id, status) -> packed bitset of client ids
+        self.enrolled = None   # client id per enrollment id, 0 when none
+        self.derived = {}      # unions of member bitsets, dropped on every change
+
+    def refresh(self):
+        """Bring the index up to the sync clock; call with the lock held"""
+        clock = db.session.execute(
+            select(SyncClock.version, SyncClock.pruned_through).where(SyncClock.id == 1)
+        ).one()
+        # A newer index than this transaction's clock (another request
+        # refreshed it meanwhile) is kept
+        if self.version is not None and self.version >= clock.version:
+            return
+        if self.version is None or self.version < clock.pruned_through or not self._advance(clock.version):
+            self._build(clock.version)
+
+    def _demographics(self, rows):
+        ids, born, genders = (list(column) for column in (list(zip(*rows)) or [(), (), ()]))
+        codes = [self.genders.setdefault(gender, len(self.genders)) for gender in genders]
+        return np.array(ids, dtype=np.int64), _day_numbers(born), np.array(codes, dtype=np.int16)
+
+    def _grow(self, client_id):
+        if client_id < self.size:
+            return
+        size = _capacity(max(client_id + 1, int(self.size * GROWTH)))
+        extra = (size - self.size) // 8
+        self.present = np.concatenate([self.present, np.zeros(extra, dtype=np.uint8)])
+        self.born = np.concatenate([self.born, np.zeros(size - self.size, dtype=np.int32)])
+        self.gender = np.concatenate([self.gender, np.zeros(size - self.size, dtype=np.int16)])
+        for key, bits in self.members.items():
+            self.members[key] = np.concatenate([bits, np.zeros(extra, dtype=np.uint8)])
+        self.size = size
+
+    def _grow_enrollments(self, enrollment_id):
+        if enrollment_id >= len(self.enrolled):
+            size = max(enrollment_id + 1, int(len(self.enrolled) * GROWTH))
+            self.enrolled = np.concatenate([self.enrolled, np.zeros(size - len(self.enrolled), dtype=np.int32)])
+
+    def _partitions(self, connection, query):
+        result = connection.execute(query.execution_options(yield_per=BUILD_BATCH_SIZE))
+        try:
+            for rows in result.partitions():
+                yield rows
+        finally:
+            result.close()
+
+    def _build(self, version):
+        # Core rows read in batches into preallocated arrays, so the build
+        # never holds a row object per client
+        connection = db.session.connection()
+        top_client = connection.execute(select(func.max(Client.id))).scalar() or 0
+        top_enrollment = connection.execute(select(func.max(Enrollment.id))).scalar() or 0
+        self.size = _capacity(top_client + 1)
+        self.present = np.zeros(self.size // 8, dtype=np.uint8)
+        self.born = np.zeros(self.size, dtype=np.int32)
+        self.gender = np.zeros(self.size, dtype=np.int16)
+        self.genders = {}
+        self.enrolled = np.zeros(top_enrollment + 1, dtype=np.int32)
+        self.members = {}
+        self.derived = {}
+        clients = select(Client.id, type_coerce(Client.date_of_birth, String), Client.gender) \
+            .where(Client.id <= top_client)
+        for rows in self._partitions(connection, clients):
+            ids, born, gender = self._demographics(rows)
+            _assign(self.present, ids, True)
+            self.born[ids] = born
+            self.gender[ids] = gender
+        enrollments = select(Enrollment.id, Enrollment.client_id, Enrollment.program_id, Enrollment.status) \
+            .where(Enrollment.id <= top_enrollment, Enrollment.client_id <= top_client)
+        for rows in self._partitions(connection, enrollments):
+            enrollment_ids, client_ids, program_ids, statuses = zip(*rows)
+            client_ids = np.array(client_ids, dtype=np.int64)
+            self.enrolled[np.array(enrollment_ids, dtype=np.int64)] = client_ids
+            self._add_members(client_ids, np.array(program_ids, dtype=np.int64), statuses)
+        self.version = version
+
+    def _add_members(self, client_ids, program_ids, statuses):
+        """Set member bits for parallel client/program/status columns"""
+        if not len(client_ids):
+            return
+        labels = sorted(set(statuses), key=str)
+        code = {status: i for i, status in enumerate(labels)}
+        groups = program_ids * len(labels) + np.array([code[status] for status in statuses], dtype=np.int64)
+        keys, inverse = np.unique(groups, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.cumsum(np.bincount(inverse))[:-1]
+        for key, ids in zip(keys, np.split(client_ids[order], bounds)):
+            member = (int(key // len(labels)), labels[key % len(labels)])
+            bits = self.members.get(member)
+            if bits is None:
+                self.members[member] = _bits_for(ids, self.size)
+            else:
+                _assign(bits, ids, True)
+
+    def _changed(self, query, since, version, column):
+        return db.session.execute(
+            query.where(column > since, column <= version).limit(REBUILD_THRESHOLD + 1)
+        ).all()
+
+    def _advance(self, version):
+        """Fold in writes after self.version; returns False when a rebuild is needed instead"""
+        since = self.version
+        tombstones = self._changed(select(Tombstone.entity, Tombstone.entity_id),
+                                   since, version, Tombstone.row_version)
+        clients = self._changed(select(Client.id, type_coerce(Client.date_of_birth, String), Client.gender),
+                                since, version, Client.row_version)
+        enrollments = self._changed(select(Enrollment.id, Enrollment.client_id),
+                                    since, version, Enrollment.row_version)
+        if len(tombstones) + len(clients) + len(enrollments) > REBUILD_THRESHOLD:
+            return False
+
+        affected = set()
+        for entity, entity_id in tombstones:
+            if entity == 'client' and entity_id < self.size:
+                _assign(self.present, [entity_id], False)
+            elif entity == 'enrollment' and entity_id < len(self.enrolled):
+                affected.add(int(self.enrolled[entity_id]))
+                self.enrolled[entity_id] = 0
+            elif entity == 'program':
+                for member in [member for member in self.members if member[0] == entity_id]:
+                    del self.members[member]
+        if clients:
+            ids, born, gender = self._demographics(clients)
+            self._grow(int(ids.max()))
+            _assign(self.present, ids, True)
+            self.born[ids] = born
+            self.gender[ids] = gender
+        for enrollment_id, client_id in enrollments:
+            self._grow_enrollments(enrollment_id)
+            self._grow(client_id)
+            # The previous client too, should an enrollment have moved
+            affected.update((int(self.enrolled[enrollment_id]), client_id))
+            self.enrolled[enrollment_id] = client_id
+        affected.discard(0)
+
+        if affected:
+            affected = sorted(affected)
+            for bits in self.members.values():
+                _assign(bits, affected, False)
+            for start in range(0, len(affected), CHUNK_SIZE):
+                rows = db.session.execute(
+                    select(Enrollment.client_id, Enrollment.program_id, Enrollment.status)
+                    .where(Enrollment.client_id.in_(affected[start:start + CHUNK_SIZE]))
+                ).all()
+                if rows:
+                    client_ids, program_ids, statuses = zip(*rows)
+                    self._add_members(np.array(client_ids, dtype=np.int64),
+                                      np.array(program_ids, dtype=np.int64), statuses)
+        if tombstones or clients or enrollments:
+            self.derived = {}
+        self.version = version
+        return True
+
+    def _enrolled(self, program_id, statuses, start, end):
+        if start is not None or end is not None:
+            ids = np.array(db.session.execute(
+                select(Enrollment.client_id).distinct()
+                .where(*_enrollment_conditions(program_id, statuses, start, end))
+            ).scalars().all(), dtype=np.int64)
+            return _bits_for(ids[ids < self.size], self.size)
+        key = (program_id, statuses)
+        bits = self.derived.get(key)
+        if bits is None:
+            bits = np.zeros_like(self.present)
+            for (member_program, status), member_bits in self.members.items():
+                if (program_id is None or member_program == program_id) and \
+                        (statuses is None or status in statuses):
+                    np.bitwise_or(bits, member_bits, out=bits)
+            self.derived[key] = bits
+        return bits
+
+    def evaluate(self, node):
+        """Packed bitset of the client ids matching a parsed cohort (do not modify it)"""
+        kind = node[0]
+        if kind == 'all':
+            bits = self.present.copy()
+            for child in node[1]:
+                np.bitwise_and(bits, self.evaluate(child), out=bits)
+            return bits
+        if kind == 'any':
+            bits = np.zeros_like(self.present)
+            for child in node[1]:
+                np.bitwise_or(bits, self.evaluate(child), out=bits)
+            return bits
+        if kind == 'not':
+            return self.present & ~self.evaluate(node[1])
+        if kind == 'enrolled':
+            return self._enrolled(*node[1:])
+        if kind == 'age':
+            oldest, youngest = node[1:]
+            mask = np.ones(self.size, dtype=bool)
+            if oldest is not None:
+                mask &= self.born > _day_numbers(oldest)
+            if youngest is not None:
+                mask &= self.born <= _day_numbers(youngest)
+            return self.present & _pack(mask)
+        codes = [self.genders[gender] for gender in node[1] if gender in self.genders]
+        return self.present & _pack(np.isin(self.gender, codes))
+
+
+def _index():
+    return current_app.extensions['cohorts']['index']
+
+
+# --- Queries ---
+
+def count(tree, engine):
+    if engine == 'sql':
+        return db.session.execute(select(func.count(Client.id)).where(to_sql(tree))).scalar()
+    index = _index()
+    with index.lock:
+        index.refresh()
+        return popcount(index.evaluate(tree))
+
+
+def members(tree, engine, batch_size=MEMBER_BATCH_SIZE):
+    """
+    The matching client ids in ascending order, as batches of 1-tuples, and
+    their number when known up front (bitmap engine) or None
+    """
+    if engine == 'sql':
+        return None, _sql_member_batches(tree, batch_size)
+    index = _index()
+    with index.lock:
+        index.refresh()
+        bits = index.evaluate(tree)
+        ids = np.flatnonzero(np.unpackbits(bits, bitorder='little'))
+    return len(ids), ([(int(client_id),) for client_id in ids[start:start + batch_size]]
+                      for start in range(0, len(ids), batch_size))
+
+
+def co_enrollment(statuses, engine):
+    """
+    Clients enrolled in each pair of programs (diagonal: in the program at
+    all), counting enrollments with one of `statuses` or any status
+    """
+    programs = db.session.query(HealthProgram.id, HealthProgram.name).order_by(HealthProgram.id).all()
+    program_ids = [program_id for program_id, _ in programs]
+    if engine == 'sql':
+        matrix = _sql_matrix(program_ids, statuses)
+    else:
+        index = _index()
+        with index.lock:
+            index.refresh()
+            sets = [index.evaluate(('enrolled', program_id, statuses, None, None)) for program_id in program_ids]
+            matrix = np.zeros((len(sets), len(sets)), dtype=np.int64)
+            for i in range(len(sets)):
+                matrix[i, i] = popcount(sets[i])
+                for j in range(i + 1, len(sets)):
+                    matrix[i, j] = matrix[j, i] = popcount(sets[i] & sets[j])
+    return {
+        'programs': [{'id': program_id, 'name': name} for program_id, name in programs],
+        'status': list(statuses) if statuses is not None else None,
+        'matrix': matrix.tolist(),
+    }
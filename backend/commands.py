@@ -0,0 +1,139 @@
+"""Maintenance commands, run with `flask --app app <command>`"""
+import json
+import click
+import analytics
+import jobs
+import bulk
+import export
+import linkage
+import migrations
+from models import db
+import stats
+import rollups
+import sync
+
+
+def register_commands(app):
+    """Attach the maintenance commands to the app's CLI"""
+
+    @app.cli.command('reconcile-counters')
+    @click.option('--check', is_flag=True, help='Only report drift, do not repair it.')
+    def reconcile_counters(check):
+        """Compare stat counters with the base tables and rebuild them if they drifted"""
+        drift = stats.check_counters()
+        for key, (stored, expected) in sorted(drift.items()):
+            click.echo(f'{key}: stored {stored}, expected {expected}')
+        if not drift:
+            click.echo('Counters are consistent')
+            return
+        if check:
+            raise SystemExit(1)
+        stats.rebuild_counters()
+        click.echo(f'Rebuilt counters ({len(drift)} keys were out of date)')
+
+    @app.cli.command('import')
+    @click.argument('kind', type=click.Choice(['clients', 'enrollments']))
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(bulk.FORMATS),
+                  help='Record format; defaults to csv for .csv files, ndjson otherwise.')
+    @click.option('--chunk-size', default=bulk.DEFAULT_CHUNK_SIZE, show_default=True,
+                  help='Rows inserted per transaction.')
+    def import_records(kind, path, fmt, chunk_size):
+        """Stream clients or enrollments from an NDJSON/CSV file into the database"""
+        fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+        importer = bulk.import_clients if kind == 'clients' else bulk.import_enrollments
+        with open(path, 'rb') as stream:
+            report = importer(bulk.iter_records(stream, fmt), chunk_size=chunk_size)
+        click.echo(json.dumps(report.to_dict(), indent=2))
+
+    @app.cli.command('export')
+    @click.argument('kind', type=click.Choice(export.KINDS))
+    @click.argument('path', type=click.Path(dir_okay=False, writable=True))
+    @click.option('--format', 'fmt', type=click.Choice(export.FILE_FORMATS), default='ndjson',
+                  show_default=True, help='Output format; parquet requires pyarrow.')
+    @click.option('--since', help='Only rows added or changed after the watermark of an earlier export.')
+    def export_records(kind, path, fmt, since):
+        """Stream clients or enrollments to a file at constant memory"""
+        try:
+            since = export.parse_since(since)
+        except ValueError:
+            raise click.BadParameter('Use the watermark printed by an earlier export', param_hint='--since')
+        watermark = export.current_watermark()
+        try:
+            rows = export.write_file(kind, fmt, path, since, watermark)
+        except RuntimeError as exc:
+            raise click.ClickException(str(exc))
+        click.echo(f'Exported {rows} {kind} to {path}; next --since {watermark}')
+
+    @app.cli.command('upgrade-db')
+    @click.option('--dedupe', is_flag=True,
+                  help='Suspend duplicate active enrollments so the unique index can be built.')
+    def upgrade_db(dedupe):
+        """Add missing columns and indexes to an existing database"""
+        try:
+            applied = migrations.upgrade(db.engine, dedupe=dedupe)
+        except migrations.MigrationError as exc:
+            raise click.ClickException(str(exc))
+        for message in applied:
+            click.echo(message)
+        if applied:
+            stats.rebuild_counters()
+            rollups.rebuild()
+        click.echo('Upgrade complete' if applied else 'Database is up to date')
+
+    @app.cli.command('refresh-analytics')
+    @click.option('--days', default=analytics.DEFAULT_WINDOW_DAYS, show_default=True,
+                  help='Window length ending today.')
+    @click.option('--interval', type=click.Choice(analytics.INTERVALS), default=analytics.DEFAULT_INTERVAL,
+                  show_default=True)
+    def refresh_analytics(days, interval):
+        """Materialize every analytics metric for the default window"""
+        window = analytics.parse_window({'days': days, 'interval': interval})
+        for metric in analytics.METRICS:
+            analytics.refresh(metric, window)
+            click.echo(f'Refreshed {analytics.result_key(metric, window)}')
+
+    @app.cli.command('refresh-rollups')
+    @click.option('--rebuild', is_flag=True, help='Recompute every day instead of those since the watermark.')
+    def refresh_rollups(rebuild):
+        """Fold recent writes into the reporting rollups"""
+        refreshed = (rollups.rebuild if rebuild else rollups.refresh)()
+        for name, since in refreshed.items():
+            click.echo(f'{name}: recomputed {"every day" if since is None else f"from {since}"}')
+
+    @app.cli.command('check-rollups')
+    def check_rollups():
+        """Compare the final days of the rollups with the base tables"""
+        drift = rollups.check()
+        for key, (stored, expected) in sorted(drift.items()):
+            click.echo(f'{":".join(key)}: stored {stored}, expected {expected}')
+        if drift:
+            click.echo(f'{len(drift)} rollup rows are out of date; run refresh-rollups --rebuild')
+            raise SystemExit(1)
+        click.echo('Rollups are consistent')
+
+    @app.cli.command('dedupe-clients')
+    @click.option('--threshold', type=float,
+                  help='Match probability to report (default LINKAGE_REVIEW_PROBABILITY).')
+    def dedupe_clients(threshold):
+        """Find likely duplicate clients and store the pairs in client_match"""
+        summary = linkage.dedupe(threshold)
+        click.echo(f'Compared {summary["comparisons"]} pairs in {summary["blocks"]} blocks; '
+                   f'{summary["pairs"]} likely duplicate pairs in {summary["groups"]} groups')
+
+    @app.cli.command('prune-tombstones')
+    @click.option('--days', type=int, help='Keep deletions this recent (default SYNC_TOMBSTONE_DAYS).')
+    def prune_tombstones(days):
+        """Forget old deletions; devices that last synced before them must resync"""
+        click.echo(f'Pruned {sync.prune(days)} tombstones')
+
+    @app.cli.command('run-jobs')
+    @click.option('--processes', default=2, show_default=True, help='Worker processes to start.')
+    @click.option('--once', is_flag=True, help='Run queued jobs in this process, then exit.')
+    def run_jobs(processes, once):
+        """Run background jobs (imports, exports, analytics refreshes)"""
+        if once:
+            click.echo(f'Ran {jobs.run_pending()} jobs')
+            return
+        click.echo(f'Starting {processes} job workers; Ctrl+C to stop')
+        jobs.run_pool(app, processes)
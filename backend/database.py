@@ -0,0 +1,91 @@
+"""
+Engine profile for create_app.
+
+SQLite files get WAL journaling and a set of pragmas applied on every new
+connection, so gunicorn workers can read while one writes and wait on locks
+instead of failing with "database is locked". PostgreSQL URLs get a sized,
+pre-pinged connection pool per worker process.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+DEFAULT_DATABASE_URI = 'sqlite:///health_system.db'
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # ms to wait for a lock before raising
+    'cache_size': -64000,  # negative means KiB, i.e. 64 MB per connection
+    'mmap_size': 268435456,  # 256 MB
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',  # SQLite leaves foreign keys unenforced otherwise
+}
+
+DEFAULT_POOL = {
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': 1800,
+}
+
+
+def normalize_database_url(url):
+    """Accept the postgres:// scheme that hosting providers hand out"""
+    if url and url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def _is_memory_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured database URL"""
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    if _is_memory_sqlite(url):
+        # Flask-SQLAlchemy uses a single static connection for in-memory databases
+        return options
+
+    pool = {key: config.get(key, default) for key, default in DEFAULT_POOL.items()}
+    options.setdefault('pool_size', pool['DB_POOL_SIZE'])
+    options.setdefault('max_overflow', pool['DB_MAX_OVERFLOW'])
+    options.setdefault('pool_timeout', pool['DB_POOL_TIMEOUT'])
+    if url.get_backend_name() != 'sqlite':
+        # Drop connections the server or a proxy closed while idle
+        options.setdefault('pool_pre_ping', True)
+        options.setdefault('pool_recycle', pool['DB_POOL_RECYCLE'])
+    return options
+
+
+def sqlite_pragmas(config):
+    """DEFAULT_SQLITE_PRAGMAS with SQLITE_PRAGMAS merged over them; a None value drops a pragma"""
+    pragmas = dict(DEFAULT_SQLITE_PRAGMAS, **config.get('SQLITE_PRAGMAS', {}))
+    return {name: value for name, value in pragmas.items() if value is not None}
+
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """Run the given PRAGMAs on every new DBAPI connection of a SQLite engine"""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name} = {value}')
+        finally:
+            cursor.close()
+
+
+def init_app(app, db):
+    """Configure engine options before db.init_app and pragmas after it"""
+    app.config['SQLALCHEMY_DATABASE_URI'] = normalize_database_url(
+        app.config.get('SQLALCHEMY_DATABASE_URI', DEFAULT_DATABASE_URI)
+    )
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+    db.init_app(app)
+    with app.app_context():
+        apply_sqlite_pragmas(db.engine, sqlite_pragmas(app.config))
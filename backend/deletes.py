@@ -0,0 +1,123 @@
+"""
+Set-based deletes of clients and programs.
+
+Removing a client or program takes its enrollments with it. Rather than
+loading every enrollment and deleting it through the session, remove()
+issues one DELETE ... WHERE per table, enrollments first, so a program with
+500k enrollments costs a handful of statements. With archive=True the rows
+are first copied into the *_archive tables with INSERT ... SELECT, so the
+delete is a move; the enrollments' status history goes along with them.
+
+The ORM flush hooks never see these statements, so everything they would
+have done is done here from grouped queries run before the DELETE, in the
+same transaction: stat counters, the final days of the rollups, sync
+tombstones and the removed enrollments' status history. Cached responses
+are invalidated after commit, including the detail of every program that
+lost enrollments.
+"""
+from datetime import datetime
+from sqlalchemy import delete, insert, literal, or_, select
+from models import (db, Client, HealthProgram, Enrollment, ClientMatch,
+                    EnrollmentStatusEvent, EnrollmentStatusInterval,
+                    ClientArchive, EnrollmentArchive, ProgramArchive,
+                    EnrollmentStatusEventArchive, EnrollmentStatusIntervalArchive)
+from cache import cache
+import rollups
+import stats
+import sync
+
+ARCHIVES = {
+    Client: ClientArchive,
+    Enrollment: EnrollmentArchive,
+    HealthProgram: ProgramArchive,
+    EnrollmentStatusEvent: EnrollmentStatusEventArchive,
+    EnrollmentStatusInterval: EnrollmentStatusIntervalArchive,
+}
+
+
+def archive_requested(args, config):
+    """?archive=1/0 on a delete route, defaulting to the DELETE_ARCHIVE setting"""
+    value = args.get('archive')
+    if value is None:
+        return bool(config.get('DELETE_ARCHIVE', False))
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def _archive(model, condition, now):
+    archive = ARCHIVES[model]
+    columns = [column.name for column in archive.__table__.columns
+               if column.name not in ('archive_id', 'archived_at')]
+    db.session.execute(insert(archive).from_select(
+        columns + ['archived_at'],
+        select(*[getattr(model, column) for column in columns], literal(now)).where(condition)
+    ))
+
+
+def remove(client_ids=(), program_ids=(), archive=False):
+    """
+    Delete (or with archive=True, move to the archive tables) clients and
+    programs with all their enrollments in one transaction. Returns the
+    number of rows removed per table.
+    """
+    client_ids, program_ids = list(client_ids), list(program_ids)
+    counts = {'clients': 0, 'programs': 0, 'enrollments': 0}
+    enrollments = []
+    if client_ids:
+        enrollments.append(Enrollment.client_id.in_(client_ids))
+    if program_ids:
+        enrollments.append(Enrollment.program_id.in_(program_ids))
+    if not enrollments:
+        return counts
+    clients = Client.id.in_(client_ids) if client_ids else None
+    programs = HealthProgram.id.in_(program_ids) if program_ids else None
+    # Enrollments go first so no foreign key ever points at a deleted row
+    targets = [('enrollments', Enrollment, or_(*enrollments)),
+               ('clients', Client, clients),
+               ('programs', HealthProgram, programs)]
+
+    connection = db.session.connection()
+    if stats.counters_enabled():
+        program_count = db.session.query(HealthProgram.id).filter(programs).count() if program_ids else 0
+        stats.apply_deltas(connection, stats.removal_deltas(targets[0][2], clients, program_count))
+    if rollups.rollups_enabled():
+        rollups.remove('enrollment', targets[0][2])
+        if client_ids:
+            rollups.remove('client', clients)
+
+    # Programs that lose enrollments cache their client counts under their own tag
+    touched_programs = set(program_ids)
+    if client_ids:
+        touched_programs.update(db.session.execute(
+            select(Enrollment.program_id).where(targets[0][2]).distinct()
+        ).scalars())
+
+    now = datetime.utcnow()
+    # ON DELETE CASCADE covers this where foreign keys are enforced
+    removed = select(Enrollment.id).where(targets[0][2])
+    for model in (EnrollmentStatusEvent, EnrollmentStatusInterval):
+        condition = model.enrollment_id.in_(removed)
+        if archive:
+            _archive(model, condition, now)
+        db.session.execute(delete(model).where(condition).execution_options(synchronize_session=False))
+
+    for name, model, condition in targets:
+        if condition is None:
+            continue
+        if sync.sync_enabled():
+            sync.tombstone_where(connection, model, condition)
+        if archive:
+            _archive(model, condition, now)
+        counts[name] = db.session.execute(
+            delete(model).where(condition).execution_options(synchronize_session=False)
+        ).rowcount
+    if client_ids:
+        db.session.execute(delete(ClientMatch).where(
+            or_(ClientMatch.client_id.in_(client_ids), ClientMatch.match_id.in_(client_ids))
+        ))
+    db.session.commit()
+
+    # Client profiles embed program data and programs embed client counts
+    cache.invalidate('programs', 'clients',
+                     *[f'program:{program_id}' for program_id in sorted(touched_programs)],
+                     *[f'client:{client_id}' for client_id in client_ids])
+    return counts
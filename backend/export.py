@@ -0,0 +1,192 @@
+"""
+Streaming line-list export of clients and enrollments.
+
+Rows are read with a server-side cursor (`yield_per`) and written out batch
+by batch, so memory stays constant regardless of table size.
+
+Incremental exports are keyed on row_version, the sync clock every write
+stamps (see sync.py), not on registration or enrollment dates: back-dated
+rows from bulk imports and later edits are picked up too. An export covers
+the rows written up to its watermark, the clock when it started; pass that
+as `since` to fetch only what was added or changed after it. Deletions are
+not exported; /api/sync reports them.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+from datetime import date, datetime
+from sqlalchemy import select
+from models import db, Client, HealthProgram, Enrollment, SyncClock
+import jobs
+
+BATCH_SIZE = 1000
+STREAM_FORMATS = ('ndjson', 'csv')
+FILE_FORMATS = STREAM_FORMATS + ('parquet',)
+MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+CLIENT_COLUMNS = [
+    Client.id, Client.first_name, Client.last_name, Client.date_of_birth,
+    Client.gender, Client.contact_number, Client.email, Client.address,
+    Client.registered_at, Client.registered_by
+]
+ENROLLMENT_COLUMNS = [
+    Enrollment.id, Enrollment.client_id, Enrollment.program_id,
+    HealthProgram.name.label('program_name'), Enrollment.status,
+    Enrollment.enrollment_date, Enrollment.notes, Enrollment.enrolled_by
+]
+KINDS = ('clients', 'enrollments')
+
+
+def parse_since(value):
+    """Parse the watermark of an earlier export, raising ValueError if malformed"""
+    if value is None or value == '':
+        return None
+    since = int(value)
+    if since < 0:
+        raise ValueError('since must not be negative')
+    return since
+
+
+def current_watermark():
+    """The sync clock now; rows written so far have a row_version at or below it"""
+    return db.session.execute(select(SyncClock.version).where(SyncClock.id == 1)).scalar() or 0
+
+
+def export_query(kind, since=None, upto=None):
+    """The ordered select statement for an export kind, limited to rows written in (since, upto]"""
+    if kind == 'clients':
+        model = Client
+        query = select(*CLIENT_COLUMNS)
+    else:
+        model = Enrollment
+        query = select(*ENROLLMENT_COLUMNS).join(HealthProgram, Enrollment.program_id == HealthProgram.id)
+    if since is not None:
+        query = query.where(model.row_version > since)
+    if upto is not None:
+        # Rows written after the watermark belong to the next export
+        query = query.where(model.row_version <= upto)
+    return query.order_by(model.id)
+
+
+def column_names(kind):
+    return [column.key for column in (CLIENT_COLUMNS if kind == 'clients' else ENROLLMENT_COLUMNS)]
+
+
+def iter_batches(kind, since=None, upto=None, batch_size=BATCH_SIZE):
+    """Yield lists of row tuples using a server-side cursor"""
+    result = db.session.execute(
+        export_query(kind, since, upto).execution_options(yield_per=batch_size)
+    )
+    try:
+        for batch in result.partitions():
+            yield batch
+    finally:
+        result.close()
+
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def iter_ndjson(names, batches):
+    for batch in batches:
+        yield ''.join(
+            json.dumps({name: _json_value(value) for name, value in zip(names, row)}) + '\n'
+            for row in batch
+        )
+
+
+def iter_csv(names, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for batch in batches:
+        writer.writerows([_json_value(value) for value in row] for row in batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only when there are no rows
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def stream(kind, fmt, since=None, upto=None, batches=None):
+    """Text chunks of an NDJSON or CSV export"""
+    batches = batches if batches is not None else iter_batches(kind, since, upto)
+    formatter = iter_ndjson if fmt == 'ndjson' else iter_csv
+    return formatter(column_names(kind), batches)
+
+
+def _arrow_schema(kind, pa):
+    columns = CLIENT_COLUMNS if kind == 'clients' else ENROLLMENT_COLUMNS
+    fields = []
+    for column in columns:
+        python_type = column.type.python_type
+        if python_type is int:
+            arrow_type = pa.int64()
+        elif python_type is datetime:
+            arrow_type = pa.timestamp('us')
+        elif python_type is date:
+            arrow_type = pa.date32()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(column.key, arrow_type))
+    return pa.schema(fields)
+
+
+def _write_parquet(kind, path, batches):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('Parquet export requires pyarrow (pip install pyarrow)')
+
+    schema = _arrow_schema(kind, pa)
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for batch in batches:
+            # One row group per batch keeps memory flat
+            writer.write_table(pa.Table.from_pylist([row._asdict() for row in batch], schema=schema))
+
+
+def write_file(kind, fmt, path, since=None, upto=None, progress=None):
+    """
+    Export to a file and return the row count. Parquet output is
+    zstd-compressed and needs pyarrow; `.gz` paths are gzip-compressed for
+    ndjson/csv. `progress` is called with the rows written after each batch.
+    """
+    rows = 0
+
+    def counted():
+        nonlocal rows
+        for batch in iter_batches(kind, since, upto):
+            rows += len(batch)
+            yield batch
+            if progress:
+                progress(rows)
+
+    if fmt == 'parquet':
+        _write_parquet(kind, path, counted())
+        return rows
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', encoding='utf-8', newline='') as output:
+        for chunk in stream(kind, fmt, batches=counted()):
+            output.write(chunk)
+    return rows
+
+
+@jobs.handler('export')
+def export_job(context, kind, fmt, since=None):
+    """Write an export into the jobs directory for download from /api/jobs/<id>/result"""
+    path = context.path(f'.{fmt}')
+    watermark = current_watermark()
+    try:
+        rows = write_file(kind, fmt, path, parse_since(since), watermark, progress=context.progress)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return {'rows': rows, 'file': os.path.basename(path), 'format': fmt, 'watermark': watermark}
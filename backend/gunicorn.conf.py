@@ -0,0 +1,40 @@
+"""
+gunicorn settings for both serving modes, from the backend/ directory:
+
+    gunicorn -c gunicorn.conf.py                      # sync: wsgi:app on gthread workers
+    SERVER_MODE=async gunicorn -c gunicorn.conf.py    # async: asgi:app on uvicorn workers
+
+Sync workers serve WEB_THREADS requests at a time each, and a slow client
+holds its thread until the response is sent. Async workers hold any number
+of connections on one event loop; the read-heavy routes run there with async
+database access and the rest on a pool of ASGI_WSGI_THREADS threads (see
+asgi.py).
+
+Environment: BIND (0.0.0.0:8000), WEB_CONCURRENCY (workers, default
+2 x cores + 1), WEB_THREADS (8, sync mode only) and TIMEOUT (30 s).
+"""
+import multiprocessing
+import os
+
+mode = os.environ.get('SERVER_MODE', 'sync')
+if mode not in ('sync', 'async'):
+    raise RuntimeError('SERVER_MODE must be sync or async')
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+timeout = int(os.environ.get('TIMEOUT', 30))
+if workers > 1:
+    # A memory cache only invalidates in the worker that made the write;
+    # share it through the SQLite backend unless one was chosen explicitly
+    os.environ.setdefault('FLASK_RESPONSE_CACHE_BACKEND', 'sqlite')
+keepalive = 5
+# Connections the kernel queues until a worker accepts them
+backlog = 2048
+
+if mode == 'async':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    wsgi_app = 'wsgi:app'
+    worker_class = 'gthread'
+    threads = int(os.environ.get('WEB_THREADS', 8))
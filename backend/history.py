@@ -0,0 +1,237 @@
+"""
+Enrollment status history.
+
+enrollment.status only holds the current status. Every status an
+enrollment takes is also appended to enrollment_status_event (the status
+it starts with at its enrollment date, then each change with the moment it
+took effect) and indexed as spans in enrollment_status_interval: one row
+per status held, from starts_at until ends_at, which stays NULL while the
+status is current. Both are written in the same transaction as the change:
+ORM writes from an after_flush hook, bulk inserts through
+record_inserted().
+
+Point-in-time and retention questions read the intervals with range scans
+on their covering indexes, never replaying the log:
+- status_counts(day): enrollments per program and status at the end of a
+  day
+- covering(day): the spans held at the end of a day, to list enrollments
+  with the status they had then
+- analytics.prevalence and analytics.retention
+
+Enrollments written before history was kept are backfilled by the
+migration with a single span in their current status from their enrollment
+date, the same assumption the analytics made before.
+"""
+from datetime import date, datetime, timedelta
+from flask import current_app, has_app_context
+from sqlalchemy import and_, event, func, insert, inspect, literal, null, or_, select, update
+from sqlalchemy.orm import Session
+from models import (db, Enrollment, EnrollmentStatusEvent, EnrollmentStatusInterval,
+                    HealthProgram, ENROLLMENT_STATUSES)
+
+# Session.info key for effective times of pending status changes, by enrollment
+_EFFECTIVE = 'status_effective_at'
+
+
+class HistoryError(ValueError):
+    """Raised for an invalid status change or as-of date"""
+
+
+def init_app(app):
+    app.extensions['history'] = {}
+
+
+def history_enabled():
+    return has_app_context() and 'history' in current_app.extensions
+
+
+def parse_day(value, name='as_of'):
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise HistoryError(f'{name} must be an ISO date (YYYY-MM-DD)')
+
+
+def _end_of(day):
+    """The first instant after `day`; a span covers the end of the day if it starts before and ends at or after it"""
+    return datetime.combine(day + timedelta(days=1), datetime.min.time())
+
+
+# --- Writing ---
+
+def already_active(client_id, program_id, exclude_id=None):
+    """
+    Whether the client has an active enrollment in the program other than
+    `exclude_id`. Only checked on a database still missing the unique
+    active-enrollment index (see `upgrade-db --dedupe`); otherwise the index
+    rejects the second one at commit and this returns False.
+    """
+    if current_app.extensions.get('active_enrollment_index', True):
+        return False
+    query = Enrollment.query.filter_by(client_id=client_id, program_id=program_id, status='active')
+    if exclude_id is not None:
+        query = query.filter(Enrollment.id != exclude_id)
+    return query.first() is not None
+
+
+def set_status(enrollment, status, effective_at=None):
+    """
+    Change an enrollment's status as of `effective_at` (an ISO datetime or
+    date, default now). The change may be back-dated, but not to before the
+    current status began.
+    """
+    if status not in ENROLLMENT_STATUSES:
+        raise HistoryError(f'status must be one of: {", ".join(ENROLLMENT_STATUSES)}')
+    if effective_at is None:
+        at = datetime.utcnow()
+    else:
+        try:
+            at = datetime.fromisoformat(effective_at)
+        except (TypeError, ValueError):
+            raise HistoryError('Invalid effective_at. Use ISO 8601')
+        if at.tzinfo is not None:
+            raise HistoryError('effective_at must be in UTC without an offset')
+        if at > datetime.utcnow():
+            raise HistoryError('effective_at cannot be in the future')
+        current = db.session.execute(
+            select(EnrollmentStatusInterval.starts_at).where(
+                EnrollmentStatusInterval.enrollment_id == enrollment.id,
+                EnrollmentStatusInterval.ends_at.is_(None))
+        ).scalar()
+        if current is not None and at < current:
+            raise HistoryError(f'effective_at precedes the current status, which began {current.isoformat()}')
+    if status == enrollment.status:
+        return
+    enrollment.status = status
+    db.session.info.setdefault(_EFFECTIVE, {})[enrollment.id] = at
+
+
+def _open(connection, rows):
+    """Append events and open spans for (enrollment_id, program_id, status, at) tuples"""
+    now = datetime.utcnow()
+    connection.execute(insert(EnrollmentStatusEvent), [
+        {'enrollment_id': enrollment_id, 'status': status, 'effective_at': at, 'recorded_at': now}
+        for enrollment_id, _, status, at in rows
+    ])
+    connection.execute(insert(EnrollmentStatusInterval), [
+        {'enrollment_id': enrollment_id, 'program_id': program_id, 'status': status,
+         'starts_at': at, 'ends_at': None}
+        for enrollment_id, program_id, status, at in rows
+    ])
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_changes(session, flush_context):
+    if not history_enabled():
+        return
+    effective = session.info.pop(_EFFECTIVE, {})
+    started = []
+    changed = []
+    moved = []
+    for obj in session.new:
+        if isinstance(obj, Enrollment):
+            started.append((obj.id, obj.program_id, obj.status or 'active', obj.enrollment_date))
+    for obj in session.dirty:
+        if not isinstance(obj, Enrollment) or obj in session.deleted:
+            continue
+        state = inspect(obj)
+        if state.attrs.status.history.has_changes():
+            changed.append((obj.id, obj.program_id, obj.status or 'active',
+                            effective.get(obj.id) or datetime.utcnow()))
+        if state.attrs.program_id.history.has_changes():
+            moved.append({'enrollment_id': obj.id, 'program_id': obj.program_id})
+    removed = [obj.id for obj in session.deleted if isinstance(obj, Enrollment)]
+    if not (started or changed or moved or removed):
+        return
+
+    connection = session.connection()
+    if removed:
+        # ON DELETE CASCADE does this where foreign keys are enforced
+        for model in (EnrollmentStatusEvent, EnrollmentStatusInterval):
+            connection.execute(model.__table__.delete().where(model.enrollment_id.in_(removed)))
+    for values in moved:
+        connection.execute(update(EnrollmentStatusInterval).where(
+            EnrollmentStatusInterval.enrollment_id == values['enrollment_id']
+        ).values(program_id=values['program_id']))
+    for enrollment_id, _, _, at in changed:
+        connection.execute(update(EnrollmentStatusInterval).where(
+            EnrollmentStatusInterval.enrollment_id == enrollment_id,
+            EnrollmentStatusInterval.ends_at.is_(None)
+        ).values(ends_at=at))
+    if started or changed:
+        _open(connection, started + changed)
+
+
+def record_inserted(connection, version):
+    """
+    Start the history of enrollments inserted with Core (bulk imports), all
+    stamped with sync row_version `version`
+    """
+    if not history_enabled():
+        return
+    now = datetime.utcnow()
+    pending = and_(
+        Enrollment.row_version == version,
+        ~select(EnrollmentStatusInterval.id)
+        .where(EnrollmentStatusInterval.enrollment_id == Enrollment.id).exists()
+    )
+    status = func.coalesce(Enrollment.status, 'active')
+    started = func.coalesce(Enrollment.enrollment_date, now)
+    # Events first: the spans are what marks an enrollment as done
+    connection.execute(insert(EnrollmentStatusEvent).from_select(
+        ['enrollment_id', 'status', 'effective_at', 'recorded_at'],
+        select(Enrollment.id, status, started, literal(now)).where(pending)
+    ))
+    connection.execute(insert(EnrollmentStatusInterval).from_select(
+        ['enrollment_id', 'program_id', 'status', 'starts_at', 'ends_at'],
+        select(Enrollment.id, Enrollment.program_id, status, started, null()).where(pending)
+    ))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_effective(session):
+    session.info.pop(_EFFECTIVE, None)
+
+
+# --- Reading ---
+
+def covering(day):
+    """Condition on EnrollmentStatusInterval: the span was held at the end of `day`"""
+    end = _end_of(day)
+    return EnrollmentStatusInterval.starts_at < end, \
+        or_(EnrollmentStatusInterval.ends_at.is_(None), EnrollmentStatusInterval.ends_at >= end)
+
+
+def status_counts(day, program_id=None):
+    """Enrollments per program and status at the end of `day`"""
+    programs = db.session.query(HealthProgram.id, HealthProgram.name).order_by(HealthProgram.id)
+    if program_id is not None:
+        programs = programs.filter(HealthProgram.id == program_id)
+    programs = programs.all()
+    counts = {program: {status: 0 for status in ENROLLMENT_STATUSES} for program, _ in programs}
+    # program_id IN (...) keeps this a range scan per program and status
+    for program, status, count in db.session.execute(
+        select(EnrollmentStatusInterval.program_id, EnrollmentStatusInterval.status, func.count())
+        .where(EnrollmentStatusInterval.program_id.in_(list(counts)),
+               EnrollmentStatusInterval.status.in_(ENROLLMENT_STATUSES), *covering(day))
+        .group_by(EnrollmentStatusInterval.program_id, EnrollmentStatusInterval.status)
+    ):
+        counts[program][status] = count
+    return {
+        'as_of': day.isoformat(),
+        'programs': [{'program_id': program, 'name': name, 'counts': counts[program]}
+                     for program, name in programs],
+        'total': {status: sum(counts[program][status] for program in counts) for status in ENROLLMENT_STATUSES},
+    }
+
+
+def enrollment_history(enrollment_id):
+    events = EnrollmentStatusEvent.query.filter_by(enrollment_id=enrollment_id) \
+        .order_by(EnrollmentStatusEvent.effective_at, EnrollmentStatusEvent.id).all()
+    spans = EnrollmentStatusInterval.query.filter_by(enrollment_id=enrollment_id) \
+        .order_by(EnrollmentStatusInterval.starts_at, EnrollmentStatusInterval.id).all()
+    return {
+        'enrollment_id': enrollment_id,
+        'events': [event.to_dict() for event in events],
+        'intervals': [span.to_dict() for span in spans],
+    }
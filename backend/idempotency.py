@@ -0,0 +1,272 @@
+"""
+Idempotency keys for write endpoints.
+
+A client that may retry a POST (field devices on flaky links) sends an
+Idempotency-Key header, any unique string such as a UUID, and reuses it for
+every retry of that request. The first request with a key runs the view and
+its response is stored under the key for IDEMPOTENCY_TTL seconds (a day by
+default). Later requests with the key get the stored response back, marked
+Idempotent-Replayed: true, without running the view again.
+
+- A key reused for a different request (method, path or body) gets 422.
+- A request whose key is still being processed waits up to
+  IDEMPOTENCY_WAIT seconds for the first one to finish and returns its
+  response, so concurrent duplicates run once. If it is still running after
+  that, the request gets 409 with Retry-After.
+- 5xx responses and exceptions are not stored; the key is freed for a retry.
+- Requests without the header behave as before.
+
+Keys are claimed in a SQLite file shared by every worker on the host, so
+duplicates are coalesced across processes. A claim is a lease of
+IDEMPOTENCY_LEASE seconds, in case a worker dies while holding one; if it
+dies after committing but before storing the response, a retry after the
+lease runs again. Stored responses are immutable, so each process keeps the
+ones it has seen in an LRU in front of the file. Expired rows are evicted as
+new ones are stored.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, jsonify, request
+
+DEFAULT_TTL = 24 * 3600
+DEFAULT_WAIT = 10
+DEFAULT_LEASE = 60
+DEFAULT_MAX_ENTRIES = 1024
+MAX_KEY_LENGTH = 255
+PURGE_EVERY = 100
+POLL_INTERVAL = 0.05
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+# Response headers kept with the stored body
+STORED_HEADERS = ('Location',)
+
+
+class IdempotencyStore:
+    """Keys and stored responses in a local SQLite file, with an LRU of completed entries in front"""
+
+    def __init__(self, path, ttl=DEFAULT_TTL, lease=DEFAULT_LEASE, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.lease = lease
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Keys this process is running, set when they are stored or released
+        self._running = {}
+        self._stored = 0
+        with self._connect() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS idempotency_key (
+                    key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, state TEXT NOT NULL,
+                    status INTEGER, body BLOB, mimetype TEXT, headers TEXT,
+                    expires_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_idempotency_key_expires_at
+                    ON idempotency_key (expires_at);
+            ''')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        """The live entry for `key`: {'fingerprint', 'state': 'running' | 'done', ...}, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry['expires_at'] >= now:
+                    self._entries.move_to_end(key)
+                    return entry
+                del self._entries[key]
+        row = self._connect().execute(
+            'SELECT fingerprint, state, status, body, mimetype, headers, expires_at '
+            'FROM idempotency_key WHERE key = ? AND expires_at >= ?', (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        entry = {'fingerprint': row[0], 'state': row[1], 'status': row[2], 'body': row[3],
+                 'mimetype': row[4], 'headers': json.loads(row[5] or '{}'), 'expires_at': row[6]}
+        if entry['state'] == 'done':
+            self._remember(key, entry)
+        return entry
+
+    def claim(self, key, fingerprint):
+        """Take `key` for a request to run; False if a live entry already holds it"""
+        now = time.time()
+        with self._lock:
+            if key in self._running:
+                return False
+            # Expired entries and abandoned claims are taken over
+            claimed = self._connect().execute(
+                "INSERT INTO idempotency_key (key, fingerprint, state, expires_at) VALUES (?1, ?2, 'running', ?3) "
+                "ON CONFLICT (key) DO UPDATE SET fingerprint = ?2, state = 'running', status = NULL, "
+                "body = NULL, mimetype = NULL, headers = NULL, expires_at = ?3 WHERE expires_at < ?4",
+                (key, fingerprint, now + self.lease, now)
+            ).rowcount
+            if claimed:
+                self._running[key] = threading.Event()
+            return bool(claimed)
+
+    def store(self, key, fingerprint, response):
+        """Keep the response of a claimed key for the TTL"""
+        now = time.time()
+        entry = {
+            'fingerprint': fingerprint,
+            'state': 'done',
+            'status': response.status_code,
+            'body': response.get_data(),
+            'mimetype': response.mimetype,
+            'headers': {name: response.headers[name] for name in STORED_HEADERS if name in response.headers},
+            'expires_at': now + self.ttl,
+        }
+        connection = self._connect()
+        connection.execute(
+            "UPDATE idempotency_key SET state = 'done', status = ?, body = ?, mimetype = ?, headers = ?, "
+            "expires_at = ? WHERE key = ? AND state = 'running'",
+            (entry['status'], entry['body'], entry['mimetype'], json.dumps(entry['headers']),
+             entry['expires_at'], key)
+        )
+        self._remember(key, entry)
+        with self._lock:
+            self._stored += 1
+            purge = self._stored % PURGE_EVERY == 0
+        if purge:
+            connection.execute('DELETE FROM idempotency_key WHERE expires_at < ?', (now,))
+        self._finish(key)
+
+    def release(self, key):
+        """Give up a claimed key without a response, so a retry runs the request again"""
+        self._connect().execute("DELETE FROM idempotency_key WHERE key = ? AND state = 'running'", (key,))
+        self._finish(key)
+
+    def wait(self, key, timeout):
+        """Block until `key` may have finished: at once when this process finishes it, else one poll"""
+        with self._lock:
+            finished = self._running.get(key)
+        if finished is not None:
+            finished.wait(timeout)
+        else:
+            time.sleep(min(POLL_INTERVAL, max(timeout, 0)))
+
+    def _finish(self, key):
+        with self._lock:
+            finished = self._running.pop(key, None)
+        if finished is not None:
+            finished.set()
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self._connect().execute('DELETE FROM idempotency_key')
+
+
+def fingerprint():
+    """Hash of what makes two requests the same request"""
+    digest = hashlib.sha256()
+    for part in (request.method, request.full_path, request.mimetype):
+        digest.update(part.encode('utf8'))
+        digest.update(b'\0')
+    digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+
+def _replay(entry):
+    response = current_app.response_class(entry['body'], status=entry['status'], mimetype=entry['mimetype'])
+    for name, value in entry['headers'].items():
+        response.headers[name] = value
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def _error(message, status):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+class Idempotency:
+    """Flask extension storing the responses of idempotent() views by Idempotency-Key"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('IDEMPOTENCY_ENABLED', True):
+            return
+        path = app.config.get('IDEMPOTENCY_PATH', os.path.join(app.instance_path, 'idempotency.db'))
+        app.extensions['idempotency'] = {
+            'store': IdempotencyStore(
+                path,
+                ttl=app.config.get('IDEMPOTENCY_TTL', DEFAULT_TTL),
+                lease=app.config.get('IDEMPOTENCY_LEASE', DEFAULT_LEASE),
+                max_entries=app.config.get('IDEMPOTENCY_MAX_ENTRIES', DEFAULT_MAX_ENTRIES),
+            ),
+            'wait': app.config.get('IDEMPOTENCY_WAIT', DEFAULT_WAIT),
+        }
+
+    def idempotent(self, view):
+        """Run a write view at most once per Idempotency-Key and replay its response to retries"""
+        @wraps(view)
+        def wrapper(**kwargs):
+            state = current_app.extensions.get('idempotency')
+            key = request.headers.get(HEADER)
+            if state is None or key is None:
+                return view(**kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                return _error(f'{HEADER} must be 1 to {MAX_KEY_LENGTH} characters', 400)
+
+            store = state['store']
+            request_fingerprint = fingerprint()
+            deadline = time.monotonic() + state['wait']
+            while True:
+                entry = store.get(key)
+                if entry is not None and entry['fingerprint'] != request_fingerprint:
+                    return _error(f'{HEADER} was already used for a different request', 422)
+                if entry is not None and entry['state'] == 'done':
+                    return _replay(entry)
+                if entry is None and store.claim(key, request_fingerprint):
+                    break
+                # The same request is running elsewhere; wait for its response
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    response = _error('A request with this Idempotency-Key is still being processed', 409)
+                    response.headers['Retry-After'] = '1'
+                    return response
+                store.wait(key, remaining)
+
+            try:
+                response = current_app.make_response(view(**kwargs))
+            except BaseException:
+                store.release(key)
+                raise
+            if response.status_code >= 500 or response.is_streamed:
+                store.release(key)
+            else:
+                store.store(key, request_fingerprint, response)
+            return response
+        return wrapper
+
+
+idempotency = Idempotency()
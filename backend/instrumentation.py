@@ -0,0 +1,267 @@
+"""
+Opt-in request and SQL instrumentation.
+
+With INSTRUMENTATION_ENABLED set, every request is timed and every SQL
+statement it runs is counted and timed through engine events. The totals are
+returned in X-Query-Count and Server-Timing headers, aggregated into
+per-route histograms served at /metrics in the Prometheus text format, and
+statements or requests slower than SLOW_QUERY_MS / SLOW_REQUEST_MS are
+logged.
+
+With PROFILING_ENABLED also set, a request carrying an X-Profile header is
+run under cProfile (or pyinstrument when the header says so and it is
+installed) and the report is returned instead of the normal body. When
+PROFILING_TOKEN is configured the header value must match it.
+
+Metrics are kept per process; with several gunicorn workers each one
+reports its own.
+"""
+import cProfile
+import io
+import pstats
+import threading
+import time
+from bisect import bisect_left
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+DEFAULT_SLOW_QUERY_MS = 100
+DEFAULT_SLOW_REQUEST_MS = 500
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values"""
+
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series['buckets'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                labels = _labels(self.labels, label_values)
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['buckets']):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{{labels}}} {series["sum"]:.6f}')
+                lines.append(f'{self.name}_count{{{labels}}} {series["count"]}')
+        return lines
+
+
+class Counter:
+    """Monotonic counter keyed by label values"""
+
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{{{_labels(self.labels, label_values)}}} {value}')
+        return lines
+
+
+def _labels(names, values):
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+class Metrics:
+    """The metric families collected for one app"""
+
+    def __init__(self):
+        route = ('method', 'route')
+        self.request_duration = Histogram(
+            'http_request_duration_seconds', 'Request latency by route.', route + ('status',), LATENCY_BUCKETS)
+        self.request_queries = Histogram(
+            'http_request_db_queries', 'SQL statements executed per request.', route, QUERY_COUNT_BUCKETS)
+        self.request_db_time = Histogram(
+            'http_request_db_duration_seconds', 'Time spent in SQL per request.', route, LATENCY_BUCKETS)
+        self.queries = Counter('db_queries_total', 'SQL statements executed, by route.', ('route',))
+        self.slow_queries = Counter('db_slow_queries_total', 'SQL statements over SLOW_QUERY_MS.', ('route',))
+
+    def render(self):
+        lines = []
+        for family in (self.request_duration, self.request_queries, self.request_db_time,
+                       self.queries, self.slow_queries):
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _route():
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return 'unmatched' if has_request_context() else 'background'
+
+
+def _state():
+    return current_app.extensions['instrumentation']
+
+
+# --- SQL events ---
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    elapsed = time.perf_counter() - started
+    if not has_request_context() or 'instrumentation' not in current_app.extensions:
+        return
+    state = _state()
+    g.query_count = g.get('query_count', 0) + 1
+    g.db_time = g.get('db_time', 0.0) + elapsed
+    route = _route()
+    state['metrics'].queries.inc((route,))
+    if elapsed * 1000 >= state['slow_query_ms']:
+        state['metrics'].slow_queries.inc((route,))
+        current_app.logger.warning('Slow query (%.1f ms) in %s %s: %s', elapsed * 1000,
+                                   request.method, request.path, ' '.join(statement.split()))
+
+
+def _handle_error(context):
+    # after_cursor_execute does not fire for a failed statement
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+# --- Request hooks ---
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+    g.db_time = 0.0
+    _start_profile()
+
+
+def _finish_request(response):
+    if 'request_started' not in g:
+        return response
+    state = _state()
+    elapsed = time.perf_counter() - g.request_started
+    route = _route()
+    labels = (request.method, route)
+    metrics = state['metrics']
+    metrics.request_duration.observe(labels + (str(response.status_code),), elapsed)
+    metrics.request_queries.observe(labels, g.query_count)
+    metrics.request_db_time.observe(labels, g.db_time)
+
+    response.headers['X-Query-Count'] = str(g.query_count)
+    response.headers['Server-Timing'] = (
+        f'db;dur={g.db_time * 1000:.1f};desc="{g.query_count} queries", app;dur={elapsed * 1000:.1f}'
+    )
+    if elapsed * 1000 >= state['slow_request_ms']:
+        current_app.logger.warning('Slow request (%.1f ms, %d queries, %.1f ms SQL): %s %s',
+                                   elapsed * 1000, g.query_count, g.db_time * 1000,
+                                   request.method, request.full_path)
+    return _finish_profile(response)
+
+
+# --- Profiling ---
+
+def _profile_requested():
+    state = _state()
+    header = request.headers.get('X-Profile')
+    if not state['profiling'] or not header:
+        return None
+    token = state['profiling_token']
+    mode, _, supplied = header.partition(':')
+    if token and supplied != token:
+        return None
+    return 'pyinstrument' if mode == 'pyinstrument' else 'cprofile'
+
+
+def _start_profile():
+    mode = _profile_requested()
+    if mode == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            mode = 'cprofile'
+        else:
+            g.profiler = ('pyinstrument', Profiler())
+            g.profiler[1].start()
+            return
+    if mode == 'cprofile':
+        g.profiler = ('cprofile', cProfile.Profile())
+        g.profiler[1].enable()
+
+
+def _finish_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    mode, profile = profiler
+    if mode == 'pyinstrument':
+        profile.stop()
+        report = profile.output_text(unicode=True, color=False)
+    else:
+        profile.disable()
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(50)
+        report = output.getvalue()
+    profiled = Response(report, mimetype='text/plain')
+    profiled.headers['X-Profiled-Status'] = str(response.status_code)
+    for header in ('X-Query-Count', 'Server-Timing'):
+        profiled.headers[header] = response.headers[header]
+    return profiled
+
+
+def instrument_engine(engine):
+    """Count and time the statements run on an engine (the async one too, in asgi.py)"""
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+def init_app(app, db):
+    """Install the hooks when INSTRUMENTATION_ENABLED is set"""
+    if not app.config.get('INSTRUMENTATION_ENABLED', False):
+        return
+    app.extensions['instrumentation'] = {
+        'metrics': Metrics(),
+        'slow_query_ms': app.config.get('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS),
+        'slow_request_ms': app.config.get('SLOW_REQUEST_MS', DEFAULT_SLOW_REQUEST_MS),
+        'profiling': app.config.get('PROFILING_ENABLED', False),
+        'profiling_token': app.config.get('PROFILING_TOKEN'),
+    }
+    with app.app_context():
+        instrument_engine(db.engine)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Prometheus metrics for this process"""
+        return Response(_state()['metrics'].render(), mimetype='text/plain; version=0.0.4')
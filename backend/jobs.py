@@ -0,0 +1,310 @@
+"""
+Background jobs without an external broker.
+
+Jobs are rows in the job table of the application database. submit()
+inserts one and returns at once; a worker claims queued jobs with a
+conditional UPDATE (so each job runs exactly once however many workers poll)
+and calls the handler registered for the job's kind:
+
+    @jobs.handler('export')
+    def export_job(context, kind, fmt):
+        ...
+        context.progress(rows_done, total)  # also raises JobCancelled
+        return {'rows': rows_done}           # stored as the job's result
+
+Workers are either a process pool started with `flask --app app run-jobs`
+or, unless JOBS_EMBEDDED_WORKER is False, a thread each web process starts
+on its first submit() so a single `python app.py` needs nothing else.
+
+Cancelling a queued job takes effect immediately; a running job stops the
+next time its handler reports progress. A job whose worker stops sending
+heartbeats for JOB_STALE_AFTER seconds is marked failed rather than retried,
+since imports are not idempotent.
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update
+from models import db, Job
+
+JOB_STATUSES = ('queued', 'running', 'succeeded', 'failed', 'cancelled')
+FINISHED_STATUSES = ('succeeded', 'failed', 'cancelled')
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_STALE_AFTER = 600
+DEFAULT_RETENTION_DAYS = 7
+PRUNE_EVERY = 3600  # seconds between clean-ups of old jobs in a runner
+
+_HANDLERS = {}
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler when its job has been cancelled"""
+
+
+def handler(kind):
+    """Register a function(context, **params) as the handler for a job kind"""
+    def decorator(function):
+        _HANDLERS[kind] = function
+        return function
+    return decorator
+
+
+def init_app(app):
+    directory = app.config.get('JOBS_DIR', os.path.join(app.instance_path, 'jobs'))
+    os.makedirs(directory, exist_ok=True)
+    app.extensions['jobs'] = {
+        'dir': directory,
+        'embedded': app.config.get('JOBS_EMBEDDED_WORKER', True),
+        'poll_interval': app.config.get('JOB_POLL_INTERVAL', DEFAULT_POLL_INTERVAL),
+        'stale_after': app.config.get('JOB_STALE_AFTER', DEFAULT_STALE_AFTER),
+        'retention_days': app.config.get('JOB_RETENTION_DAYS', DEFAULT_RETENTION_DAYS),
+        'thread': None,
+        'lock': threading.Lock(),
+    }
+
+
+def _state():
+    return current_app.extensions['jobs']
+
+
+def job_path(job_id, suffix=''):
+    """File owned by a job (an uploaded body, an export) in the jobs directory"""
+    return os.path.join(_state()['dir'], f'{job_id}{suffix}')
+
+
+def spool(stream, suffix=''):
+    """Copy a request body to a file in the jobs directory and return its path"""
+    path = job_path(uuid.uuid4().hex, suffix)
+    with open(path, 'wb') as output:
+        shutil.copyfileobj(stream, output, 1024 * 1024)
+    return path
+
+
+class JobContext:
+    """Handed to handlers to report progress and notice cancellation"""
+
+    def __init__(self, job_id):
+        self.id = job_id
+
+    def path(self, suffix=''):
+        return job_path(self.id, suffix)
+
+    def progress(self, done, total=None):
+        values = {'progress': done, 'heartbeat_at': datetime.utcnow()}
+        if total is not None:
+            values['total'] = total
+        # Own connection, so the handler's open transaction is neither
+        # committed nor rolled back by a progress report
+        with db.engine.begin() as connection:
+            connection.execute(update(Job).where(Job.id == self.id).values(**values))
+            cancelled = connection.execute(select(Job.cancel_requested).where(Job.id == self.id)).scalar()
+        if cancelled:
+            raise JobCancelled()
+
+
+# --- Queue ---
+
+def submit(kind, params=None, dedupe_key=None):
+    """
+    Queue a job and return it. With a dedupe_key, an equal job that is still
+    queued or running is returned instead of queueing another.
+    """
+    if kind not in _HANDLERS:
+        raise ValueError(f'No handler for job kind {kind!r}')
+    if dedupe_key is not None:
+        existing = Job.query.filter(
+            Job.dedupe_key == dedupe_key, Job.status.in_(('queued', 'running'))
+        ).first()
+        if existing is not None:
+            return existing
+    job = Job(id=uuid.uuid4().hex, kind=kind, params=json.dumps(params or {}), dedupe_key=dedupe_key)
+    db.session.add(job)
+    db.session.commit()
+    _ensure_embedded_worker()
+    return job
+
+
+def cancel(job):
+    """Cancel a queued job now or ask a running one to stop; returns the refreshed job"""
+    now = datetime.utcnow()
+    cancelled = db.session.execute(
+        update(Job).where(Job.id == job.id, Job.status == 'queued')
+        .values(status='cancelled', finished_at=now)
+    ).rowcount
+    if not cancelled:
+        db.session.execute(
+            update(Job).where(Job.id == job.id, Job.status == 'running').values(cancel_requested=True)
+        )
+    db.session.commit()
+    db.session.refresh(job)
+    return job
+
+
+def claim(worker):
+    """Mark the oldest queued job as running for this worker and return it"""
+    while True:
+        job_id = db.session.execute(
+            select(Job.id).where(Job.status == 'queued').order_by(Job.created_at).limit(1)
+        ).scalar()
+        if job_id is None:
+            db.session.commit()
+            return None
+        now = datetime.utcnow()
+        claimed = db.session.execute(
+            update(Job).where(Job.id == job_id, Job.status == 'queued')
+            .values(status='running', worker=worker, started_at=now, heartbeat_at=now)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+        # Another worker got there first; try the next one
+
+
+def run_job(job):
+    """Run a claimed job's handler and record how it ended"""
+    context = JobContext(job.id)
+    values = {}
+    try:
+        result = _HANDLERS[job.kind](context, **json.loads(job.params))
+        values.update(status='succeeded', result=json.dumps(result) if result is not None else None)
+    except JobCancelled:
+        db.session.rollback()
+        values['status'] = 'cancelled'
+    except Exception as exc:
+        db.session.rollback()
+        current_app.logger.exception('Job %s (%s) failed', job.id, job.kind)
+        values.update(status='failed', error=str(exc) or exc.__class__.__name__)
+    values['finished_at'] = datetime.utcnow()
+    with db.engine.begin() as connection:
+        connection.execute(update(Job).where(Job.id == job.id).values(**values))
+    db.session.expire_all()
+    return values['status']
+
+
+def run_pending(worker=None, limit=None):
+    """Run queued jobs in this thread until none are left; returns how many ran"""
+    worker = worker or _worker_name('inline')
+    ran = 0
+    while limit is None or ran < limit:
+        job = claim(worker)
+        if job is None:
+            break
+        run_job(job)
+        ran += 1
+    return ran
+
+
+def fail_stale():
+    """Mark running jobs whose worker stopped sending heartbeats as failed"""
+    cutoff = datetime.utcnow() - timedelta(seconds=_state()['stale_after'])
+    failed = db.session.execute(
+        update(Job).where(Job.status == 'running', Job.heartbeat_at < cutoff)
+        .values(status='failed', error='Worker stopped responding', finished_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    return failed
+
+
+def prune(days=None):
+    """Delete finished jobs older than the retention period, with their files"""
+    days = _state()['retention_days'] if days is None else days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    old = [job_id for (job_id,) in db.session.query(Job.id).filter(
+        Job.status.in_(FINISHED_STATUSES), Job.finished_at < cutoff
+    )]
+    if not old:
+        return 0
+    directory = _state()['dir']
+    for name in os.listdir(directory):
+        if name[:32] in old:
+            os.remove(os.path.join(directory, name))
+    Job.query.filter(Job.id.in_(old)).delete(synchronize_session=False)
+    db.session.commit()
+    return len(old)
+
+
+# --- Workers ---
+
+def _worker_name(kind):
+    return f'{socket.gethostname()}:{os.getpid()}:{kind}'
+
+
+class JobRunner:
+    """Poll for queued jobs and run them one at a time until stopped"""
+
+    def __init__(self, app, name):
+        self.app = app
+        self.name = name
+        self.stop = threading.Event()
+
+    def run(self):
+        last_prune = 0
+        with self.app.app_context():
+            interval = _state()['poll_interval']
+            while not self.stop.is_set():
+                try:
+                    fail_stale()
+                    if time.monotonic() - last_prune > PRUNE_EVERY:
+                        prune()
+                        last_prune = time.monotonic()
+                    ran = run_pending(self.name)
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Job runner %s failed to poll', self.name)
+                    ran = 0
+                finally:
+                    db.session.remove()
+                if not ran:
+                    self.stop.wait(interval)
+
+
+def _ensure_embedded_worker():
+    state = _state()
+    if not state['embedded']:
+        return
+    with state['lock']:
+        thread = state['thread']
+        # Threads do not survive a fork, so check liveness rather than presence
+        if thread is not None and thread.is_alive():
+            return
+        runner = JobRunner(current_app._get_current_object(), _worker_name('thread'))
+        state['thread'] = threading.Thread(target=runner.run, name='job-runner', daemon=True)
+        state['thread'].start()
+
+
+def _worker_main(config):
+    from app import create_app
+    app = create_app(dict(config, JOBS_EMBEDDED_WORKER=False))
+    JobRunner(app, _worker_name('process')).run()
+
+
+def run_pool(app, processes):
+    """Run job workers in `processes` child processes until interrupted"""
+    context = multiprocessing.get_context('spawn')
+    config = {key: value for key, value in app.config.items() if key.isupper()}
+    workers = [context.Process(target=_worker_main, args=(config,), daemon=True) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+
+    # Take the workers down with us when a supervisor stops the pool
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,310 @@
+"""
+Duplicate client detection (record linkage).
+
+Candidates are found by blocking: every client carries a link_key of the
+Soundex code of its last name plus its birth year ('S530:1985'), indexed, so
+a check only reads the clients sharing a key with the new record, at most
+LINKAGE_MAX_CANDIDATES of them.
+
+Candidate pairs are scored Fellegi-Sunter style. Each field comparison adds
+log2(m/u) bits when the values agree and log2((1-m)/(1-u)) when they do not,
+where m is how often the field agrees for the same person and u how often it
+agrees by chance; partial agreement (a typo, a day/month swap) interpolates
+between the two. The total, offset by the prior odds of a random in-block
+pair being a match, is turned into a probability. Names are compared by the
+Dice coefficient of character bigrams, computed for a whole block at once as
+a matrix product, so scoring is numpy work rather than per-pair Python.
+
+register_client reports candidates from LINKAGE_REVIEW_PROBABILITY (0.5)
+with the new client. With LINKAGE_ON_REGISTER=reject it instead refuses a
+record with a candidate at or above LINKAGE_MATCH_PROBABILITY (0.9) unless
+the caller confirms it. The batch dedupe job
+scores every block of the client table (and, to catch changed surnames,
+every group of clients born on the same day) and stores likely pairs in
+client_match. Blocks bigger than MAX_BLOCK_SIZE are sorted and scored in
+overlapping windows, so the job stays O(n * MAX_BLOCK_SIZE) rather than
+O(n^2).
+"""
+import math
+import re
+from datetime import date, datetime
+from itertools import groupby
+import numpy as np
+from flask import current_app
+from sqlalchemy import insert, select
+from models import db, Client, ClientMatch, link_key, normalize_name
+import jobs
+
+LINKAGE_MODES = ('reject', 'warn', 'off')
+DEFAULT_MATCH_PROBABILITY = 0.9
+DEFAULT_REVIEW_PROBABILITY = 0.5
+DEFAULT_MAX_CANDIDATES = 200
+MAX_BLOCK_SIZE = 1000
+BLOCK_OVERLAP = 100
+MATCH_INSERT_BATCH = 1000
+
+# (m, u) per compared field
+FIELD_PROBABILITIES = {
+    'first_name': (0.92, 0.01),
+    'last_name': (0.95, 0.005),
+    'date_of_birth': (0.97, 0.0005),
+    'gender': (0.98, 0.5),
+    'contact_number': (0.9, 0.0001),
+}
+# log2 odds that two clients sharing a block are the same person
+PRIOR_LOG2_ODDS = -14.0
+# Name similarity below NAME_DISAGREE counts as disagreement, above NAME_AGREE as agreement
+NAME_DISAGREE = 0.3
+NAME_AGREE = 0.8
+
+BIGRAM_DIM = 512
+PHONE_DIGITS = 9
+
+COLUMNS = (Client.id, Client.first_name_norm, Client.last_name_norm, Client.date_of_birth,
+           Client.gender, Client.contact_number)
+
+
+def _weights(field):
+    m, u = FIELD_PROBABILITIES[field]
+    return math.log2(m / u), math.log2((1 - m) / (1 - u))
+
+
+def init_app(app):
+    mode = app.config.get('LINKAGE_ON_REGISTER', 'warn')
+    if mode not in LINKAGE_MODES:
+        raise ValueError(f'LINKAGE_ON_REGISTER must be one of: {", ".join(LINKAGE_MODES)}')
+    app.extensions['linkage'] = {
+        'on_register': mode,
+        'match_probability': app.config.get('LINKAGE_MATCH_PROBABILITY', DEFAULT_MATCH_PROBABILITY),
+        'review_probability': app.config.get('LINKAGE_REVIEW_PROBABILITY', DEFAULT_REVIEW_PROBABILITY),
+        'max_candidates': app.config.get('LINKAGE_MAX_CANDIDATES', DEFAULT_MAX_CANDIDATES),
+    }
+
+
+def settings():
+    return current_app.extensions['linkage']
+
+
+# --- Vectorized comparison ---
+
+class Records:
+    """Columns of a set of clients as arrays ready for pairwise scoring"""
+
+    def __init__(self, rows):
+        rows = list(rows)
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.first = _bigrams([row[1] for row in rows])
+        self.last = _bigrams([row[2] for row in rows])
+        born = [_as_date(row[3]) for row in rows]
+        self.born = np.array([(d.year, d.month, d.day) if d else (0, 0, 0) for d in born],
+                             dtype=np.int32).reshape(len(rows), 3)
+        self.gender = np.array([(row[4] or '')[:1].lower() for row in rows])
+        self.phone = np.array([_phone(row[5]) for row in rows])
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def _as_date(value):
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _phone(value):
+    digits = re.sub(r'\D', '', value or '')
+    return digits[-PHONE_DIGITS:] if len(digits) >= 7 else ''
+
+
+def _bigrams(names):
+    """Binary hashed bigram vectors of names, with their bigram counts"""
+    vectors = np.zeros((len(names), BIGRAM_DIM), dtype=np.float32)
+    for i, name in enumerate(names):
+        padded = f' {name or ""} '
+        for a, b in zip(padded, padded[1:]):
+            vectors[i, (ord(a) * 131 + ord(b)) % BIGRAM_DIM] = 1.0
+    return vectors, vectors.sum(axis=1)
+
+
+def _dice(left, right):
+    (a, a_count), (b, b_count) = left, right
+    return 2 * (a @ b.T) / np.maximum(a_count[:, None] + b_count[None, :], 1)
+
+
+def _interpolate(field, similarity, low, high):
+    agree, disagree = _weights(field)
+    level = np.clip((similarity - low) / (high - low), 0.0, 1.0)
+    return disagree + (agree - disagree) * level
+
+
+def score(left, right):
+    """Matrix of match probabilities between every record of left and of right"""
+    straight = (_dice(left.first, right.first), _dice(left.last, right.last))
+    # Also try first and last name swapped, a common data entry error
+    crossed = (_dice(left.first, right.last), _dice(left.last, right.first))
+    swapped = crossed[0] + crossed[1] > straight[0] + straight[1]
+    first = np.where(swapped, crossed[0], straight[0])
+    last = np.where(swapped, crossed[1], straight[1])
+    weight = (_interpolate('first_name', first, NAME_DISAGREE, NAME_AGREE)
+              + _interpolate('last_name', last, NAME_DISAGREE, NAME_AGREE))
+
+    a, b = left.born[:, None, :], right.born[None, :, :]
+    equal = a == b
+    same = equal.sum(axis=2)
+    transposed = equal[..., 0] & (a[..., 1] == b[..., 2]) & (a[..., 2] == b[..., 1])
+    born = np.select([same == 3, transposed, same == 2], [1.0, 0.8, 0.6], 0.0)
+    weight += _interpolate('date_of_birth', born, 0.0, 1.0)
+
+    agree, disagree = _weights('gender')
+    weight += np.where(left.gender[:, None] == right.gender[None, :], agree, disagree)
+
+    # A phone number only counts when both records have one
+    agree, disagree = _weights('contact_number')
+    known = (left.phone[:, None] != '') & (right.phone[None, :] != '')
+    weight += np.where(known, np.where(left.phone[:, None] == right.phone[None, :], agree, disagree), 0.0)
+
+    return 1.0 / (1.0 + np.exp2(-(weight + PRIOR_LOG2_ODDS)))
+
+
+# --- Registration-time check ---
+
+def candidate_keys(first_name, last_name, date_of_birth):
+    """Blocks to search for a record: its own and the one it has with names swapped"""
+    keys = {link_key(last_name, date_of_birth), link_key(first_name, date_of_birth)}
+    keys.discard(None)
+    return sorted(keys)
+
+
+def find_matches(values, exclude_id=None, threshold=None):
+    """
+    Existing clients that are likely the same person as `values` (client
+    column values), best first, as [{'client': ..., 'probability': ...}].
+    """
+    state = settings()
+    threshold = state['review_probability'] if threshold is None else threshold
+    keys = candidate_keys(values['first_name'], values['last_name'], values['date_of_birth'])
+    if not keys:
+        return []
+    query = select(*COLUMNS, Client.first_name, Client.last_name).where(Client.link_key.in_(keys))
+    if exclude_id is not None:
+        query = query.where(Client.id != exclude_id)
+    # Newest first, so an oversized block still covers recent registrations
+    rows = db.session.execute(query.order_by(Client.id.desc()).limit(state['max_candidates'])).all()
+    if not rows:
+        return []
+
+    record = Records([(0, normalize_name(values['first_name']), normalize_name(values['last_name']),
+                       values['date_of_birth'], values['gender'], values.get('contact_number'))])
+    probabilities = score(record, Records(rows))[0]
+    matches = [
+        {
+            'client': {
+                'id': row.id,
+                'first_name': row.first_name,
+                'last_name': row.last_name,
+                'date_of_birth': row.date_of_birth.isoformat(),
+            },
+            'probability': round(float(probability), 4),
+        }
+        for row, probability in zip(rows, probabilities)
+        if probability >= threshold
+    ]
+    matches.sort(key=lambda match: (-match['probability'], match['client']['id']))
+    return matches
+
+
+def is_likely_duplicate(matches):
+    """Whether a find_matches result should stop a registration"""
+    return bool(matches) and matches[0]['probability'] >= settings()['match_probability']
+
+
+# --- Batch deduplication ---
+
+def _blocks(order_by, key):
+    """Yield Records for each run of clients sharing `key`, splitting oversized runs"""
+    rows = db.session.execute(
+        select(*COLUMNS, key).order_by(*order_by).execution_options(yield_per=MAX_BLOCK_SIZE)
+    )
+    for value, group in groupby(rows, key=lambda row: row[-1]):
+        if value is None:
+            continue
+        block = list(group)
+        if len(block) < 2:
+            continue
+        if len(block) <= MAX_BLOCK_SIZE:
+            yield Records(block)
+            continue
+        # Sorted neighbourhood: similar records sit close together after
+        # sorting, so overlapping windows find them without an n^2 comparison
+        block.sort(key=lambda row: (row[3] or date.min, row[2] or '', row[1] or ''))
+        step = MAX_BLOCK_SIZE - BLOCK_OVERLAP
+        for start in range(0, len(block) - BLOCK_OVERLAP, step):
+            yield Records(block[start:start + MAX_BLOCK_SIZE])
+
+
+def find_duplicates(threshold=None, progress=None):
+    """
+    Score every blocked pair of clients and return ({(id, id): probability},
+    counters). `progress(clients_done, total)` is called between blocks.
+    """
+    threshold = settings()['review_probability'] if threshold is None else threshold
+    total = db.session.query(Client.id).count()
+    pairs = {}
+    counters = {'blocks': 0, 'comparisons': 0}
+    passes = (
+        ((Client.link_key, Client.id), Client.link_key),
+        # Catches a changed or misspelt surname, which moves a client to another block
+        ((Client.date_of_birth, Client.id), Client.date_of_birth),
+    )
+    for number, (order_by, key) in enumerate(passes):
+        done = 0
+        for block in _blocks(order_by, key):
+            probabilities = score(block, block)
+            left, right = np.nonzero(np.triu(probabilities >= threshold, k=1))
+            for i, j in zip(left.tolist(), right.tolist()):
+                pair = tuple(sorted((int(block.ids[i]), int(block.ids[j]))))
+                pairs[pair] = max(pairs.get(pair, 0.0), float(probabilities[i, j]))
+            counters['blocks'] += 1
+            counters['comparisons'] += len(block) * (len(block) - 1) // 2
+            done += len(block)
+            if progress and counters['blocks'] % 100 == 0:
+                progress(number * total + min(done, total), 2 * total)
+    return pairs, counters
+
+
+def _clusters(pairs):
+    """Number of groups of clients connected by a matched pair"""
+    parent = {}
+
+    def root(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for a, b in pairs:
+        parent[root(a)] = root(b)
+    return len({root(node) for node in parent})
+
+
+def dedupe(threshold=None, progress=None):
+    """Replace the client_match table with the pairs found by find_duplicates"""
+    pairs, counters = find_duplicates(threshold, progress)
+    now = datetime.utcnow()
+    # Best matches get the lowest ids, so listings page through them first
+    ranked = sorted(pairs.items(), key=lambda item: (-item[1], item[0]))
+    db.session.query(ClientMatch).delete()
+    for start in range(0, len(ranked), MATCH_INSERT_BATCH):
+        db.session.execute(insert(ClientMatch), [
+            {'client_id': a, 'match_id': b, 'probability': round(probability, 4), 'found_at': now}
+            for (a, b), probability in ranked[start:start + MATCH_INSERT_BATCH]
+        ])
+    db.session.commit()
+    return dict(counters, pairs=len(pairs), groups=_clusters(pairs))
+
+
+@jobs.handler('dedupe-clients')
+def dedupe_job(context, threshold=None):
+    """Find likely duplicate clients across the whole table"""
+    return dedupe(threshold, progress=context.progress)
@@ -0,0 +1,251 @@
+"""
+In-place schema upgrades for existing databases.
+
+`db.create_all()` only creates missing tables, so columns and indexes added
+to models later never reach a database file that already exists. Each step
+here inspects the live schema and only does work when something is missing,
+so `upgrade` is safe to run on every start and on any older
+health_system.db.
+
+Run standalone with `python migrations.py [DATABASE_URL]`, or through
+`flask --app app upgrade-db`.
+"""
+import argparse
+import sys
+from sqlalchemy import create_engine, inspect, text
+from datetime import date, datetime
+from models import db, name_search_columns, link_key
+
+BACKFILL_BATCH_SIZE = 1000
+# Built only once no duplicate active enrollments remain (see --dedupe)
+ACTIVE_ENROLLMENT_INDEX = 'uq_enrollment_active_client_program'
+
+
+class MigrationError(RuntimeError):
+    """A step cannot be applied without manual intervention"""
+
+
+def _columns(connection, table):
+    return {column['name'] for column in inspect(connection).get_columns(table)}
+
+
+def has_index(engine, table, name):
+    return name in {index['name'] for index in inspect(engine).get_indexes(table)}
+
+
+def _rename_registration_date(connection):
+    # Early versions of the client table called registered_at registration_date
+    columns = _columns(connection, 'client')
+    if 'registration_date' in columns and 'registered_at' not in columns:
+        connection.execute(text('ALTER TABLE client RENAME COLUMN registration_date TO registered_at'))
+        return 'Renamed client.registration_date to registered_at'
+
+
+def _add_missing_columns(connection):
+    applied = []
+    for table in db.metadata.sorted_tables:
+        existing = _columns(connection, table.name)
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if column.primary_key or (not column.nullable and column.server_default is None):
+                raise MigrationError(f'Cannot add required column {table.name}.{column.name} in place')
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            applied.append(f'Added column {table.name}.{column.name}')
+    return '; '.join(applied) or None
+
+
+def _backfill_client_search_columns(connection):
+    filled = 0
+    while True:
+        rows = connection.execute(text(
+            'SELECT id, first_name, last_name FROM client '
+            'WHERE first_name_norm IS NULL OR last_name_norm IS NULL LIMIT :limit'
+        ), {'limit': BACKFILL_BATCH_SIZE}).all()
+        if not rows:
+            break
+        connection.execute(text(
+            'UPDATE client SET first_name_norm = :first_name_norm, '
+            'last_name_norm = :last_name_norm, name_phonetic = :name_phonetic WHERE id = :id'
+        ), [{'id': row.id, **name_search_columns(row.first_name, row.last_name)} for row in rows])
+        filled += len(rows)
+    if filled:
+        return f'Backfilled search columns for {filled} clients'
+
+
+def _backfill_client_link_keys(connection):
+    filled = 0
+    last_id = 0
+    while True:
+        # Rows whose key stays NULL (no usable last name) are passed by id
+        rows = connection.execute(text(
+            'SELECT id, last_name, date_of_birth FROM client '
+            'WHERE link_key IS NULL AND id > :last_id ORDER BY id LIMIT :limit'
+        ), {'last_id': last_id, 'limit': BACKFILL_BATCH_SIZE}).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        params = []
+        for row in rows:
+            born = row.date_of_birth
+            if isinstance(born, str):
+                born = date.fromisoformat(born)
+            key = link_key(row.last_name, born)
+            if key is not None:
+                params.append({'id': row.id, 'link_key': key})
+        if params:
+            connection.execute(text('UPDATE client SET link_key = :link_key WHERE id = :id'), params)
+            filled += len(params)
+    if filled:
+        return f'Backfilled record linkage keys for {filled} clients'
+
+
+def _backfill_row_versions(connection):
+    # Rows written before change tracking get versions above the clock, in id
+    # order, so the first sync after the upgrade picks them all up
+    if connection.execute(text('SELECT 1 FROM sync_clock WHERE id = 1')).first() is None:
+        connection.execute(text('INSERT INTO sync_clock (id, version, pruned_through) VALUES (1, 0, 0)'))
+    stamped = 0
+    for table in ('health_program', 'client', 'enrollment'):
+        top = connection.execute(text(
+            f'SELECT MAX(id), COUNT(*) FROM {table} WHERE row_version IS NULL'
+        )).one()
+        if not top[1]:
+            continue
+        clock = connection.execute(text('SELECT version FROM sync_clock WHERE id = 1')).scalar()
+        connection.execute(text(f'UPDATE {table} SET row_version = :clock + id WHERE row_version IS NULL'),
+                           {'clock': clock})
+        connection.execute(text('UPDATE sync_clock SET version = :version WHERE id = 1'),
+                           {'version': clock + top[0]})
+        stamped += top[1]
+    if stamped:
+        return f'Stamped sync versions on {stamped} existing rows'
+
+
+def _duplicate_active_enrollments(connection):
+    return connection.execute(text(
+        "SELECT e.id FROM enrollment e WHERE e.status = 'active' AND EXISTS ("
+        "  SELECT 1 FROM enrollment o WHERE o.client_id = e.client_id"
+        "  AND o.program_id = e.program_id AND o.status = 'active' AND o.id < e.id)"
+    )).scalars().all()
+
+
+def _create_missing_indexes(connection, dedupe=False):
+    applied = []
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.unique):
+            if index.name in existing:
+                continue
+            if index.unique and table.name == 'enrollment':
+                duplicates = _duplicate_active_enrollments(connection)
+                if duplicates and not dedupe:
+                    raise MigrationError(
+                        f'{len(duplicates)} enrollments duplicate an earlier active enrollment '
+                        f'(ids {", ".join(map(str, duplicates[:20]))}); rerun with --dedupe '
+                        f'to suspend them before creating {index.name}'
+                    )
+                if duplicates:
+                    connection.execute(text(
+                        "UPDATE enrollment SET status = 'suspended', notes = "
+                        "COALESCE(notes || ' ', '') || '[suspended: duplicate active enrollment]' "
+                        "WHERE id = :id"
+                    ), [{'id': enrollment_id} for enrollment_id in duplicates])
+                    _record_suspensions(connection, duplicates)
+                    applied.append(f'Suspended {len(duplicates)} duplicate active enrollments')
+            index.create(connection)
+            applied.append(f'Created index {index.name}')
+    return '; '.join(applied) or None
+
+
+def _record_suspensions(connection, enrollment_ids):
+    # The history was backfilled before this step; close the active spans so
+    # the suspension shows up as a change made now
+    now = datetime.utcnow()
+    rows = [{'id': enrollment_id, 'now': now} for enrollment_id in enrollment_ids]
+    connection.execute(text(
+        'UPDATE enrollment_status_interval SET ends_at = :now WHERE enrollment_id = :id AND ends_at IS NULL'
+    ), rows)
+    connection.execute(text(
+        'INSERT INTO enrollment_status_event (enrollment_id, status, effective_at, recorded_at) '
+        "VALUES (:id, 'suspended', :now, :now)"
+    ), rows)
+    connection.execute(text(
+        'INSERT INTO enrollment_status_interval (enrollment_id, program_id, status, starts_at, ends_at) '
+        "SELECT id, program_id, 'suspended', :now, NULL FROM enrollment WHERE id = :id"
+    ), rows)
+
+
+def _backfill_status_history(connection):
+    # Enrollments from before history was kept hold their current status from
+    # their enrollment date. Runs before the index step, which can stop on
+    # duplicate active enrollments; --dedupe then records its suspensions
+    pending = ('FROM enrollment e WHERE NOT EXISTS '
+               '(SELECT 1 FROM enrollment_status_interval i WHERE i.enrollment_id = e.id)')
+    now = {'now': datetime.utcnow()}
+    connection.execute(text(
+        'INSERT INTO enrollment_status_event (enrollment_id, status, effective_at, recorded_at) '
+        "SELECT e.id, COALESCE(e.status, 'active'), COALESCE(e.enrollment_date, :now), :now " + pending
+    ), now)
+    filled = connection.execute(text(
+        'INSERT INTO enrollment_status_interval (enrollment_id, program_id, status, starts_at, ends_at) '
+        "SELECT e.id, e.program_id, COALESCE(e.status, 'active'), COALESCE(e.enrollment_date, :now), NULL "
+        + pending
+    ), now).rowcount
+    if filled:
+        return f'Backfilled status history for {filled} enrollments'
+
+
+def upgrade(engine, dedupe=False):
+    """
+    Bring an existing database up to the current models. Returns a list of
+    the changes made; raises MigrationError if a step needs intervention.
+    """
+    steps = [
+        _rename_registration_date,
+        _add_missing_columns,
+        _backfill_client_search_columns,
+        _backfill_client_link_keys,
+        _backfill_row_versions,
+        _backfill_status_history,
+        lambda connection: _create_missing_indexes(connection, dedupe),
+    ]
+    db.metadata.create_all(engine)
+    applied = []
+    for step in steps:
+        # Each step commits on its own so a later failure keeps earlier progress
+        with engine.begin() as connection:
+            message = step(connection)
+        if message:
+            applied.append(message)
+    return applied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Upgrade a database to the current schema')
+    parser.add_argument('database', nargs='?', default='sqlite:///instance/health_system.db',
+                        help='SQLAlchemy URL (default: %(default)s)')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Suspend duplicate active enrollments so the unique index can be built')
+    args = parser.parse_args(argv)
+
+    engine = create_engine(args.database)
+    try:
+        applied = upgrade(engine, dedupe=args.dedupe)
+    except MigrationError as exc:
+        print(f'Migration failed: {exc}', file=sys.stderr)
+        return 1
+    for message in applied:
+        print(message)
+    if applied:
+        # Counters live in the app layer; they are reseeded or reconciled there
+        print('Upgrade complete; run `flask --app app reconcile-counters` to refresh stat counters')
+    else:
+        print('Database is up to date')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,65 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+import json
+import unicodedata
+from sqlalchemy import event
 from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
 
+ENROLLMENT_STATUSES = ('active', 'completed', 'suspended')
+
+_SOUNDEX_CODES = {
+    **dict.fromkeys('bfpv', '1'),
+    **dict.fromkeys('cgjkqsxz', '2'),
+    **dict.fromkeys('dt', '3'),
+    'l': '4',
+    **dict.fromkeys('mn', '5'),
+    'r': '6',
+}
+
+def normalize_name(value):
+    """Lower-case, strip accents and collapse whitespace for indexed name search"""
+    if not value:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', value)
+    stripped = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return ' '.join(stripped.lower().split())
+
+def soundex(token):
+    """American Soundex code of a single normalized name token"""
+    letters = [ch for ch in token if ch.isalpha()]
+    if not letters:
+        return ''
+    code = letters[0].upper()
+    previous = _SOUNDEX_CODES.get(letters[0], '')
+    for ch in letters[1:]:
+        digit = _SOUNDEX_CODES.get(ch, '')
+        if digit and digit != previous:
+            code += digit
+        # h and w do not separate letters with the same code
+        if ch not in 'hw':
+            previous = digit
+    return (code + '000')[:4]
+
+def name_search_columns(first_name, last_name):
+    """Derived search columns for a client name, shared by ORM and bulk writes"""
+    first_norm = normalize_name(first_name)
+    last_norm = normalize_name(last_name)
+    tokens = (first_norm + ' ' + last_norm).split()
+    return {
+        'first_name_norm': first_norm,
+        'last_name_norm': last_norm,
+        'name_phonetic': ' '.join(soundex(token) for token in tokens)
+    }
+
+def link_key(name, date_of_birth):
+    """Record linkage blocking key: Soundex of a name plus birth year, e.g. 'S530:1985'"""
+    code = soundex(normalize_name(name).replace(' ', ''))
+    if not code or date_of_birth is None:
+        return None
+    return f'{code}:{date_of_birth.year}'
+
 class User(db.Model):
     """User model for doctors/staff who access the system"""
     id = db.Column(db.Integer, primary_key=True)
@@ -39,12 +95,29 @@ class User(db.Model):
 class Enrollment(db.Model):
     """Detailed enrollment model instead of using association table"""
     id = db.Column(db.Integer, primary_key=True)
-    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
-    program_id = db.Column(db.Integer, db.ForeignKey('health_program.id'), nullable=False)
+    # ON DELETE takes effect on databases created with this schema; deletes.py
+    # removes dependent rows itself so older files behave the same
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id', ondelete='CASCADE'), nullable=False)
+    program_id = db.Column(db.Integer, db.ForeignKey('health_program.id', ondelete='CASCADE'), nullable=False)
     enrollment_date = db.Column(db.DateTime, default=datetime.utcnow)
     status = db.Column(db.String(20), default='active')  # active, completed, suspended
     notes = db.Column(db.Text)
-    enrolled_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    enrolled_by = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
+    # Sync clock value of the last write (see sync.py)
+    row_version = db.Column(db.Integer)
+    
+    __table_args__ = (
+        db.Index('ix_enrollment_client_program_status', 'client_id', 'program_id', 'status'),
+        db.Index('ix_enrollment_row_version', 'row_version'),
+        db.Index('ix_enrollment_program_status', 'program_id', 'status'),
+        # Cohort conditions on recent enrollments in a program
+        db.Index('ix_enrollment_program_date', 'program_id', 'enrollment_date'),
+        # At most one active enrollment per client and program; inserts that
+        # would duplicate one fail atomically instead of relying on a pre-check
+        db.Index('uq_enrollment_active_client_program', 'client_id', 'program_id', unique=True,
+                 sqlite_where=db.text("status = 'active'"),
+                 postgresql_where=db.text("status = 'active'")),
+    )
     
     # Relationships
     client = db.relationship('Client', back_populates='enrollments')
@@ -63,6 +136,59 @@ class Enrollment(db.Model):
             'enrolled_by': self.enrolled_by
         }
 
+class EnrollmentStatusEvent(db.Model):
+    """Append-only log of the status an enrollment starts with and every change after it"""
+    __tablename__ = 'enrollment_status_event'
+
+    id = db.Column(db.Integer, primary_key=True)
+    enrollment_id = db.Column(db.Integer, db.ForeignKey('enrollment.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    # When the status took effect, and when the change was written
+    effective_at = db.Column(db.DateTime, nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_status_event_enrollment', 'enrollment_id', 'effective_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'status': self.status,
+            'effective_at': self.effective_at.isoformat(),
+            'recorded_at': self.recorded_at.isoformat()
+        }
+
+class EnrollmentStatusInterval(db.Model):
+    """
+    The same history as spans: one row per status an enrollment held, from
+    starts_at until ends_at (NULL while it is the current status)
+    """
+    __tablename__ = 'enrollment_status_interval'
+
+    id = db.Column(db.Integer, primary_key=True)
+    enrollment_id = db.Column(db.Integer, db.ForeignKey('enrollment.id', ondelete='CASCADE'), nullable=False)
+    program_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    starts_at = db.Column(db.DateTime, nullable=False)
+    ends_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # Covering indexes: "held status S in program P at time T" and spells
+        # starting or ending in a window are range scans that never touch rows
+        db.Index('ix_status_interval_program_start', 'program_id', 'status', 'starts_at', 'ends_at'),
+        db.Index('ix_status_interval_end', 'status', 'ends_at', 'program_id'),
+        db.Index('ix_status_interval_enrollment', 'enrollment_id', 'ends_at'),
+        # Enrollment listings with ?as_of= page through a program and status in id order
+        db.Index('ix_status_interval_listing', 'program_id', 'status', 'enrollment_id', 'starts_at', 'ends_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'status': self.status,
+            'starts_at': self.starts_at.isoformat(),
+            'ends_at': self.ends_at.isoformat() if self.ends_at else None
+        }
+
 class Client(db.Model):
     __tablename__ = 'client'
     
@@ -74,11 +200,27 @@ class Client(db.Model):
     contact_number = db.Column(db.String(20))
     email = db.Column(db.String(100))
     address = db.Column(db.Text)
-    registered_at = db.Column(db.DateTime, default=datetime.utcnow)
-    registered_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    registered_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    registered_by = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
+    
+    # Search columns, kept in sync with the names on every flush
+    first_name_norm = db.Column(db.String(50))
+    last_name_norm = db.Column(db.String(50))
+    name_phonetic = db.Column(db.String(100))
+    # Duplicate detection candidates share this key (see linkage.py)
+    link_key = db.Column(db.String(20))
+    # Sync clock value of the last write (see sync.py)
+    row_version = db.Column(db.Integer)
+    
+    __table_args__ = (
+        db.Index('ix_client_row_version', 'row_version'),
+        db.Index('ix_client_last_first_norm', 'last_name_norm', 'first_name_norm'),
+        db.Index('ix_client_first_name_norm', 'first_name_norm'),
+        db.Index('ix_client_link_key', 'link_key'),
+    )
     
     # Relationships
-    enrollments = db.relationship('Enrollment', backref='client', lazy=True)
+    enrollments = db.relationship('Enrollment', back_populates='client', lazy=True)
     
     def to_dict(self):
         return {
@@ -108,26 +250,52 @@ class Client(db.Model):
             'date_of_birth': self.date_of_birth.isoformat() if self.date_of_birth else None,
         }
 
+    def to_dict_summary(self):
+        """Basic client data plus active programs; expects enrollments to be eager loaded"""
+        programs = [
+            {'id': e.program.id, 'name': e.program.name}
+            for e in self.enrollments
+            if e.status == 'active'
+        ]
+        return {
+            **self.to_dict_basic(),
+            'gender': self.gender,
+            'programs': programs,
+            'program_count': len(programs)
+        }
+
+@event.listens_for(Client, 'before_insert')
+@event.listens_for(Client, 'before_update')
+def _sync_client_search_columns(mapper, connection, target):
+    for key, value in name_search_columns(target.first_name, target.last_name).items():
+        setattr(target, key, value)
+    target.link_key = link_key(target.last_name, target.date_of_birth)
+
 class HealthProgram(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
     description = db.Column(db.Text)
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
-    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
+    # Sync clock value of the last write (see sync.py)
+    row_version = db.Column(db.Integer, index=True)
     
     # Relationships
     enrollments = db.relationship('Enrollment', back_populates='program', cascade='all, delete-orphan')
     creator = db.relationship('User')
     
-    def to_dict(self):
-        active_enrollments = [e for e in self.enrollments if e.status == 'active']
+    def to_dict(self, client_count=None):
+        # Listings pass client_count from one grouped query over the whole page;
+        # otherwise count here rather than loading every enrollment
+        if client_count is None:
+            client_count = Enrollment.query.filter_by(program_id=self.id, status='active').count()
         return {
             'id': self.id,
             'name': self.name,
             'description': self.description,
             'created_date': self.created_date.isoformat(),
             'created_by': self.created_by,
-            'client_count': len(active_enrollments)
+            'client_count': client_count
         }
         
     def to_dict_basic(self):
@@ -135,4 +303,202 @@ class HealthProgram(db.Model):
             'id': self.id,
             'name': self.name,
             'description': self.description
-        }
\ No newline at end of file
+        }
+
+class StatCounter(db.Model):
+    """Incrementally maintained dashboard counter, keyed like 'enrollments:status:active'"""
+    __tablename__ = 'stat_counter'
+    
+    key = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class AnalyticsResult(db.Model):
+    """Materialized analytics payload, keyed like 'incidence:week:2024-01-01:2024-03-31:all'"""
+    __tablename__ = 'analytics_result'
+
+    key = db.Column(db.String(255), primary_key=True)
+    payload = db.Column(db.Text, nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class EnrollmentRollup(db.Model):
+    """Enrollment counts per program, enrollment day, status, age band at enrollment and gender"""
+    __tablename__ = 'enrollment_rollup'
+
+    program_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    age_band = db.Column(db.String(10), primary_key=True)
+    gender = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_enrollment_rollup_day', 'day'),
+    )
+
+class ClientRollup(db.Model):
+    """Client registrations per day, age band at registration and gender"""
+    __tablename__ = 'client_rollup'
+
+    day = db.Column(db.Date, primary_key=True)
+    age_band = db.Column(db.String(10), primary_key=True)
+    gender = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class RollupWatermark(db.Model):
+    """First day of a rollup that is recomputed on the next refresh"""
+    __tablename__ = 'rollup_watermark'
+
+    name = db.Column(db.String(50), primary_key=True)
+    day = db.Column(db.Date)
+
+class ClientMatch(db.Model):
+    """Pair of clients the batch dedupe job found likely to be the same person"""
+    __tablename__ = 'client_match'
+
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, nullable=False)
+    match_id = db.Column(db.Integer, nullable=False)  # always greater than client_id
+    probability = db.Column(db.Float, nullable=False)
+    found_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('uq_client_match_pair', 'client_id', 'match_id', unique=True),
+        db.Index('ix_client_match_match_id', 'match_id'),
+    )
+
+class ProgramArchive(db.Model):
+    """Health program removed with ?archive=1, moved here by deletes.py"""
+    __tablename__ = 'program_archive'
+
+    archive_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.Text)
+    created_date = db.Column(db.DateTime)
+    created_by = db.Column(db.Integer)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class ClientArchive(db.Model):
+    """Client removed with ?archive=1, moved here by deletes.py"""
+    __tablename__ = 'client_archive'
+
+    archive_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, nullable=False, index=True)
+    first_name = db.Column(db.String(50), nullable=False)
+    last_name = db.Column(db.String(50), nullable=False)
+    date_of_birth = db.Column(db.Date, nullable=False)
+    gender = db.Column(db.String(20), nullable=False)
+    contact_number = db.Column(db.String(20))
+    email = db.Column(db.String(100))
+    address = db.Column(db.Text)
+    registered_at = db.Column(db.DateTime)
+    registered_by = db.Column(db.Integer)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class EnrollmentArchive(db.Model):
+    """Enrollment removed with its client or program under ?archive=1"""
+    __tablename__ = 'enrollment_archive'
+
+    archive_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, nullable=False, index=True)
+    client_id = db.Column(db.Integer, nullable=False, index=True)
+    program_id = db.Column(db.Integer, nullable=False)
+    enrollment_date = db.Column(db.DateTime)
+    status = db.Column(db.String(20))
+    notes = db.Column(db.Text)
+    enrolled_by = db.Column(db.Integer)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class EnrollmentStatusEventArchive(db.Model):
+    """Status event of an enrollment archived with its client or program"""
+    __tablename__ = 'enrollment_status_event_archive'
+
+    archive_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, nullable=False)
+    enrollment_id = db.Column(db.Integer, nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False)
+    effective_at = db.Column(db.DateTime, nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class EnrollmentStatusIntervalArchive(db.Model):
+    """Status span of an enrollment archived with its client or program"""
+    __tablename__ = 'enrollment_status_interval_archive'
+
+    archive_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, nullable=False)
+    enrollment_id = db.Column(db.Integer, nullable=False, index=True)
+    program_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    starts_at = db.Column(db.DateTime, nullable=False)
+    ends_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class SyncClock(db.Model):
+    """Single-row counter that stamps row_version on every synced write"""
+    __tablename__ = 'sync_clock'
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    # Tombstones at or below this version have been pruned
+    pruned_through = db.Column(db.Integer, nullable=False, default=0)
+
+class Tombstone(db.Model):
+    """Deleted client, program or enrollment, kept so devices can drop their copy"""
+    __tablename__ = 'tombstone'
+
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)  # client, program, enrollment
+    entity_id = db.Column(db.Integer, nullable=False)
+    row_version = db.Column(db.Integer, nullable=False, index=True)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class SyncUpload(db.Model):
+    """Server id given to a record created offline, so a re-sent upload is not applied twice"""
+    __tablename__ = 'sync_upload'
+
+    device_id = db.Column(db.String(100), primary_key=True)
+    entity = db.Column(db.String(20), primary_key=True)
+    local_id = db.Column(db.String(100), primary_key=True)
+    entity_id = db.Column(db.Integer, nullable=False)
+    uploaded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class Job(db.Model):
+    """Long-running operation queued with jobs.submit and run by a job worker"""
+    __tablename__ = 'job'
+
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, succeeded, failed, cancelled
+    dedupe_key = db.Column(db.String(255))
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    worker = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_job_status_created', 'status', 'created_at'),
+        db.Index('ix_job_dedupe_key', 'dedupe_key'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'cancel_requested': self.cancel_requested,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
@@ -0,0 +1,103 @@
+"""Keyset (cursor) pagination and field projection for collection endpoints"""
+import base64
+import binascii
+from flask import request, current_app
+from serialization import RowShape
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class PaginationError(ValueError):
+    """Raised when limit/after/fields query parameters are malformed"""
+
+
+def encode_cursor(value):
+    """Turn the last seen sort key into an opaque cursor token"""
+    return base64.urlsafe_b64encode(str(value).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Recover the sort key from a cursor token produced by encode_cursor"""
+    padded = token + '=' * (-len(token) % 4)
+    try:
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise PaginationError('Invalid cursor')
+
+
+def column_map(model, exclude=()):
+    """Map of public field name -> column for a model, used to validate fields="""
+    return {
+        column.name: getattr(model, column.key)
+        for column in model.__table__.columns
+        if column.name not in exclude
+    }
+
+
+def parse_limit(value):
+    default = current_app.config.get('PAGE_SIZE_DEFAULT', DEFAULT_PAGE_SIZE)
+    maximum = current_app.config.get('PAGE_SIZE_MAX', MAX_PAGE_SIZE)
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise PaginationError('limit must be an integer')
+    if limit < 1:
+        raise PaginationError('limit must be positive')
+    return min(limit, maximum)
+
+
+def _parse_fields(value, allowed):
+    if not value:
+        return None
+    fields = [f.strip() for f in value.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise PaginationError(f'Unknown fields: {", ".join(unknown)}')
+    # The key is always returned so the caller can correlate rows
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+    return fields
+
+
+def paginate(query, key, serialize, allowed_fields, serialize_page=None, shape=None):
+    """
+    Apply keyset pagination to an ORM query using the `limit`, `after` and
+    `fields` request arguments.
+
+    With a `shape` (a serialization.RowShape) only its columns are selected
+    and rows are returned as plain dicts; otherwise each entity is passed
+    through `serialize` (or the whole page through `serialize_page`, for
+    serializers that batch per-page lookups). `fields` narrows the response
+    to the requested columns either way. Returns the response envelope
+    `{'items': [...], 'next_cursor': token-or-None}`.
+    """
+    limit = parse_limit(request.args.get('limit'))
+    fields = _parse_fields(request.args.get('fields'), allowed_fields)
+    after = request.args.get('after')
+
+    if after:
+        query = query.filter(key > decode_cursor(after))
+    if fields:
+        shape = RowShape(*[allowed_fields[f] for f in fields], names=fields)
+    if shape is not None:
+        query = query.with_entities(*shape.columns)
+
+    # Fetch one extra row to learn whether another page exists
+    rows = query.order_by(key).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if shape is not None:
+        items = shape.dump(rows)
+        last_key = rows[-1][shape.index(key.key)] if rows else None
+    else:
+        items = serialize_page(rows) if serialize_page else [serialize(row) for row in rows]
+        last_key = getattr(rows[-1], key.key) if rows else None
+
+    return {
+        'items': items,
+        'next_cursor': encode_cursor(last_key) if has_more else None
+    }
@@ -0,0 +1,278 @@
+"""
+Pre-aggregated rollup tables for reporting.
+
+enrollment_rollup holds enrollment counts per (program, enrollment day,
+status, age band at enrollment, gender) and client_rollup holds
+registrations per (registration day, age band, gender). Reports read a few
+thousand rollup rows instead of joining every enrollment to its client.
+
+Each rollup has a watermark day in rollup_watermark:
+- Days before the watermark are final. ORM writes that touch them (deletes
+  through the delete routes, status or program changes, back-dated inserts)
+  adjust the rollup in the same transaction from a before_flush hook.
+- Days from the watermark on are recomputed by refresh() from the base
+  tables with one INSERT ... SELECT ... GROUP BY, after which the watermark
+  moves to today. Normally that is only today's rows.
+
+Core inserts that bypass the ORM (bulk imports) call reopen() to move the
+watermark back to the earliest day they wrote. rebuild() recomputes
+everything and check() compares the rollups with the base tables.
+"""
+from collections import Counter
+from datetime import date, datetime
+from flask import current_app, has_app_context
+from sqlalchemy import Date, bindparam, case, event, extract, func, insert, inspect, select, text
+from sqlalchemy.orm import Session
+from models import db, Client, Enrollment, EnrollmentRollup, ClientRollup, RollupWatermark
+
+# Lower bounds of the age bands, in years
+AGE_BANDS = (0, 5, 15, 25, 50, 65)
+AGE_BAND_LABELS = ('0-4', '5-14', '15-24', '25-49', '50-64', '65+')
+
+ROLLUPS = ('enrollment', 'client')
+
+_UPSERTS = {
+    'enrollment': text(
+        'INSERT INTO enrollment_rollup (program_id, day, status, age_band, gender, count) '
+        'VALUES (:program_id, :day, :status, :age_band, :gender, :delta) '
+        'ON CONFLICT (program_id, day, status, age_band, gender) '
+        'DO UPDATE SET count = enrollment_rollup.count + excluded.count'
+    ).bindparams(bindparam('day', type_=Date)),
+    'client': text(
+        'INSERT INTO client_rollup (day, age_band, gender, count) '
+        'VALUES (:day, :age_band, :gender, :delta) '
+        'ON CONFLICT (day, age_band, gender) DO UPDATE SET count = client_rollup.count + excluded.count'
+    ).bindparams(bindparam('day', type_=Date)),
+}
+
+
+def init_app(app):
+    app.extensions['rollups'] = {'enabled': app.config.get('ROLLUPS_ENABLED', True)}
+
+
+def rollups_enabled():
+    return has_app_context() and current_app.extensions.get('rollups', {}).get('enabled', False)
+
+
+def age_band(age):
+    """Label of the band an age in whole years falls in"""
+    label = AGE_BAND_LABELS[0]
+    for lower, band in zip(AGE_BANDS, AGE_BAND_LABELS):
+        if age >= lower:
+            label = band
+    return label
+
+
+def _age_band_sql(at, date_of_birth):
+    age = extract('year', at) - extract('year', date_of_birth)
+    return case(
+        *[(age < upper, label) for upper, label in zip(AGE_BANDS[1:], AGE_BAND_LABELS)],
+        else_=AGE_BAND_LABELS[-1]
+    )
+
+
+def _grouped(name, since=None):
+    """SELECT of rollup columns and counts from the base tables, from `since` on"""
+    if name == 'enrollment':
+        day = func.date(Enrollment.enrollment_date)
+        band = _age_band_sql(Enrollment.enrollment_date, Client.date_of_birth)
+        status = func.coalesce(Enrollment.status, 'active')
+        query = select(Enrollment.program_id, day, status, band, Client.gender, func.count(Enrollment.id)) \
+            .join(Client, Client.id == Enrollment.client_id) \
+            .group_by(Enrollment.program_id, day, status, band, Client.gender)
+        if since is not None:
+            query = query.where(Enrollment.enrollment_date >= datetime.combine(since, datetime.min.time()))
+        return query
+    day = func.date(Client.registered_at)
+    band = _age_band_sql(Client.registered_at, Client.date_of_birth)
+    query = select(day, band, Client.gender, func.count(Client.id)).group_by(day, band, Client.gender)
+    if since is not None:
+        query = query.where(Client.registered_at >= datetime.combine(since, datetime.min.time()))
+    return query
+
+
+def _table(name):
+    return EnrollmentRollup if name == 'enrollment' else ClientRollup
+
+
+def _columns(name):
+    if name == 'enrollment':
+        return ['program_id', 'day', 'status', 'age_band', 'gender', 'count']
+    return ['day', 'age_band', 'gender', 'count']
+
+
+def watermark(name, connection=None):
+    """First non-final day of a rollup, or None if it has never been built"""
+    if connection is not None:
+        return connection.execute(
+            select(RollupWatermark.day).where(RollupWatermark.name == name)
+        ).scalar()
+    row = db.session.get(RollupWatermark, name)
+    return row.day if row is not None else None
+
+
+def _set_watermark(name, day):
+    db.session.merge(RollupWatermark(name=name, day=day))
+
+
+def refresh(names=ROLLUPS):
+    """Recompute the rollup days from each watermark on and advance it to today"""
+    today = datetime.utcnow().date()
+    refreshed = {}
+    for name in names:
+        since = watermark(name)
+        table = _table(name)
+        query = db.session.query(table)
+        if since is not None:
+            query = query.filter(table.day >= since)
+        query.delete(synchronize_session=False)
+        columns = _columns(name)
+        db.session.execute(
+            insert(table.__table__).from_select(columns, _grouped(name, since))
+        )
+        _set_watermark(name, today)
+        refreshed[name] = since
+    db.session.commit()
+    return refreshed
+
+
+def rebuild(names=ROLLUPS):
+    """Recompute every rollup from scratch in one transaction"""
+    for name in names:
+        db.session.query(RollupWatermark).filter_by(name=name).delete()
+    return refresh(names)
+
+
+def reopen(name, day):
+    """Make `day` and everything after it be recomputed by the next refresh"""
+    current = watermark(name)
+    if current is not None and day is not None and day < current:
+        _set_watermark(name, day)
+        db.session.commit()
+
+
+def remove(name, condition):
+    """
+    Take rows about to be deleted with a set-based DELETE (those matching
+    `condition`) out of the final days of a rollup; later days are
+    recomputed by the next refresh anyway.
+    """
+    since = watermark(name)
+    if since is None:
+        return
+    day = Enrollment.enrollment_date if name == 'enrollment' else Client.registered_at
+    query = _grouped(name).where(condition, day < datetime.combine(since, datetime.min.time()))
+    params = [dict(zip(_columns(name)[:-1], row[:-1]), delta=-row[-1]) for row in db.session.execute(query)]
+    for values in params:
+        values['day'] = date.fromisoformat(values['day'])
+    if params:
+        db.session.execute(_UPSERTS[name], params)
+
+
+def check(names=ROLLUPS):
+    """Return {(rollup, key...): (stored, expected)} for every final row that disagrees with the base tables"""
+    drift = {}
+    for name in names:
+        since = watermark(name)
+        if since is None:
+            continue
+        table = _table(name)
+        key_columns = [getattr(table, column) for column in _columns(name)[:-1]]
+        stored = {
+            tuple(str(v) for v in row[:-1]): row[-1]
+            for row in db.session.query(*key_columns, table.count).filter(table.day < since)
+        }
+        expected = {}
+        for row in db.session.execute(_grouped(name)):
+            key = tuple(str(v) for v in row[:-1])
+            # Only days before the watermark are expected to be current
+            day = key[1] if name == 'enrollment' else key[0]
+            if day < since.isoformat():
+                expected[key] = row[-1]
+        for key in set(stored) | set(expected):
+            if stored.get(key, 0) != expected.get(key, 0):
+                drift[(name,) + key] = (stored.get(key, 0), expected.get(key, 0))
+    return drift
+
+
+# --- Transactional maintenance of final days ---
+
+def _day(value):
+    return (value or datetime.utcnow()).date()
+
+
+def _enrollment_key(session, enrollment, program_id, status, enrolled_at):
+    client = session.get(Client, enrollment.client_id)
+    if client is None:
+        return None
+    day = _day(enrolled_at)
+    return (program_id, day, status or 'active',
+            age_band(day.year - client.date_of_birth.year), client.gender)
+
+
+def _client_key(client):
+    day = _day(client.registered_at)
+    return (day, age_band(day.year - client.date_of_birth.year), client.gender)
+
+
+@event.listens_for(Session, 'before_flush')
+def _track_rollups(session, flush_context, instances):
+    if not rollups_enabled():
+        return
+    changed = [obj for obj in list(session.new) + list(session.deleted) + list(session.dirty)
+               if isinstance(obj, (Client, Enrollment))]
+    if not changed:
+        return
+
+    connection = session.connection()
+    marks = {name: watermark(name, connection) for name in ROLLUPS}
+    deltas = {name: Counter() for name in ROLLUPS}
+
+    def track(name, key, delta):
+        # Days from the watermark on are picked up by the next refresh
+        if key is not None and marks[name] is not None and key[1 if name == 'enrollment' else 0] < marks[name]:
+            deltas[name][key] += delta
+
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, Enrollment):
+                track('enrollment', _enrollment_key(session, obj, obj.program_id, obj.status,
+                                                    obj.enrollment_date), 1)
+            elif isinstance(obj, Client) and obj.date_of_birth is not None:
+                track('client', _client_key(obj), 1)
+
+        for obj in session.deleted:
+            if isinstance(obj, Enrollment):
+                state = inspect(obj)
+                status = state.attrs.status.history
+                program = state.attrs.program_id.history
+                enrolled = state.attrs.enrollment_date.history
+                track('enrollment', _enrollment_key(
+                    session, obj,
+                    program.deleted[0] if program.deleted else obj.program_id,
+                    status.deleted[0] if status.deleted else obj.status,
+                    enrolled.deleted[0] if enrolled.deleted else obj.enrollment_date), -1)
+            elif isinstance(obj, Client):
+                track('client', _client_key(obj), -1)
+
+        for obj in session.dirty:
+            if not isinstance(obj, Enrollment) or obj in session.deleted:
+                continue
+            state = inspect(obj)
+            status = state.attrs.status.history
+            program = state.attrs.program_id.history
+            enrolled = state.attrs.enrollment_date.history
+            if not (status.has_changes() or program.has_changes() or enrolled.has_changes()):
+                continue
+            track('enrollment', _enrollment_key(
+                session, obj,
+                program.deleted[0] if program.deleted else obj.program_id,
+                status.deleted[0] if status.deleted else obj.status,
+                enrolled.deleted[0] if enrolled.deleted else obj.enrollment_date), -1)
+            track('enrollment', _enrollment_key(session, obj, obj.program_id, obj.status,
+                                                obj.enrollment_date), 1)
+
+    for name, counter in deltas.items():
+        params = [dict(zip(_columns(name)[:-1], key), delta=delta) for key, delta in counter.items() if delta]
+        if params:
+            connection.execute(_UPSERTS[name], params)
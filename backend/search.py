@@ -0,0 +1,219 @@
+"""
+Client name search.
+
+Prefix search runs against the normalized, indexed name columns on `client`
+as index range scans. On SQLite an FTS5 index over the same columns (plus a
+Soundex column for phonetic matches) is maintained by triggers, so any write
+path, ORM or bulk, keeps it in sync.
+"""
+from flask import request, current_app
+from sqlalchemy import text, and_, or_
+from models import db, Client, normalize_name, soundex
+from pagination import paginate, parse_limit
+
+SEARCH_MODES = ('prefix', 'fts', 'contains')
+RANK_ORDERS = ('id', 'name', 'relevance')
+
+_FTS_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS client_fts USING fts5(
+        first_name_norm, last_name_norm, name_phonetic,
+        content='client', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS client_fts_ai AFTER INSERT ON client BEGIN
+        INSERT INTO client_fts(rowid, first_name_norm, last_name_norm, name_phonetic)
+        VALUES (new.id, new.first_name_norm, new.last_name_norm, new.name_phonetic);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS client_fts_ad AFTER DELETE ON client BEGIN
+        INSERT INTO client_fts(client_fts, rowid, first_name_norm, last_name_norm, name_phonetic)
+        VALUES ('delete', old.id, old.first_name_norm, old.last_name_norm, old.name_phonetic);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS client_fts_au
+    AFTER UPDATE OF first_name_norm, last_name_norm, name_phonetic ON client BEGIN
+        INSERT INTO client_fts(client_fts, rowid, first_name_norm, last_name_norm, name_phonetic)
+        VALUES ('delete', old.id, old.first_name_norm, old.last_name_norm, old.name_phonetic);
+        INSERT INTO client_fts(rowid, first_name_norm, last_name_norm, name_phonetic)
+        VALUES (new.id, new.first_name_norm, new.last_name_norm, new.name_phonetic);
+    END
+    """,
+]
+
+
+class SearchError(ValueError):
+    """Raised for unsupported search mode/rank combinations"""
+
+
+def init_app(app):
+    """Create the FTS5 index and its sync triggers when the database supports it"""
+    enabled = False
+    if app.config.get('SEARCH_FTS_ENABLED', True):
+        with app.app_context():
+            enabled = _setup_fts()
+    app.extensions['client_search'] = {'fts': enabled}
+
+
+def fts_enabled():
+    return current_app.extensions.get('client_search', {}).get('fts', False)
+
+
+def _setup_fts():
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    with db.engine.begin() as connection:
+        options = {row[0] for row in connection.exec_driver_sql('PRAGMA compile_options')}
+        if 'ENABLE_FTS5' not in options:
+            return False
+        existed = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE name = 'client_fts'"
+        ).first()
+        for statement in _FTS_DDL:
+            connection.exec_driver_sql(statement)
+        if not existed:
+            # Index any clients that predate the FTS table
+            connection.exec_driver_sql("INSERT INTO client_fts(client_fts) VALUES ('rebuild')")
+    return True
+
+
+def rebuild_fts():
+    """Rebuild the FTS index from the client table"""
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO client_fts(client_fts) VALUES ('rebuild')")
+
+
+def _prefix_filter(column, term):
+    # A half-open range lets the B-tree index serve the match on any backend,
+    # unlike LIKE 'term%' which SQLite only optimizes for NOCASE columns
+    return and_(column >= term, column < term + '\uffff')
+
+
+def _prefix_clause(tokens):
+    if len(tokens) == 1:
+        return or_(_prefix_filter(Client.first_name_norm, tokens[0]),
+                   _prefix_filter(Client.last_name_norm, tokens[0]))
+    first, last = tokens[0], ' '.join(tokens[1:])
+    return or_(
+        and_(_prefix_filter(Client.first_name_norm, first),
+             _prefix_filter(Client.last_name_norm, last)),
+        and_(_prefix_filter(Client.last_name_norm, first),
+             _prefix_filter(Client.first_name_norm, last)),
+    )
+
+
+def fts_match_expression(term):
+    """Build an FTS5 MATCH expression: every token must prefix-match a name or sound alike"""
+    clauses = []
+    for token in normalize_name(term).split():
+        token = token.replace('"', '')
+        if not token:
+            continue
+        options = [f'{{first_name_norm last_name_norm}} : "{token}" *']
+        code = soundex(token)
+        if code:
+            options.append(f'name_phonetic : "{code}"')
+        clauses.append('(' + ' OR '.join(options) + ')')
+    return ' AND '.join(clauses)
+
+
+def _fts_ids(match, limit=None):
+    sql = 'SELECT rowid FROM client_fts WHERE client_fts MATCH :match'
+    params = {'match': match}
+    if limit is not None:
+        sql += ' ORDER BY rank LIMIT :limit'
+        params['limit'] = limit
+    return text(sql).bindparams(**params)
+
+
+def filter_clients(query, search_term=None, first_name=None, last_name=None, mode='prefix'):
+    """Apply name filters to a Client query using the requested search mode"""
+    if mode not in SEARCH_MODES:
+        raise SearchError(f'mode must be one of: {", ".join(SEARCH_MODES)}')
+
+    if mode == 'contains':
+        # Legacy substring matching; always a full scan
+        if search_term:
+            return query.filter(Client.first_name.ilike(f'%{search_term}%') |
+                                Client.last_name.ilike(f'%{search_term}%'))
+        if first_name:
+            query = query.filter(Client.first_name.ilike(f'%{first_name}%'))
+        if last_name:
+            query = query.filter(Client.last_name.ilike(f'%{last_name}%'))
+        return query
+
+    if mode == 'fts':
+        if not fts_enabled():
+            raise SearchError('Full-text search is not available on this database')
+        if search_term:
+            match = fts_match_expression(search_term)
+            if match:
+                query = query.filter(Client.id.in_(_fts_ids(match).columns(rowid=db.Integer)))
+            return query
+        # first_name/last_name use the same indexed prefix filters as mode=prefix
+
+    if search_term:
+        tokens = normalize_name(search_term).split()
+        if tokens:
+            query = query.filter(_prefix_clause(tokens))
+        return query
+    if first_name and normalize_name(first_name):
+        query = query.filter(_prefix_filter(Client.first_name_norm, normalize_name(first_name)))
+    if last_name and normalize_name(last_name):
+        query = query.filter(_prefix_filter(Client.last_name_norm, normalize_name(last_name)))
+    return query
+
+
+def search_page(query, serialize, allowed_fields, shape=None):
+    """
+    Run the client search described by the request arguments and return a
+    response envelope. Clients are serialized with `serialize`, or built
+    from the columns of `shape` when one is given.
+
+    `rank=id` (default) is keyset paginated like every other collection.
+    `rank=name` returns the first `limit` matches in index order and
+    `rank=relevance` the `limit` best BM25 matches from the FTS index;
+    neither of those return a cursor.
+    """
+    args = request.args
+    mode = args.get('mode', 'prefix')
+    rank = args.get('rank', 'id')
+    search_term = args.get('search')
+
+    if rank not in RANK_ORDERS:
+        raise SearchError(f'rank must be one of: {", ".join(RANK_ORDERS)}')
+
+    if rank == 'relevance':
+        if mode != 'fts' or not search_term:
+            raise SearchError('rank=relevance requires mode=fts and a search term')
+        if not fts_enabled():
+            raise SearchError('Full-text search is not available on this database')
+        match = fts_match_expression(search_term)
+        if not match:
+            return {'items': [], 'next_cursor': None}
+        limit = parse_limit(args.get('limit'))
+        ids = [row[0] for row in db.session.execute(_fts_ids(match, limit))]
+        matches = query.filter(Client.id.in_(ids))
+        if shape is not None:
+            items = {item['id']: item for item in shape.dump(matches.with_entities(*shape.columns))}
+        else:
+            items = {client.id: serialize(client) for client in matches}
+        return {'items': [items[i] for i in ids if i in items], 'next_cursor': None}
+
+    query = filter_clients(query, search_term, args.get('first_name'),
+                           args.get('last_name'), mode)
+
+    if rank == 'name':
+        limit = parse_limit(args.get('limit'))
+        query = query.order_by(Client.last_name_norm, Client.first_name_norm, Client.id).limit(limit)
+        if shape is not None:
+            items = shape.dump(query.with_entities(*shape.columns))
+        else:
+            items = [serialize(client) for client in query]
+        return {'items': items, 'next_cursor': None}
+
+    return paginate(query, Client.id, serialize, allowed_fields, shape=shape)
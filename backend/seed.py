@@ -104,18 +104,17 @@ def seed_database():
     enrollment_statuses = ['active', 'completed', 'suspended']
     enrollment_status_weights = [0.7, 0.2, 0.1]  # 70% active, 20% completed, 10% suspended
     
+    # Track pairs in memory rather than querying once per enrollment
+    enrolled_pairs = set()
+    
     for client in created_clients:
         # Enroll each client in 1-3 random programs
         for _ in range(random.randint(1, 3)):
             program = random.choice(created_programs)
             
             # Check if client is already enrolled in this program
-            existing_enrollment = Enrollment.query.filter_by(
-                client_id=client.id,
-                program_id=program.id
-            ).first()
-            
-            if not existing_enrollment:
+            if (client.id, program.id) not in enrolled_pairs:
+                enrolled_pairs.add((client.id, program.id))
                 # Random enrollment between 1 and 365 days ago
                 days_ago = random.randint(1, 365)
                 enrollment_date = datetime.now() - timedelta(days=days_ago)
@@ -0,0 +1,99 @@
+"""
+Fast serialization for list responses.
+
+RowShape describes a list payload as a set of column expressions. List
+routes select exactly those columns and turn the result tuples into dicts,
+skipping ORM identity-map bookkeeping, attribute instrumentation and the
+lazy loads a to_dict() may trigger. Date and datetime columns are found once
+when the shape is built, so only those positions are converted per row.
+
+JSONProvider replaces Flask's JSON provider with orjson when it is
+installed (pip install orjson), falling back to the standard library.
+"""
+from datetime import date, datetime
+from decimal import Decimal
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import Date, DateTime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class RowShape:
+    """Column expressions for a list payload and a tuple -> dict builder"""
+
+    def __init__(self, *columns, names=None):
+        self.columns = columns
+        self.names = tuple(names or (column.key for column in columns))
+        self._dates = tuple(
+            i for i, column in enumerate(columns) if isinstance(column.type, (Date, DateTime))
+        )
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def dump(self, rows):
+        """Turn result rows (tuples in column order) into a list of dicts"""
+        names = self.names
+        if not self._dates:
+            return [dict(zip(names, row)) for row in rows]
+        dates = self._dates
+        items = []
+        for row in rows:
+            values = list(row)
+            for i in dates:
+                value = values[i]
+                if value is not None:
+                    values[i] = value.isoformat()
+            items.append(dict(zip(names, values)))
+        return items
+
+    def dump_lists(self, rows):
+        """Like dump, but each row stays a list in column order (names sent once)"""
+        dates = self._dates
+        items = []
+        for row in rows:
+            values = list(row)
+            for i in dates:
+                value = values[i]
+                if value is not None:
+                    values[i] = value.isoformat()
+            items.append(values)
+        return items
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes with orjson when available"""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self._encode(obj).decode()
+
+    def _encode(self, obj, indent=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=_default, option=option)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is None and self._app.debug or self.compact is False
+        body = self._encode(obj, indent=indent)
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
@@ -0,0 +1,255 @@
+"""
+Dashboard statistics.
+
+Stats are served either from SQL COUNT/GROUP BY aggregates or, when
+STATS_COUNTERS_ENABLED is set (the default), from the stat_counter table.
+Counters are adjusted in a before_flush hook, so they are written in the
+same transaction as the client/enrollment/program rows they describe.
+Writes that bypass the ORM must call `apply_deltas` themselves.
+"""
+from collections import Counter
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, inspect, text
+from sqlalchemy.orm import Session
+from models import db, Client, HealthProgram, Enrollment, StatCounter
+
+DEFAULT_DAYS = 30
+MAX_DAYS = 366
+TOTAL_KEYS = ('clients', 'programs', 'enrollments')
+
+_UPSERT = text(
+    'INSERT INTO stat_counter (key, value) VALUES (:key, :delta) '
+    'ON CONFLICT (key) DO UPDATE SET value = stat_counter.value + excluded.value'
+)
+
+
+def init_app(app):
+    """Enable counter maintenance and seed the counters for an existing database"""
+    enabled = app.config.get('STATS_COUNTERS_ENABLED', True)
+    app.extensions['stats'] = {'counters': enabled}
+    if enabled:
+        with app.app_context():
+            if db.session.get(StatCounter, 'clients') is None:
+                rebuild_counters()
+
+
+def counters_enabled():
+    return has_app_context() and current_app.extensions.get('stats', {}).get('counters', False)
+
+
+# --- Counter keys ---
+
+def client_keys(registered_at):
+    day = (registered_at or datetime.utcnow()).date().isoformat()
+    return ['clients', f'clients:registered:{day}']
+
+
+def enrollment_keys(program_id, status):
+    # status is None on a pending insert; the column default is 'active'
+    status = status or 'active'
+    return ['enrollments', f'enrollments:status:{status}', f'program:{program_id}:{status}']
+
+
+def apply_deltas(connection, deltas):
+    """Add a Counter of key -> delta to stat_counter on the given connection"""
+    params = [{'key': key, 'delta': delta} for key, delta in deltas.items() if delta]
+    if params:
+        connection.execute(_UPSERT, params)
+
+
+def removal_deltas(enrollment_condition=None, client_condition=None, programs=0):
+    """
+    Counter deltas for a set-based delete of the enrollments and clients
+    matching the given conditions and of `programs` programs, from grouped
+    counts taken before the DELETE runs.
+    """
+    deltas = Counter()
+    if enrollment_condition is not None:
+        for program_id, status, count in db.session.query(
+            Enrollment.program_id, Enrollment.status, func.count(Enrollment.id)
+        ).filter(enrollment_condition).group_by(Enrollment.program_id, Enrollment.status):
+            for key in enrollment_keys(program_id, status):
+                deltas[key] -= count
+    if client_condition is not None:
+        day = func.date(Client.registered_at)
+        for registered, count in db.session.query(day, func.count(Client.id)) \
+                .filter(client_condition).group_by(day):
+            deltas['clients'] -= count
+            if registered is not None:
+                deltas[f'clients:registered:{registered}'] -= count
+    deltas['programs'] -= programs
+    return deltas
+
+
+@event.listens_for(Session, 'before_flush')
+def _track_counters(session, flush_context, instances):
+    if not counters_enabled():
+        return
+
+    deltas = Counter()
+    for obj in session.new:
+        if isinstance(obj, Client):
+            deltas.update(client_keys(obj.registered_at))
+        elif isinstance(obj, Enrollment):
+            deltas.update(enrollment_keys(obj.program_id, obj.status))
+        elif isinstance(obj, HealthProgram):
+            deltas['programs'] += 1
+
+    for obj in session.deleted:
+        if isinstance(obj, Client):
+            deltas.subtract(client_keys(obj.registered_at))
+        elif isinstance(obj, Enrollment):
+            deltas.subtract(enrollment_keys(obj.program_id, obj.status))
+        elif isinstance(obj, HealthProgram):
+            deltas['programs'] -= 1
+
+    for obj in session.dirty:
+        if not isinstance(obj, Enrollment) or obj in session.deleted:
+            continue
+        state = inspect(obj)
+        status = state.attrs.status.history
+        program = state.attrs.program_id.history
+        if not status.has_changes() and not program.has_changes():
+            continue
+        old_status = status.deleted[0] if status.deleted else obj.status
+        old_program = program.deleted[0] if program.deleted else obj.program_id
+        deltas.subtract(enrollment_keys(old_program, old_status))
+        deltas.update(enrollment_keys(obj.program_id, obj.status))
+
+    apply_deltas(session.connection(), deltas)
+
+
+def expected_counters():
+    """Compute every counter value from the base tables with grouped aggregates"""
+    deltas = Counter()
+    deltas['clients'] = db.session.query(func.count(Client.id)).scalar()
+    deltas['programs'] = db.session.query(func.count(HealthProgram.id)).scalar()
+    day = func.date(Client.registered_at)
+    for registered, count in db.session.query(day, func.count(Client.id)).group_by(day):
+        if registered is not None:
+            deltas[f'clients:registered:{registered}'] = count
+
+    by_program = db.session.query(
+        Enrollment.program_id, Enrollment.status, func.count(Enrollment.id)
+    ).group_by(Enrollment.program_id, Enrollment.status)
+    for program_id, status, count in by_program:
+        deltas.update({key: count for key in enrollment_keys(program_id, status)[1:]})
+        deltas['enrollments'] += count
+    return deltas
+
+
+def check_counters():
+    """Return {key: (stored, expected)} for every counter that has drifted"""
+    expected = expected_counters()
+    stored = dict(db.session.query(StatCounter.key, StatCounter.value))
+    drift = {}
+    for key in set(expected) | set(stored):
+        if stored.get(key, 0) != expected.get(key, 0):
+            drift[key] = (stored.get(key, 0), expected.get(key, 0))
+    return drift
+
+
+def rebuild_counters():
+    """Recompute every counter from the base tables in one transaction"""
+    deltas = expected_counters()
+    db.session.query(StatCounter).delete()
+    db.session.add_all(
+        StatCounter(key=key, value=value)
+        for key, value in deltas.items()
+        if value or key in TOTAL_KEYS
+    )
+    db.session.commit()
+    return deltas
+
+
+# --- Readers ---
+
+def _counters_with_prefix(prefix, start='', end='\uffff'):
+    # Counter keys share a prefix per family, so a key range is a PK index scan
+    rows = db.session.query(StatCounter.key, StatCounter.value).filter(
+        StatCounter.key >= prefix + start, StatCounter.key < prefix + end
+    )
+    return [(key[len(prefix):], value) for key, value in rows]
+
+
+def _stats_from_counters(since):
+    totals = dict(db.session.query(StatCounter.key, StatCounter.value).filter(
+        StatCounter.key.in_(TOTAL_KEYS)
+    ))
+    by_status = dict(_counters_with_prefix('enrollments:status:'))
+    by_program = {}
+    for suffix, value in _counters_with_prefix('program:'):
+        program_id, status = suffix.split(':', 1)
+        by_program.setdefault(int(program_id), {})[status] = value
+    per_day = _counters_with_prefix('clients:registered:', start=since.isoformat())
+    return totals, by_status, by_program, per_day
+
+
+def _stats_from_aggregates(since):
+    totals = {
+        'clients': db.session.query(func.count(Client.id)).scalar(),
+        'programs': db.session.query(func.count(HealthProgram.id)).scalar(),
+        'enrollments': db.session.query(func.count(Enrollment.id)).scalar(),
+    }
+    by_status = dict(db.session.query(Enrollment.status, func.count(Enrollment.id))
+                     .group_by(Enrollment.status))
+    by_program = {}
+    for program_id, status, count in db.session.query(
+        Enrollment.program_id, Enrollment.status, func.count(Enrollment.id)
+    ).group_by(Enrollment.program_id, Enrollment.status):
+        by_program.setdefault(program_id, {})[status] = count
+    day = func.date(Client.registered_at)
+    per_day = db.session.query(day, func.count(Client.id)).filter(
+        Client.registered_at >= datetime.combine(since, datetime.min.time())
+    ).group_by(day).order_by(day).all()
+    return totals, by_status, by_program, [(str(d), count) for d, count in per_day]
+
+
+def active_client_counts(program_ids):
+    """Active enrollment count per program id, in one query whatever the number of programs"""
+    if not program_ids:
+        return {}
+    if counters_enabled():
+        keys = {f'program:{program_id}:active': program_id for program_id in program_ids}
+        rows = db.session.query(StatCounter.key, StatCounter.value).filter(StatCounter.key.in_(keys))
+        counts = {keys[key]: value for key, value in rows}
+    else:
+        counts = dict(db.session.query(Enrollment.program_id, func.count(Enrollment.id)).filter(
+            Enrollment.program_id.in_(program_ids), Enrollment.status == 'active'
+        ).group_by(Enrollment.program_id))
+    return {program_id: counts.get(program_id, 0) for program_id in program_ids}
+
+
+def get_stats(days=DEFAULT_DAYS):
+    """Totals, enrollments by status and program, and daily registrations"""
+    days = max(1, min(days, MAX_DAYS))
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    use_counters = counters_enabled()
+    if use_counters:
+        totals, by_status, by_program, per_day = _stats_from_counters(since)
+    else:
+        totals, by_status, by_program, per_day = _stats_from_aggregates(since)
+
+    programs = []
+    for program_id, name in db.session.query(HealthProgram.id, HealthProgram.name).order_by(HealthProgram.id):
+        counts = by_program.get(program_id, {})
+        programs.append({
+            'program_id': program_id,
+            'name': name,
+            'active': counts.get('active', 0),
+            'total': sum(counts.values())
+        })
+
+    return {
+        'totals': {
+            'clients': totals.get('clients', 0),
+            'programs': totals.get('programs', 0),
+            'enrollments': totals.get('enrollments', 0),
+            'active_enrollments': by_status.get('active', 0)
+        },
+        'enrollments_by_status': {status: count for status, count in by_status.items() if count},
+        'enrollments_by_program': programs,
+        'registrations_per_day': [{'date': d, 'count': count} for d, count in per_day if count],
+        'source': 'counters' if use_counters else 'aggregates'
+    }
@@ -0,0 +1,323 @@
+"""
+Delta sync for offline field devices.
+
+Every write to a client, program or enrollment stamps the row's row_version
+with the next value of a single-row clock (sync_clock), taken in the same
+transaction: ORM writes from a before_flush hook, bulk imports through
+stamp(). Deletes leave a tombstone carrying a clock value too. Taking the
+clock locks its row until commit, so versions become visible in order and a
+device that has seen version N has seen everything up to N.
+
+GET /api/sync?since=<token> returns the current state of every row changed
+after the token plus the ids deleted since, compactly (column names once,
+rows as lists, gzip when accepted), and a token for the next call. Without a
+token it returns a full snapshot, page by page. Tombstones are pruned after
+SYNC_TOMBSTONE_DAYS (default 90); an older token gets 410 Gone and the device
+starts over from a snapshot.
+
+upload() applies records created offline. Each carries the device's own
+local_id; the server id it was given is kept in sync_upload, so re-sending
+an upload after a dropped connection does not create anything twice.
+"""
+import gzip
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context, request
+from sqlalchemy import event, insert, literal, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from models import (db, Client, HealthProgram, Enrollment, SyncClock, SyncUpload, Tombstone)
+from pagination import decode_cursor, encode_cursor
+from serialization import RowShape
+import bulk
+import history
+import linkage
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+DEFAULT_TOMBSTONE_DAYS = 90
+MIN_GZIP_SIZE = 1024
+
+ENTITIES = {Client: 'client', HealthProgram: 'program', Enrollment: 'enrollment'}
+
+# What a device keeps of each synced table, in response order
+SHAPES = {
+    'programs': (HealthProgram, RowShape(
+        HealthProgram.id, HealthProgram.name, HealthProgram.description, HealthProgram.created_date
+    )),
+    'clients': (Client, RowShape(
+        Client.id, Client.first_name, Client.last_name, Client.date_of_birth, Client.gender,
+        Client.contact_number, Client.email, Client.address, Client.registered_at
+    )),
+    'enrollments': (Enrollment, RowShape(
+        Enrollment.id, Enrollment.client_id, Enrollment.program_id, Enrollment.enrollment_date,
+        Enrollment.status, Enrollment.notes
+    )),
+}
+
+
+class SyncError(ValueError):
+    """Raised for a malformed sync token or upload"""
+
+
+class TokenExpired(SyncError):
+    """The token predates pruned tombstones; the device must resync from a snapshot"""
+
+
+def init_app(app):
+    app.extensions['sync'] = {
+        'tombstone_days': app.config.get('SYNC_TOMBSTONE_DAYS', DEFAULT_TOMBSTONE_DAYS),
+    }
+    with app.app_context():
+        if db.session.get(SyncClock, 1) is None:
+            db.session.add(SyncClock(id=1, version=0, pruned_through=0))
+            db.session.commit()
+
+
+def sync_enabled():
+    return has_app_context() and 'sync' in current_app.extensions
+
+
+def next_version(connection):
+    """Advance the clock and return its new value; holds the clock row until commit"""
+    return connection.execute(
+        update(SyncClock).where(SyncClock.id == 1)
+        .values(version=SyncClock.version + 1).returning(SyncClock.version)
+    ).scalar_one()
+
+
+def stamp(connection, rows):
+    """Give column-value dicts about to be inserted with Core one new row_version"""
+    version = next_version(connection)
+    for values in rows:
+        values['row_version'] = version
+    return version
+
+
+@event.listens_for(Session, 'before_flush')
+def _stamp_changes(session, flush_context, instances):
+    if not sync_enabled():
+        return
+    changed = [obj for obj in list(session.new) + list(session.dirty)
+               if type(obj) in ENTITIES and obj not in session.deleted
+               and (obj in session.new or session.is_modified(obj))]
+    deleted = [obj for obj in session.deleted if type(obj) in ENTITIES]
+    if not changed and not deleted:
+        return
+    connection = session.connection()
+    version = next_version(connection)
+    for obj in changed:
+        obj.row_version = version
+    if deleted:
+        now = datetime.utcnow()
+        connection.execute(insert(Tombstone), [
+            {'entity': ENTITIES[type(obj)], 'entity_id': obj.id, 'row_version': version, 'deleted_at': now}
+            for obj in deleted
+        ])
+
+
+def tombstone_where(connection, model, condition):
+    """Leave tombstones for the rows a set-based DELETE of `condition` is about to remove"""
+    version = next_version(connection)
+    connection.execute(insert(Tombstone).from_select(
+        ['entity', 'entity_id', 'row_version', 'deleted_at'],
+        select(literal(ENTITIES[model]), model.id, literal(version), literal(datetime.utcnow()))
+        .where(condition)
+    ))
+
+
+# --- Reading changes ---
+
+def parse_token(token):
+    if not token:
+        return 0
+    try:
+        return decode_cursor(token)
+    except ValueError:
+        raise SyncError('Invalid sync token')
+
+
+def parse_limit(value):
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise SyncError('limit must be an integer')
+    if limit < 1:
+        raise SyncError('limit must be positive')
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def _upto(since, limit):
+    """Highest version to include so a page holds about `limit` rows, and whether more follow"""
+    tables = [model.row_version for model, _ in SHAPES.values()]
+    if since:
+        tables.append(Tombstone.row_version)
+    versions = []
+    more = False
+    for column in tables:
+        found = db.session.execute(
+            select(column).where(column > since).order_by(column).limit(limit + 1)
+        ).scalars().all()
+        more = more or len(found) > limit
+        versions.extend(found)
+    if not versions:
+        return None, False
+    versions.sort()
+    if len(versions) <= limit:
+        return versions[-1], more
+    # Never split the rows written by one transaction across pages
+    upto = versions[limit - 1]
+    return upto, more or versions[-1] > upto
+
+
+def changes(since=0, limit=DEFAULT_PAGE_SIZE):
+    """
+    Rows written and ids deleted after version `since`, at most about
+    `limit` of them, as the /api/sync response body.
+    """
+    clock = db.session.get(SyncClock, 1)
+    if since and since < clock.pruned_through:
+        raise TokenExpired('Sync token is older than the retained deletions; resync without since')
+    upto, has_more = _upto(since, limit)
+    body = {}
+    for name, (model, shape) in SHAPES.items():
+        rows = []
+        if upto is not None:
+            rows = db.session.execute(
+                select(*shape.columns)
+                .where(model.row_version > since, model.row_version <= upto).order_by(model.id)
+            ).all()
+        body[name] = {'columns': list(shape.names), 'rows': shape.dump_lists(rows), 'deleted': []}
+    if since and upto is not None:
+        for entity, entity_id in db.session.execute(
+            select(Tombstone.entity, Tombstone.entity_id)
+            .where(Tombstone.row_version > since, Tombstone.row_version <= upto).order_by(Tombstone.id)
+        ):
+            body[entity + 's']['deleted'].append(entity_id)
+    # With nothing left, the clock read in this same transaction covers every
+    # committed write, so the next call starts from there
+    version = upto if has_more else max(clock.version, since)
+    body.update(next=encode_cursor(version), has_more=has_more, snapshot=not since)
+    return body
+
+
+def compress(response):
+    """Gzip a response body when the client accepts it and it is worth it"""
+    if 'gzip' not in request.headers.get('Accept-Encoding', '') or \
+            response.content_length is None or response.content_length < MIN_GZIP_SIZE:
+        return response
+    response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def prune(days=None):
+    """Delete tombstones older than the retention period; returns how many went"""
+    days = current_app.extensions['sync']['tombstone_days'] if days is None else days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    through = db.session.execute(
+        select(db.func.max(Tombstone.row_version)).where(Tombstone.deleted_at < cutoff)
+    ).scalar()
+    if through is None:
+        return 0
+    pruned = db.session.query(Tombstone).filter(Tombstone.row_version <= through).delete()
+    db.session.execute(update(SyncClock).where(SyncClock.id == 1).values(pruned_through=through))
+    db.session.commit()
+    return pruned
+
+
+# --- Uploads from devices ---
+
+def _uploaded(device_id, entity, local_id):
+    row = db.session.get(SyncUpload, (device_id, entity, str(local_id)))
+    return row.entity_id if row is not None else None
+
+
+def _record_upload(device_id, entity, local_id, entity_id):
+    db.session.add(SyncUpload(device_id=device_id, entity=entity, local_id=str(local_id), entity_id=entity_id))
+
+
+def _upload_client(device_id, record):
+    local_id = record.get('local_id')
+    existing = _uploaded(device_id, 'client', local_id)
+    if existing is not None:
+        return {'local_id': local_id, 'id': existing, 'status': 'existing'}
+    values = bulk.validate_client(record)
+    if record.get('registered_at'):
+        try:
+            values['registered_at'] = datetime.fromisoformat(record['registered_at'])
+        except (TypeError, ValueError):
+            raise bulk.RowError('Invalid registered_at. Use ISO 8601')
+    if linkage.settings()['on_register'] == 'reject' and not record.get('confirm_new'):
+        matches = linkage.find_matches(values)
+        if linkage.is_likely_duplicate(matches):
+            return {'local_id': local_id, 'status': 'duplicate', 'matches': matches}
+    client = Client(**values)
+    db.session.add(client)
+    db.session.flush()
+    _record_upload(device_id, 'client', local_id, client.id)
+    return {'local_id': local_id, 'id': client.id, 'status': 'created'}
+
+
+def _upload_enrollment(device_id, record, client_ids):
+    local_id = record.get('local_id')
+    existing = _uploaded(device_id, 'enrollment', local_id)
+    if existing is not None:
+        return {'local_id': local_id, 'id': existing, 'status': 'existing'}
+    record = dict(record)
+    client_local_id = record.get('client_local_id')
+    if client_local_id is not None and record.get('client_id') in (None, ''):
+        # A client created on the device, in this upload or an earlier one
+        client_id = client_ids.get(str(client_local_id)) or _uploaded(device_id, 'client', client_local_id)
+        if client_id is None:
+            raise bulk.RowError(f'Unknown client_local_id {client_local_id}')
+        record['client_id'] = client_id
+    values = bulk.validate_enrollment(record)
+    if db.session.get(Client, values['client_id']) is None:
+        raise bulk.RowError('Client not found')
+    if db.session.get(HealthProgram, values['program_id']) is None:
+        raise bulk.RowError('Program not found')
+    if values['status'] == 'active' and history.already_active(values['client_id'], values['program_id']):
+        raise bulk.RowError('Client is already enrolled in this program')
+    enrollment = Enrollment(**values)
+    db.session.add(enrollment)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        raise bulk.RowError('Client is already enrolled in this program')
+    _record_upload(device_id, 'enrollment', local_id, enrollment.id)
+    return {'local_id': local_id, 'id': enrollment.id, 'status': 'created'}
+
+
+def upload(device_id, payload):
+    """
+    Apply clients and enrollments created offline, in one transaction with a
+    savepoint per record. Returns per-record outcomes keyed by local_id.
+    """
+    if not device_id:
+        raise SyncError('device_id is required')
+    results = {'clients': [], 'enrollments': []}
+    client_ids = {}
+    for name, apply in (('clients', _upload_client), ('enrollments', _upload_enrollment)):
+        records = payload.get(name) or []
+        if not isinstance(records, list):
+            raise SyncError(f'{name} must be a list')
+        for record in records:
+            if not isinstance(record, dict) or record.get('local_id') in (None, ''):
+                results[name].append({'local_id': None, 'status': 'error', 'error': 'local_id is required'})
+                continue
+            try:
+                with db.session.begin_nested():
+                    if name == 'clients':
+                        outcome = apply(device_id, record)
+                    else:
+                        outcome = apply(device_id, record, client_ids)
+            except bulk.RowError as exc:
+                outcome = {'local_id': record['local_id'], 'status': 'error', 'error': str(exc)}
+            if name == 'clients' and 'id' in outcome:
+                client_ids[str(record['local_id'])] = outcome['id']
+            results[name].append(outcome)
+    db.session.commit()
+    return results
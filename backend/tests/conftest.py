@@ -0,0 +1,55 @@
+import pytest
+from sqlalchemy import event
+from app import create_app
+from models import db
+
+
+@pytest.fixture
+def app_config():
+    """Extra config for the app fixture; override in a module to turn features back on"""
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, app_config):
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "test.db"}',
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'TESTING': True,
+        # Every request should reach the database and nothing run in the background
+        'RESPONSE_CACHE_ENABLED': False,
+        'ADMISSION_ENABLED': False,
+        'IDEMPOTENCY_ENABLED': False,
+        'JOBS_EMBEDDED_WORKER': False,
+        'JOBS_DIR': str(tmp_path / 'jobs'),
+        **app_config,
+    })
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def count_queries(app):
+    """count_queries(fn) runs fn and returns the number of SQL statements it executed"""
+    def count(fn):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            fn()
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        return len(statements)
+    return count
@@ -0,0 +1,38 @@
+"""Client registration validates its body before any lookup"""
+import pytest
+
+CLIENT = {'first_name': 'Ann', 'last_name': 'Smith', 'date_of_birth': '1990-01-01', 'gender': 'Female'}
+
+
+@pytest.mark.parametrize('field, value, error', [
+    ('first_name', 123, 'first_name must be a non-empty string'),
+    ('last_name', ['Smith'], 'last_name must be a non-empty string'),
+    ('last_name', '   ', 'last_name must be a non-empty string'),
+    ('date_of_birth', 19900101, 'Invalid date format. Use YYYY-MM-DD'),
+])
+def test_register_client_rejects_bad_fields(client, field, value, error):
+    response = client.post('/api/clients', json={**CLIENT, field: value})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == error
+
+
+def test_register_client(client):
+    response = client.post('/api/clients', json=CLIENT)
+    assert response.status_code == 201
+    assert response.get_json()['client']['last_name'] == 'Smith'
+
+
+def test_likely_duplicate_is_registered_with_a_warning_by_default(client):
+    assert client.post('/api/clients', json=CLIENT).status_code == 201
+    response = client.post('/api/clients', json=CLIENT)
+    assert response.status_code == 201
+    assert response.get_json()['possible_duplicates']
+
+
+@pytest.mark.parametrize('app_config', [{'LINKAGE_ON_REGISTER': 'reject'}])
+def test_reject_mode_needs_confirm_new(client, app_config):
+    first = client.post('/api/clients', json=CLIENT).get_json()['client']
+    response = client.post('/api/clients', json=CLIENT)
+    assert response.status_code == 409
+    assert response.get_json()['matches'][0]['client']['id'] == first['id']
+    assert client.post('/api/clients', json={**CLIENT, 'confirm_new': True}).status_code == 201
@@ -0,0 +1,36 @@
+"""Deletes invalidate every cached response they change"""
+import pytest
+from datetime import date
+from models import db, Client, HealthProgram, Enrollment
+
+
+@pytest.fixture
+def app_config():
+    return {'RESPONSE_CACHE_ENABLED': True}
+
+
+def _seed(app):
+    with app.app_context():
+        program = HealthProgram(name='Program', description='')
+        db.session.add(program)
+        db.session.flush()
+        client_ids = []
+        for n in range(2):
+            client = Client(first_name=f'Client{n}', last_name='Test', date_of_birth=date(1990, 1, 1), gender='F')
+            db.session.add(client)
+            db.session.flush()
+            db.session.add(Enrollment(client_id=client.id, program_id=program.id))
+            client_ids.append(client.id)
+        db.session.commit()
+        return program.id, client_ids
+
+
+@pytest.mark.parametrize('archive', ['0', '1'])
+def test_deleting_a_client_refreshes_the_program_count(app, client, archive):
+    program_id, client_ids = _seed(app)
+    assert client.get(f'/api/programs/{program_id}').get_json()['program']['client_count'] == 2
+
+    response = client.delete(f'/api/clients/{client_ids[0]}?archive={archive}')
+    assert response.status_code == 200
+
+    assert client.get(f'/api/programs/{program_id}').get_json()['program']['client_count'] == 1
@@ -0,0 +1,61 @@
+"""A client holds at most one active enrollment per program, with or without the unique index"""
+import pytest
+from datetime import date
+from sqlalchemy import text
+import migrations
+from models import db, Client, HealthProgram, Enrollment
+
+
+@pytest.fixture(params=[True, False], ids=['index', 'no-index'])
+def seeded(request, app):
+    """A client and a program; without the index, as on a database awaiting upgrade-db --dedupe"""
+    with app.app_context():
+        if not request.param:
+            db.session.execute(text(f'DROP INDEX {migrations.ACTIVE_ENROLLMENT_INDEX}'))
+            db.session.commit()
+            app.extensions['active_enrollment_index'] = False
+        program = HealthProgram(name='Program', description='')
+        client = Client(first_name='Ann', last_name='Smith', date_of_birth=date(1990, 1, 1), gender='F')
+        db.session.add_all([program, client])
+        db.session.commit()
+        return client.id, program.id
+
+
+def _active(app, client_id, program_id):
+    with app.app_context():
+        return Enrollment.query.filter_by(client_id=client_id, program_id=program_id, status='active').count()
+
+
+def test_enroll_twice(app, client, seeded):
+    client_id, program_id = seeded
+    assert client.post(f'/api/clients/{client_id}/programs/{program_id}', json={}).status_code == 200
+    assert client.post(f'/api/clients/{client_id}/programs/{program_id}', json={}).status_code == 409
+    assert client.post('/api/enrollments', json={'client_id': client_id, 'program_id': program_id}).status_code == 409
+    assert _active(app, client_id, program_id) == 1
+
+
+def test_sync_upload_twice(app, client, seeded):
+    client_id, program_id = seeded
+    assert client.post(f'/api/clients/{client_id}/programs/{program_id}', json={}).status_code == 200
+    response = client.post('/api/sync', json={
+        'device_id': 'device-1',
+        'enrollments': [{'local_id': 'e1', 'client_id': client_id, 'program_id': program_id}],
+    })
+    assert response.status_code == 200
+    outcome = response.get_json()['enrollments'][0]
+    assert outcome['status'] == 'error'
+    assert outcome['error'] == 'Client is already enrolled in this program'
+    assert _active(app, client_id, program_id) == 1
+
+
+def test_reactivate_beside_an_active_enrollment(app, client, seeded):
+    client_id, program_id = seeded
+    first = client.post(f'/api/clients/{client_id}/programs/{program_id}', json={}).get_json()['enrollment']
+    assert client.patch(f'/api/enrollments/{first["id"]}', json={'status': 'completed'}).status_code == 200
+    second = client.post(f'/api/clients/{client_id}/programs/{program_id}', json={}).get_json()['enrollment']
+
+    response = client.patch(f'/api/enrollments/{first["id"]}', json={'status': 'active'})
+    assert response.status_code == 409
+    assert _active(app, client_id, program_id) == 1
+    # Re-sending the current status of the active one is not a conflict
+    assert client.patch(f'/api/enrollments/{second["id"]}', json={'status': 'active'}).status_code == 200
@@ -0,0 +1,53 @@
+"""Profile and detail endpoints issue the same number of queries however much they embed"""
+from models import db, Client, HealthProgram, Enrollment
+from datetime import date
+
+PROGRAMS = 5
+
+
+def _client(first_name, programs):
+    client = Client(first_name=first_name, last_name='Test', date_of_birth=date(1990, 1, 1), gender='F')
+    db.session.add(client)
+    db.session.flush()
+    for program in programs:
+        db.session.add(Enrollment(client_id=client.id, program_id=program.id))
+    return client
+
+
+def _seed(app):
+    with app.app_context():
+        programs = [HealthProgram(name=f'Program {n}', description='') for n in range(PROGRAMS)]
+        db.session.add_all(programs)
+        db.session.flush()
+        ids = {
+            'none': _client('None', []).id,
+            'one': _client('One', programs[:1]).id,
+            'many': _client('Many', programs).id,
+        }
+        db.session.commit()
+        return ids
+
+
+def test_get_client_query_count_is_constant(app, client, count_queries):
+    ids = _seed(app)
+    counts = {}
+    for name, client_id in ids.items():
+        def fetch():
+            response = client.get(f'/api/clients/{client_id}')
+            assert response.status_code == 200
+            assert response.get_json()['program_count'] == {'none': 0, 'one': 1, 'many': PROGRAMS}[name]
+        counts[name] = count_queries(fetch)
+    assert counts['one'] == counts['many']
+    # A client with no enrollments never costs more than one with some
+    assert counts['none'] <= counts['one']
+
+
+def test_get_enrollment_query_count_is_constant(app, client, count_queries):
+    ids = _seed(app)
+    with app.app_context():
+        enrollment_ids = [
+            Enrollment.query.filter_by(client_id=ids[name]).first().id for name in ('one', 'many')
+        ]
+    counts = [count_queries(lambda: client.get(f'/api/enrollments/{enrollment_id}'))
+              for enrollment_id in enrollment_ids]
+    assert counts[0] == counts[1]
@@ -0,0 +1,29 @@
+"""Client search filters apply in every mode"""
+import pytest
+from datetime import date
+from models import db, Client
+
+
+def _seed(app):
+    with app.app_context():
+        for first_name, last_name in (('Ann', 'Zedox'), ('Bob', 'Smith'), ('Zed', 'Jones')):
+            db.session.add(Client(first_name=first_name, last_name=last_name,
+                                  date_of_birth=date(1990, 1, 1), gender='F'))
+        db.session.commit()
+
+
+def _names(response):
+    assert response.status_code == 200
+    return sorted(item['last_name'] for item in response.get_json()['items'])
+
+
+@pytest.mark.parametrize('mode', ['prefix', 'fts', 'contains'])
+def test_name_filters_apply_in_every_mode(app, client, mode):
+    _seed(app)
+    assert _names(client.get(f'/api/clients?mode={mode}&last_name=zed')) == ['Zedox']
+    assert _names(client.get(f'/api/clients?mode={mode}&first_name=zed')) == ['Jones']
+
+
+def test_fts_search_term_matches_either_name(app, client):
+    _seed(app)
+    assert _names(client.get('/api/clients?mode=fts&search=zed')) == ['Jones', 'Zedox']
@@ -0,0 +1,27 @@
+// Largest page the API serves (PAGE_SIZE_MAX)
+const PAGE_SIZE = 1000;
+
+// Collect every item of a paginated collection endpoint by following next_cursor
+export const fetchAllPages = async (url, errorMessage = 'Failed to load data') => {
+  const items = [];
+  let after = null;
+
+  do {
+    const pageUrl = new URL(url);
+    pageUrl.searchParams.set('limit', PAGE_SIZE);
+    if (after) {
+      pageUrl.searchParams.set('after', after);
+    }
+
+    const response = await fetch(pageUrl);
+    if (!response.ok) {
+      throw new Error(errorMessage);
+    }
+
+    const data = await response.json();
+    items.push(...data.items);
+    after = data.next_cursor;
+  } while (after);
+
+  return items;
+};
@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { useParams, Link } from 'react-router-dom';
+import { fetchAllPages } from '../api';
 
 const ClientDetail = () => {
   const { id } = useParams();
@@ -25,12 +26,8 @@ const ClientDetail = () => {
         setClient(clientData);
         
         // Fetch all available programs
-        const programsResponse = await fetch('http://localhost:5000/api/programs');
-        if (!programsResponse.ok) {
-          throw new Error('Failed to fetch programs');
-        }
-        const programsData = await programsResponse.json();
-        setPrograms(programsData);
+        const programItems = await fetchAllPages('http://localhost:5000/api/programs', 'Failed to fetch programs');
+        setPrograms(programItems);
         
         setError(null);
       } catch (err) {
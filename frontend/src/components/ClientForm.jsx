@@ -1,5 +1,5 @@
 import React, { useState } from 'react';
-import { useNavigate } from 'react-router-dom';
+import { Link, useNavigate } from 'react-router-dom';
 
 const ClientForm = () => {
   const navigate = useNavigate();
@@ -13,17 +13,21 @@ const ClientForm = () => {
     address: ''
   });
   const [error, setError] = useState('');
+  const [matches, setMatches] = useState([]);
   const [loading, setLoading] = useState(false);
 
   const handleChange = (e) => {
     const { name, value } = e.target;
     setFormData(prev => ({ ...prev, [name]: value }));
+    // Matches only apply to the details they were found for
+    setMatches([]);
   };
 
-  const handleSubmit = async (e) => {
-    e.preventDefault();
+  // confirmNew registers the client even though likely duplicates were found
+  const register = async (confirmNew) => {
     setLoading(true);
     setError('');
+    setMatches([]);
   
     try {
       const response = await fetch('http://localhost:5000/api/clients', {
@@ -31,11 +35,18 @@ const ClientForm = () => {
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify(formData),
+        body: JSON.stringify(confirmNew ? { ...formData, confirm_new: true } : formData),
       });
   
       const data = await response.json();
   
+      if (response.status === 409 && data.matches) {
+        setError('This client may already be registered. Check the matches below.');
+        setMatches(data.matches);
+        setLoading(false);
+        return;
+      }
+
       if (!response.ok) {
         throw new Error(data.error || 'Failed to register client');
       }
@@ -51,6 +62,11 @@ const ClientForm = () => {
       setLoading(false);
     }
   };
+
+  const handleSubmit = (e) => {
+    e.preventDefault();
+    register(false);
+  };
   
 
   return (
@@ -58,6 +74,29 @@ const ClientForm = () => {
       <h1>Register New Client</h1>
       
       {error && <div className="error-message">{error}</div>}
+
+      {matches.length > 0 && (
+        <div className="duplicate-matches">
+          <ul>
+            {matches.map(match => (
+              <li key={match.client.id}>
+                <Link to={`/clients/${match.client.id}`}>
+                  {match.client.first_name} {match.client.last_name}
+                </Link>
+                {' '}(born {match.client.date_of_birth}, {Math.round(match.probability * 100)}% match)
+              </li>
+            ))}
+          </ul>
+          <button
+            type="button"
+            className="button"
+            onClick={() => register(true)}
+            disabled={loading}
+          >
+            Not a match, register anyway
+          </button>
+        </div>
+      )}
       
       <form onSubmit={handleSubmit} className="client-form">
         <div className="form-row">
@@ -7,15 +7,22 @@ const ClientList = () => {
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState(null);
   const [deleteMessage, setDeleteMessage] = useState(null);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [activeSearch, setActiveSearch] = useState('');
 
-  const fetchClients = async (search = '') => {
+  const fetchClients = async (search = '', after = null) => {
     try {
       setLoading(true);
-      let url = 'http://127.0.0.1:5000/api/clients';
+      // include=programs returns each client's active programs in the same response
+      let url = 'http://127.0.0.1:5000/api/clients?include=programs';
       
       if (search) {
         // Use the search parameter which handles both first and last name
-        url += `?search=${encodeURIComponent(search)}`;
+        url += `&search=${encodeURIComponent(search)}`;
+      }
+
+      if (after) {
+        url += `&after=${encodeURIComponent(after)}`;
       }
 
       const response = await fetch(url);
@@ -26,30 +33,11 @@ const ClientList = () => {
 
       const data = await response.json();
       console.log("Fetched clients:", data);
-      
-      // For each client, fetch their active programs to display the count and names
-      const clientsWithPrograms = await Promise.all(data.map(async (client) => {
-        try {
-          // Fetch the full client details including programs
-          const detailResponse = await fetch(`http://127.0.0.1:5000/api/clients/${client.id}`);
-          if (detailResponse.ok) {
-            const detailData = await detailResponse.json();
-            // If the client has programs, get them, otherwise return the basic client data
-            if (detailData.programs) {
-              return {
-                ...client,
-                programs: detailData.programs
-              };
-            }
-          }
-          return client;
-        } catch (err) {
-          console.error(`Error fetching details for client ${client.id}:`, err);
-          return client;
-        }
-      }));
 
-      setClients(clientsWithPrograms);
+      // Results are paginated; append when loading a further page
+      setClients(after ? (previous) => [...previous, ...data.items] : data.items);
+      setNextCursor(data.next_cursor);
+      setActiveSearch(search);
       setError(null);
     } catch (err) {
       setError('Error loading clients. Please try again.');
@@ -179,6 +167,16 @@ const ClientList = () => {
           ))}
         </div>
       )}
+
+      {!loading && nextCursor && (
+        <button
+          type="button"
+          onClick={() => fetchClients(activeSearch, nextCursor)}
+          className="button load-more-button"
+        >
+          Load more
+        </button>
+      )}
     </div>
   );
 };
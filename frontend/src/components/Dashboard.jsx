@@ -11,24 +11,14 @@ const Dashboard = () => {
   useEffect(() => {
     const fetchStats = async () => {
       try {
-        // Fetch client count
-        const clientResponse = await fetch('http://localhost:5000/api/clients');
-        const clients = await clientResponse.json();
-        
-        // Fetch program count
-        const programResponse = await fetch('http://localhost:5000/api/programs');
-        const programs = await programResponse.json();
-        
-        // Calculate enrollment count (in a real app, you'd have a dedicated endpoint)
-        let enrollmentCount = 0;
-        for (const client of clients) {
-          enrollmentCount += client.programs ? client.programs.length : 0;
-        }
+        // Counts are aggregated server-side, so this is one small request
+        const response = await fetch('http://localhost:5000/api/stats');
+        const data = await response.json();
         
         setStats({
-          clientCount: clients.length,
-          programCount: programs.length,
-          enrollmentCount: enrollmentCount
+          clientCount: data.totals.clients,
+          programCount: data.totals.programs,
+          enrollmentCount: data.totals.active_enrollments
         });
       } catch (error) {
         console.error('Error fetching dashboard stats:', error);
@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
+import { fetchAllPages } from '../api';
 
 const ProgramList = () => {
   const [programs, setPrograms] = useState([]);
@@ -14,14 +15,9 @@ const ProgramList = () => {
   const fetchPrograms = async () => {
     try {
       setLoading(true);
-      const response = await fetch('http://localhost:5000/api/programs');
-      
-      if (!response.ok) {
-        throw new Error('Failed to fetch programs');
-      }
-      
-      const data = await response.json();
-      setPrograms(data);
+      // Every page, so lists of more than one page are not cut short
+      const items = await fetchAllPages('http://localhost:5000/api/programs', 'Failed to fetch programs');
+      setPrograms(items);
       setError(null);
     } catch (err) {
       setError('Error loading programs. Please try again.');